@@ -0,0 +1,356 @@
+"""
+离线压测：启动桩模型服务（bench/stub_llm.py）和 Agent 服务，模拟 N 个并发用户按脚本对话，
+输出吞吐、端到端延迟和首 token 延迟的分位数，以及会话读写与工具执行的耗时占比。
+
+全程只访问本机端口，不需要网络和 API Key。Agent 服务在临时目录中运行，不会写入 data/。
+
+用法:
+    python bench/load_test.py --users 8 --conversations 5
+    python bench/load_test.py --mode chat --ttft 0.5 --tokens-per-sec 40
+    python bench/load_test.py --json bench_result.json
+    python bench/load_test.py --fast-ttft 0.1 --fast-tokens-per-sec 200   # 启用模型级联，对比按层级的耗时
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 脚本名 -> 权重，对应 stub_llm.py 中的脚本
+SCRIPT_WEIGHTS = {"chat": 3, "files": 2, "sql": 3, "python": 1}
+# 各脚本的用户消息，与真实请求一样带有意图词，工具路由器据此选择工具定义
+SCRIPT_PROMPTS = {
+    "chat": "你好，随便聊聊",
+    "files": "看看 docs 目录里的文件写了什么",
+    "sql": "用 SQL 统计 bench.db 里的订单",
+    "python": "用 Python 计算一下平方和",
+}
+
+
+# ----------------------------------------------------------------------
+# 环境准备
+# ----------------------------------------------------------------------
+
+def prepare_workdir(workdir: str):
+    """准备 Agent 服务的运行目录，以及脚本中工具调用要访问的文件和数据库。"""
+    os.symlink(os.path.join(ROOT, "web"), os.path.join(workdir, "web"))
+    os.makedirs(os.path.join(workdir, "data"))
+    shutil.copy(os.path.join(ROOT, "data", "personas.json"), os.path.join(workdir, "data", "personas.json"))
+
+    docs = os.path.join(workdir, "docs")
+    os.makedirs(docs)
+    with open(os.path.join(docs, "report.md"), "w", encoding="utf-8") as f:
+        f.write("# 月度报告\n\n" + "本月各项指标稳定，订单量和客单价均有提升。\n" * 200)
+    with open(os.path.join(docs, "notes.txt"), "w", encoding="utf-8") as f:
+        f.write("待办：复盘库存周转；跟进退款率偏高的品类。\n" * 50)
+
+    conn = sqlite3.connect(os.path.join(workdir, "bench.db"))
+    conn.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, region TEXT, category TEXT, amount REAL)")
+    rng = random.Random(0)
+    conn.executemany(
+        "INSERT INTO orders (region, category, amount) VALUES (?, ?, ?)",
+        [(rng.choice(["华东", "华北", "华南", "西南"]), rng.choice(["服饰", "家电", "食品", "图书", "美妆"]),
+          round(rng.uniform(10, 2000), 2)) for _ in range(20000)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def start_process(args: List[str], env: Dict[str, str], cwd: str, log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    return subprocess.Popen(args, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url, timeout=1)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"服务未能在 {timeout} 秒内启动: {url}")
+
+
+# ----------------------------------------------------------------------
+# 模拟用户
+# ----------------------------------------------------------------------
+
+class Results:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.ttfts: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.by_script: Dict[str, List[float]] = {}
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def ok(self, script: str, latency: float, ttft: Optional[float]):
+        self.latencies.append(latency)
+        self.by_script.setdefault(script, []).append(latency)
+        if ttft is not None:
+            self.ttfts.append(ttft)
+
+
+async def stream_request(client: httpx.AsyncClient, payload: Dict, script: str, results: Results) -> Optional[str]:
+    start = time.perf_counter()
+    ttft = None
+    session_id = None
+    async with client.stream("POST", "/api/chat/stream", json=payload) as response:
+        if response.status_code != 200:
+            results.error(f"http_{response.status_code}")
+            return payload.get("session_id")
+        async for line in response.aiter_lines():
+            if not line.startswith("data: ") or line == "data: [DONE]":
+                continue
+            event = json.loads(line[6:])
+            if event.get("type") == "meta" and event.get("session_id"):
+                session_id = event["session_id"]
+            elif event.get("type") == "error":
+                results.error("agent_error")
+            elif event.get("type") in ("content", "tool_start") and ttft is None:
+                # 用户看到的首个输出（文字或工具调用）
+                ttft = time.perf_counter() - start
+    results.ok(script, time.perf_counter() - start, ttft)
+    return session_id
+
+
+async def chat_request(client: httpx.AsyncClient, payload: Dict, script: str, results: Results) -> Optional[str]:
+    start = time.perf_counter()
+    response = await client.post("/api/chat", json=payload)
+    if response.status_code != 200:
+        results.error(f"http_{response.status_code}")
+        return payload.get("session_id")
+    results.ok(script, time.perf_counter() - start, None)
+    return response.json().get("session_id")
+
+
+async def simulated_user(user: int, base_url: str, args, results: Results):
+    rng = random.Random(user)
+    scripts = list(SCRIPT_WEIGHTS)
+    weights = [SCRIPT_WEIGHTS[s] for s in scripts]
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout) as client:
+        for _ in range(args.conversations):
+            session_id = None
+            for turn in range(args.turns):
+                script = rng.choices(scripts, weights)[0]
+                payload = {"text": f"[bench:{script}] {SCRIPT_PROMPTS[script]}（用户 {user} 第 {turn + 1} 轮）", "session_id": session_id}
+                mode = args.mode if args.mode != "mixed" else rng.choice(["stream", "chat"])
+                try:
+                    if mode == "stream":
+                        session_id = await stream_request(client, payload, script, results)
+                    else:
+                        session_id = await chat_request(client, payload, script, results)
+                except httpx.HTTPError as e:
+                    results.error(type(e).__name__)
+                if args.think_time:
+                    await asyncio.sleep(rng.uniform(0, args.think_time))
+
+
+# ----------------------------------------------------------------------
+# 报告
+# ----------------------------------------------------------------------
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def parse_span_sums(metrics_text: str) -> Dict[str, float]:
+    """从 /api/metrics 中取出各 span 的累计耗时（秒）。"""
+    sums: Dict[str, float] = {}
+    for line in metrics_text.splitlines():
+        if line.startswith("agent_span_duration_seconds_sum{"):
+            labels, value = line[len("agent_span_duration_seconds_sum{"):].rsplit("} ", 1)
+            span = labels.split('span="', 1)[1].split('"', 1)[0]
+            sums[span] = sums.get(span, 0.0) + float(value)
+    return sums
+
+
+def parse_tier_stats(metrics_text: str) -> Dict[str, float]:
+    """从 /api/metrics 中取出按模型层级的请求耗时、次数和 token 数，键为 "tier.指标"。"""
+    stats: Dict[str, float] = {}
+    prefixes = {"llm_tier_request_seconds_sum{": "seconds", "llm_tier_request_seconds_count{": "requests",
+                "llm_tier_tokens_total{": None}
+    for line in metrics_text.splitlines():
+        for prefix, field in prefixes.items():
+            if not line.startswith(prefix):
+                continue
+            labels, value = line[len(prefix):].rsplit("} ", 1)
+            tier = labels.split('tier="', 1)[1].split('"', 1)[0]
+            key = field or labels.split('kind="', 1)[1].split('"', 1)[0] + "_tokens"
+            stats[f"{tier}.{key}"] = stats.get(f"{tier}.{key}", 0.0) + float(value)
+    return stats
+
+
+def build_report(results: Results, elapsed: float, before: Dict[str, float], after: Dict[str, float], args,
+                 tiers_before: Optional[Dict[str, float]] = None, tiers_after: Optional[Dict[str, float]] = None) -> Dict:
+    spans = {name: round(after.get(name, 0.0) - before.get(name, 0.0), 3) for name in after}
+    tier_delta = {key: value - (tiers_before or {}).get(key, 0.0) for key, value in (tiers_after or {}).items()}
+    tiers = {}
+    for tier in sorted({key.split(".", 1)[0] for key in tier_delta}):
+        requests = tier_delta.get(f"{tier}.requests", 0.0)
+        tiers[tier] = {
+            "requests": int(requests),
+            "avg_latency_s": round(tier_delta.get(f"{tier}.seconds", 0.0) / requests, 3) if requests else 0.0,
+            "prompt_tokens": int(tier_delta.get(f"{tier}.prompt_tokens", 0)),
+            "completion_tokens": int(tier_delta.get(f"{tier}.completion_tokens", 0)),
+        }
+
+    def dist(values):
+        return {"p50": round(percentile(values, 50), 3), "p95": round(percentile(values, 95), 3),
+                "p99": round(percentile(values, 99), 3), "max": round(max(values), 3) if values else 0.0}
+
+    return {
+        "config": {"users": args.users, "conversations": args.conversations, "turns": args.turns,
+                   "mode": args.mode, "ttft": args.ttft, "tokens_per_sec": args.tokens_per_sec,
+                   "fast_ttft": args.fast_ttft, "fast_tokens_per_sec": args.fast_tokens_per_sec},
+        "requests": len(results.latencies),
+        "errors": results.errors,
+        "duration_s": round(elapsed, 2),
+        "requests_per_sec": round(len(results.latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_s": dist(results.latencies),
+        "ttft_s": dist(results.ttfts),
+        "latency_by_script_s": {name: dist(values) for name, values in sorted(results.by_script.items())},
+        "server_time_s": spans,
+        "model_tiers": tiers,
+    }
+
+
+def print_report(report: Dict):
+    print("\n==== 压测结果 ====")
+    cfg = report["config"]
+    print(f"用户 {cfg['users']} × 对话 {cfg['conversations']} × 轮次 {cfg['turns']}，模式 {cfg['mode']}，"
+          f"桩模型 TTFT {cfg['ttft']}s / {cfg['tokens_per_sec']} token/s")
+    print(f"请求数 {report['requests']}，耗时 {report['duration_s']}s，吞吐 {report['requests_per_sec']} req/s")
+    if report["errors"]:
+        print(f"错误: {report['errors']}")
+    for title, key in (("端到端延迟", "latency_s"), ("首 token 延迟", "ttft_s")):
+        d = report[key]
+        print(f"{title}: p50 {d['p50']}s  p95 {d['p95']}s  p99 {d['p99']}s  max {d['max']}s")
+    print("按脚本的端到端延迟:")
+    for name, d in report["latency_by_script_s"].items():
+        print(f"  {name:<8} p50 {d['p50']}s  p95 {d['p95']}s  p99 {d['p99']}s")
+    spans = report["server_time_s"]
+    total = sum(v for k, v in spans.items() if k != "llm_ttft") or 1.0
+    print("服务端累计耗时:")
+    for name, value in sorted(spans.items(), key=lambda kv: -kv[1]):
+        share = "" if name == "llm_ttft" else f" ({value / total * 100:.1f}%)"
+        print(f"  {name:<14} {value}s{share}")
+    if report["model_tiers"]:
+        print("按模型层级:")
+        for tier, d in report["model_tiers"].items():
+            print(f"  {tier:<8} 请求 {d['requests']}，平均耗时 {d['avg_latency_s']}s，"
+                  f"输入 {d['prompt_tokens']} / 输出 {d['completion_tokens']} token")
+
+
+# ----------------------------------------------------------------------
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="agent_bench_")
+    prepare_workdir(workdir)
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+        "STUB_TTFT": str(args.ttft),
+        "STUB_TOKENS_PER_SEC": str(args.tokens_per_sec),
+        "STUB_WORKDIR": workdir,
+        "LOGIC_BASE_URL": f"{stub_url}/v1",
+        "LOGIC_API_KEY": "bench",
+        "VISION_API_KEY": "bench",
+        "TOOL_CACHE_DIR": "",
+    })
+    if args.fast_ttft is not None:
+        env.update({
+            "LOGIC_FAST_MODEL": "stub-fast",
+            "STUB_FAST_MODEL": "stub-fast",
+            "STUB_FAST_TTFT": str(args.fast_ttft),
+            "STUB_FAST_TOKENS_PER_SEC": str(args.fast_tokens_per_sec),
+            "CASCADE_THINKING_PERSONAS": args.thinking_personas,
+        })
+    stub = start_process([sys.executable, "-m", "uvicorn", "bench.stub_llm:app", "--port", str(args.stub_port),
+                          "--log-level", "warning"], env, workdir, os.path.join(workdir, "stub.log"))
+    server = start_process([sys.executable, "-m", "uvicorn", "server:app", "--port", str(args.port),
+                            "--log-level", "warning"], env, workdir, os.path.join(workdir, "server.log"))
+    try:
+        await wait_ready(f"{stub_url}/docs")
+        await wait_ready(f"{base_url}/api/metrics")
+        async with httpx.AsyncClient(base_url=base_url) as client:
+            metrics_text = (await client.get("/api/metrics")).text
+            before, tiers_before = parse_span_sums(metrics_text), parse_tier_stats(metrics_text)
+
+            results = Results()
+            start = time.perf_counter()
+            await asyncio.gather(*(simulated_user(u, base_url, args, results) for u in range(args.users)))
+            elapsed = time.perf_counter() - start
+
+            # 会话在回合结束后于后台写回，稍等片刻再读取服务端耗时
+            await asyncio.sleep(1)
+            metrics_text = (await client.get("/api/metrics")).text
+            after, tiers_after = parse_span_sums(metrics_text), parse_tier_stats(metrics_text)
+
+        report = build_report(results, elapsed, before, after, args, tiers_before, tiers_after)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if args.keep:
+            print(f"\n运行目录（含服务日志）: {workdir}")
+        return report
+    finally:
+        for proc in (server, stub):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线压测 Agent 服务（使用桩模型，不访问网络）")
+    parser.add_argument("--users", type=int, default=8, help="并发用户数")
+    parser.add_argument("--conversations", type=int, default=3, help="每个用户的对话数")
+    parser.add_argument("--turns", type=int, default=3, help="每个对话的轮次")
+    parser.add_argument("--mode", choices=["stream", "chat", "mixed"], default="stream",
+                        help="使用 /api/chat/stream、/api/chat 或随机混合")
+    parser.add_argument("--ttft", type=float, default=0.3, help="桩模型首 token 延迟（秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=80, help="桩模型输出速度")
+    parser.add_argument("--fast-ttft", type=float, default=None,
+                        help="启用模型级联，桩模型中快速模型的首 token 延迟（秒）")
+    parser.add_argument("--fast-tokens-per-sec", type=float, default=200, help="桩模型中快速模型的输出速度")
+    parser.add_argument("--thinking-personas", default="",
+                        help="级联中始终使用思考模型的人格 ID（默认为空，压测使用的人格不影响层级选择）")
+    parser.add_argument("--think-time", type=float, default=0.0, help="用户两轮之间的最大思考时间（秒）")
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求超时（秒）")
+    parser.add_argument("--port", type=int, default=8765, help="Agent 服务端口")
+    parser.add_argument("--stub-port", type=int, default=8766, help="桩模型服务端口")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，便于比较不同版本")
+    parser.add_argument("--keep", action="store_true", help="保留临时运行目录（含服务日志）")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+压测用的 OpenAI 兼容桩服务：实现 /v1/chat/completions（流式和非流式），按脚本返回工具调用，
+不访问网络、不产生费用。
+
+用户消息中的 [bench:脚本名] 标记决定本轮对话走哪个脚本；脚本的第几步由最后一条用户消息之后
+已有的 assistant 消息数决定，因此同一个脚本可以驱动 Agent 完成多步工具调用。
+
+环境变量:
+    STUB_TTFT            首 token 延迟（秒），默认 0.3
+    STUB_TOKENS_PER_SEC  输出速度（token/秒），默认 80
+    STUB_ERROR_RATE      以该概率返回 503，用于验证多端点切换和熔断，默认 0
+    STUB_FAST_MODEL      请求该模型名时改用 STUB_FAST_TTFT / STUB_FAST_TOKENS_PER_SEC，模拟级联中的快速模型
+    STUB_WORKDIR         工具调用中使用的文件和数据库所在目录（由 load_test.py 准备）
+
+运行中可以通过 POST /stub/config {"ttft": 2, "tokens_per_sec": 20, "error_rate": 1} 修改速度和错误率（fast_ttft、fast_tokens_per_sec 同理），
+模拟某个端点变慢或故障后再恢复。
+
+用法:
+    python -m uvicorn bench.stub_llm:app --port 9100
+"""
+import os
+import re
+import json
+import time
+import random
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+SETTINGS = {
+    "ttft": float(os.getenv("STUB_TTFT", "0.3")),
+    "tokens_per_sec": float(os.getenv("STUB_TOKENS_PER_SEC", "80")),
+    "error_rate": float(os.getenv("STUB_ERROR_RATE", "0")),
+    "fast_ttft": float(os.getenv("STUB_FAST_TTFT", "0.1")),
+    "fast_tokens_per_sec": float(os.getenv("STUB_FAST_TOKENS_PER_SEC", "200")),
+}
+FAST_MODEL = os.getenv("STUB_FAST_MODEL", "")
+WORKDIR = os.getenv("STUB_WORKDIR", os.getcwd())
+
+_SCRIPT_RE = re.compile(r"\[bench:(\w+)\]")
+
+# 回答正文按"词"流式输出，每个词算一个 token
+ANSWER = ("根据查询结果，本月订单总量较上月增长了百分之十二，其中华东地区贡献最大。"
+          "建议重点关注退款率偏高的两个品类，并在下周复盘库存周转情况。").replace("，", "， ").replace("。", "。 ")
+ANSWER_TOKENS = ANSWER.split(" ") * 4
+
+
+def _call(name, **args):
+    return {"name": name, "arguments": json.dumps(args, ensure_ascii=False)}
+
+
+def _scripts():
+    """脚本名 -> 各步的工具调用列表；最后一步之后返回文字回答。"""
+    db_path = os.path.join(WORKDIR, "bench.db")
+    return {
+        "chat": [],
+        "files": [
+            [_call("list_directory", dir_path=os.path.join(WORKDIR, "docs"))],
+            [_call("read_file", file_path=os.path.join(WORKDIR, "docs", "report.md")),
+             _call("read_file", file_path=os.path.join(WORKDIR, "docs", "notes.txt"))],
+        ],
+        "sql": [
+            [_call("query_sqlite", db_path=db_path, query="SELECT region, COUNT(*), SUM(amount) FROM orders GROUP BY region"),
+             _call("query_sqlite", db_path=db_path, query="SELECT * FROM orders ORDER BY amount DESC LIMIT 20")],
+            [_call("query_sqlite", db_path=db_path, query="SELECT category, AVG(amount) FROM orders GROUP BY category")],
+        ],
+        "python": [
+            [_call("run_python", code="total = sum(i * i for i in range(200000))\nprint(total)")],
+        ],
+    }
+
+
+def _next_step(messages):
+    """返回本次请求应输出的工具调用列表；None 表示输出文字回答。"""
+    last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+    if last_user < 0:
+        return None
+    match = _SCRIPT_RE.search(messages[last_user].get("content") or "")
+    if not match:
+        return None
+    steps = _scripts().get(match.group(1), [])
+    done = sum(1 for m in messages[last_user + 1:] if m.get("role") == "assistant")
+    return steps[done] if done < len(steps) else None
+
+
+def _usage(prompt_messages, completion_tokens):
+    prompt_tokens = sum(len(str(m.get("content") or "")) for m in prompt_messages) // 2
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+app = FastAPI()
+
+
+@app.post("/stub/config")
+async def update_config(request: Request):
+    body = await request.json()
+    SETTINGS.update({key: float(value) for key, value in body.items() if key in SETTINGS})
+    return SETTINGS
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    if random.random() < SETTINGS["error_rate"]:
+        return JSONResponse({"error": {"message": "stub overloaded", "type": "server_error"}}, status_code=503)
+    body = await request.json()
+    messages = body.get("messages", [])
+    calls = _next_step(messages) if body.get("tools") else None
+    model = body.get("model", "stub")
+    if FAST_MODEL and model == FAST_MODEL:
+        ttft, tokens_per_sec = SETTINGS["fast_ttft"], SETTINGS["fast_tokens_per_sec"]
+    else:
+        ttft, tokens_per_sec = SETTINGS["ttft"], SETTINGS["tokens_per_sec"]
+    created = int(time.time())
+
+    if not body.get("stream"):
+        tokens = 20 if calls else len(ANSWER_TOKENS)
+        await asyncio.sleep(ttft + tokens / tokens_per_sec)
+        message = {"role": "assistant", "content": None if calls else "".join(ANSWER_TOKENS)}
+        if calls:
+            message["tool_calls"] = [
+                {"id": f"call_{i}", "type": "function", "function": call} for i, call in enumerate(calls)
+            ]
+        return {
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if calls else "stop"}],
+            "usage": _usage(messages, tokens),
+        }
+
+    def chunk(delta, finish_reason=None):
+        payload = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                   "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async def generate():
+        await asyncio.sleep(ttft)
+        delay = 1 / tokens_per_sec
+        completion_tokens = 0
+        if calls:
+            for i, call in enumerate(calls):
+                yield chunk({"tool_calls": [{"index": i, "id": f"call_{i}", "type": "function",
+                                             "function": {"name": call["name"], "arguments": ""}}]})
+                # 参数按约 4 字符一个 token 分段输出
+                args = call["arguments"]
+                for start in range(0, len(args), 16):
+                    yield chunk({"tool_calls": [{"index": i, "function": {"arguments": args[start:start + 16]}}]})
+                    completion_tokens += 4
+                    await asyncio.sleep(4 * delay)
+            yield chunk({}, "tool_calls")
+        else:
+            for token in ANSWER_TOKENS:
+                yield chunk({"content": token})
+                completion_tokens += 1
+                await asyncio.sleep(delay)
+            yield chunk({}, "stop")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            payload = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                       "choices": [], "usage": _usage(messages, completion_tokens)}
+            yield f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
@@ -13,14 +13,138 @@ class Config:
     LOGIC_API_KEY = os.getenv("LOGIC_API_KEY")
     LOGIC_BASE_URL = os.getenv("LOGIC_BASE_URL", "https://api.bltcy.ai/v1")
     LOGIC_MODEL = os.getenv("LOGIC_MODEL", "gemini-3-flash-preview-thinking-*")
+    # 模型级联（core/model_cascade.py）：简单回复、工具结果总结等使用快速模型，规划和多步任务使用上面的思考模型。
+    # LOGIC_FAST_MODEL 为空时不启用；地址和密钥未配置时与 LOGIC_* 共用，LOGIC_FAST_ENDPOINTS 格式同 LOGIC_ENDPOINTS
+    LOGIC_FAST_MODEL = os.getenv("LOGIC_FAST_MODEL", "")
+    LOGIC_FAST_API_KEY = os.getenv("LOGIC_FAST_API_KEY")
+    LOGIC_FAST_BASE_URL = os.getenv("LOGIC_FAST_BASE_URL")
+    LOGIC_FAST_ENDPOINTS = os.getenv("LOGIC_FAST_ENDPOINTS", "")
+    # 流式请求是否附带 stream_options.include_usage（用于统计前缀缓存命中），接口不支持时设为 False
+    LOGIC_STREAM_USAGE = os.getenv("LOGIC_STREAM_USAGE", "True").lower() == "true"
     
     # 视觉大脑 (Gemini)
     VISION_API_KEY = os.getenv("VISION_API_KEY")
     VISION_BASE_URL = os.getenv("VISION_BASE_URL", "https://api.bltcy.ai/v1")
     VISION_MODEL = os.getenv("VISION_MODEL", "gemini-3-pro-preview")
 
+    # 模型请求传输层（core/model_transport.py）：连接池、超时、重试与对冲
+    MODEL_CONNECT_TIMEOUT = float(os.getenv("MODEL_CONNECT_TIMEOUT", "10"))
+    # 读取超时：两次收到数据之间的最长间隔（流式请求即相邻 chunk 之间）
+    MODEL_READ_TIMEOUT = float(os.getenv("MODEL_READ_TIMEOUT", "120"))
+    # 流式请求等待第一个 chunk 的最长时间，超时按可重试错误处理
+    MODEL_FIRST_TOKEN_TIMEOUT = float(os.getenv("MODEL_FIRST_TOKEN_TIMEOUT", "60"))
+    MODEL_POOL_MAX_CONNECTIONS = int(os.getenv("MODEL_POOL_MAX_CONNECTIONS", "20"))
+    MODEL_POOL_KEEPALIVE = float(os.getenv("MODEL_POOL_KEEPALIVE", "30"))
+    # 限流、5xx、连接错误的最大重试次数，以及指数退避的基数和上限（秒）
+    MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "3"))
+    MODEL_BACKOFF_BASE = float(os.getenv("MODEL_BACKOFF_BASE", "0.5"))
+    MODEL_BACKOFF_MAX = float(os.getenv("MODEL_BACKOFF_MAX", "8"))
+    # 对冲请求：首 token 等待超过近期 TTFT 的该分位数时并行发起第二次请求（会增加少量调用量，默认关闭）
+    MODEL_HEDGE_ENABLED = os.getenv("MODEL_HEDGE_ENABLED", "False").lower() == "true"
+    MODEL_HEDGE_PERCENTILE = float(os.getenv("MODEL_HEDGE_PERCENTILE", "0.95"))
+    # 积累多少个 TTFT 样本后才启用对冲，以及对冲前的最短等待（秒）
+    MODEL_HEDGE_MIN_SAMPLES = int(os.getenv("MODEL_HEDGE_MIN_SAMPLES", "20"))
+    MODEL_HEDGE_MIN_DELAY = float(os.getenv("MODEL_HEDGE_MIN_DELAY", "1.0"))
+
+    # 多端点路由（core/llm_client.py 的 ModelRouter）：分号分隔的多个端点，每个为 "base_url|model|weight|api_key"，
+    # 后三项可省略（默认使用对应的 *_MODEL、权重 1 和 *_API_KEY）。留空时只使用 *_BASE_URL 一个端点
+    LOGIC_ENDPOINTS = os.getenv("LOGIC_ENDPOINTS", "")
+    VISION_ENDPOINTS = os.getenv("VISION_ENDPOINTS", "")
+    # 熔断：连续失败次数或最近请求的错误率达到阈值时熔断，冷却（秒）后放行一次试探请求
+    MODEL_CIRCUIT_FAILURES = int(os.getenv("MODEL_CIRCUIT_FAILURES", "3"))
+    MODEL_CIRCUIT_ERROR_RATE = float(os.getenv("MODEL_CIRCUIT_ERROR_RATE", "0.5"))
+    MODEL_CIRCUIT_COOLDOWN = float(os.getenv("MODEL_CIRCUIT_COOLDOWN", "30"))
+    # 有多个端点时每个端点自身的重试次数，之后切换到下一个端点
+    MODEL_ROUTER_RETRIES_PER_ENDPOINT = int(os.getenv("MODEL_ROUTER_RETRIES_PER_ENDPOINT", "1"))
+    # 客户端限流（core/rate_limiter.py）：按端点（base_url）限制每分钟请求数和 token 数，额度不足时排队等待。
+    # MODEL_RATE_LIMITS 为分号分隔的 "base_url|rpm|tpm"，未列出的端点使用 MODEL_RPM / MODEL_TPM，0 表示不限制
+    MODEL_RATE_LIMITS = os.getenv("MODEL_RATE_LIMITS", "")
+    MODEL_RPM = float(os.getenv("MODEL_RPM", "0"))
+    MODEL_TPM = float(os.getenv("MODEL_TPM", "0"))
+    # 最多积累多少秒的额度用于突发请求
+    MODEL_RATE_LIMIT_BURST_SECONDS = float(os.getenv("MODEL_RATE_LIMIT_BURST_SECONDS", "10"))
+    # 预估 TPM 占用时每个请求的输出 token 数，响应返回后按实际用量修正
+    MODEL_RATE_LIMIT_COMPLETION_TOKENS = int(os.getenv("MODEL_RATE_LIMIT_COMPLETION_TOKENS", "512"))
+    # 后台请求（摘要）排队时按晚到该秒数排序，让位于用户对话
+    MODEL_RATE_LIMIT_BACKGROUND_DELAY = float(os.getenv("MODEL_RATE_LIMIT_BACKGROUND_DELAY", "10"))
+
+    # 模型级联的升级规则：以下情况改用思考模型
+    # - 用户消息超过 CASCADE_FAST_MAX_CHARS 字符，或本轮提供的工具包含 CASCADE_THINKING_TOOLS（SQL、代码等需要规划的工具）
+    # - 当前人格在 CASCADE_THINKING_PERSONAS 中（整次运行都使用思考模型）
+    # - 本次运行的工具调用累计达到 CASCADE_ESCALATE_TOOL_CALLS 次，或有工具调用失败（之后的步骤都使用思考模型）
+    CASCADE_FAST_MAX_CHARS = int(os.getenv("CASCADE_FAST_MAX_CHARS", "120"))
+    CASCADE_THINKING_TOOLS = os.getenv("CASCADE_THINKING_TOOLS", "query_sqlite,query_mysql,run_python,generate_document,generate_mindmap")
+    CASCADE_THINKING_PERSONAS = os.getenv("CASCADE_THINKING_PERSONAS", "work_mode")
+    CASCADE_ESCALATE_TOOL_CALLS = int(os.getenv("CASCADE_ESCALATE_TOOL_CALLS", "3"))
+
     # Agent 设置
     AGENT_NAME = "Personal Assistant"
+    # 阻塞型工具在线程池中执行，此处限制线程池大小
+    TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", "8"))
+    # 同一轮中最多并行执行的工具调用数
+    TOOL_MAX_PARALLEL = int(os.getenv("TOOL_MAX_PARALLEL", "4"))
+    # 同时运行的 Agent 循环数上限，超出的请求进入等待队列
+    AGENT_MAX_CONCURRENT = int(os.getenv("AGENT_MAX_CONCURRENT", "4"))
+    # 等待队列长度上限，队列已满时返回 429
+    AGENT_MAX_QUEUE = int(os.getenv("AGENT_MAX_QUEUE", "32"))
+    # 流式输出时，参数已完整的只读工具调用不等本轮输出结束即提前执行
+    TOOL_SPECULATIVE_ENABLED = os.getenv("TOOL_SPECULATIVE_ENABLED", "True").lower() == "true"
+    # 一次运行中相同的只读工具调用直接返回之前的结果；重复次数达到上限时提前结束运行（0 表示不限制）
+    TOOL_REPEAT_LIMIT = int(os.getenv("TOOL_REPEAT_LIMIT", "3"))
+    # 按请求挑选发送给模型的工具定义（关键词规则 + 描述相似度 + 会话中用过的工具），关闭时每次发送全部工具
+    TOOL_ROUTER_ENABLED = os.getenv("TOOL_ROUTER_ENABLED", "True").lower() == "true"
+    # 按描述相似度最多选入的工具数，以及最低相似度
+    TOOL_ROUTER_TOP_K = int(os.getenv("TOOL_ROUTER_TOP_K", "3"))
+    TOOL_ROUTER_MIN_SCORE = float(os.getenv("TOOL_ROUTER_MIN_SCORE", "0.15"))
+    # 始终发送的工具（逗号分隔）
+    TOOL_ROUTER_ALWAYS = os.getenv("TOOL_ROUTER_ALWAYS", "")
+    # 幂等工具（网页、天气、读文件、只读 SQL 等）的结果缓存
+    TOOL_CACHE_ENABLED = os.getenv("TOOL_CACHE_ENABLED", "True").lower() == "true"
+    TOOL_CACHE_MAX_ENTRIES = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "512"))
+    TOOL_CACHE_MAX_BYTES = int(os.getenv("TOOL_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+    # 磁盘缓存目录，为空（默认）时只使用内存缓存；数据库查询结果始终只缓存在内存中
+    TOOL_CACHE_DIR = os.getenv("TOOL_CACHE_DIR", "")
+    TOOL_CACHE_DISK_MAX_ENTRIES = int(os.getenv("TOOL_CACHE_DISK_MAX_ENTRIES", "5000"))
+
+    # 模型响应的精确匹配缓存（core/llm_cache.py），只对 LLM_CACHE_PERSONAS 中的人格生效（逗号分隔，"*" 为全部，为空时不启用）
+    LLM_CACHE_PERSONAS = os.getenv("LLM_CACHE_PERSONAS", "")
+    LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "data/llm_cache")
+    LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+    # 条目有效期（秒），0 表示不过期
+    LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+
+    # 超过 TOOL_RESULT_INLINE_CHARS 的工具结果全文存档，会话中只保留预览和句柄，模型用 read_result 按需读取
+    TOOL_RESULT_DIR = os.getenv("TOOL_RESULT_DIR", "data/tool_results")
+    TOOL_RESULT_INLINE_CHARS = int(os.getenv("TOOL_RESULT_INLINE_CHARS", "2000"))
+    # read_result 每次返回的最大字符数
+    TOOL_RESULT_PAGE_CHARS = int(os.getenv("TOOL_RESULT_PAGE_CHARS", "4000"))
+    # 单个存档结果的最大字节数
+    TOOL_RESULT_MAX_BYTES = int(os.getenv("TOOL_RESULT_MAX_BYTES", str(16 * 1024 * 1024)))
+
+    # 每次请求中 system 提示词 + 历史消息的 token 预算，历史消息从新到旧装入
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "16000"))
+    # 滑出窗口的早期消息折叠为滚动摘要（回合结束后在后台生成）
+    CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "True").lower() == "true"
+    # 待折叠的消息达到多少 token 才生成一次摘要
+    CONTEXT_SUMMARY_MIN_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MIN_TOKENS", "2000"))
+    # 每次调用模型折叠的最大消息 token 数（旧会话首次折叠时分块进行）
+    CONTEXT_SUMMARY_CHUNK_TOKENS = int(os.getenv("CONTEXT_SUMMARY_CHUNK_TOKENS", "8000"))
+    # 摘要的最大字数
+    CONTEXT_SUMMARY_MAX_CHARS = int(os.getenv("CONTEXT_SUMMARY_MAX_CHARS", "800"))
+
+    # 会话存储
+    # 存储后端: sqlite（默认）、jsonl（追加式日志）或 json（每个会话一个完整 JSON 文件）
+    SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+    # 内存中的会话每隔多少秒批量写回磁盘（0 表示只在回合结束时写回）
+    SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))
+    # 内存中最多保留的会话数（只淘汰已写回的会话）
+    SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "64"))
+
+    # 可观测性：/api/metrics 始终可用；以下开关控制逐条打印 span 和默认返回耗时汇总
+    TRACE_LOG_SPANS = os.getenv("TRACE_LOG_SPANS", "False").lower() == "true"
+    # 流式响应结束时附带 {"type": "meta", "timing": {...}} 事件（请求中的 timing 字段优先）
+    TRACE_TIMING_EVENT = os.getenv("TRACE_TIMING_EVENT", "False").lower() == "true"
     DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 
     @staticmethod
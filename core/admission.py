@@ -0,0 +1,153 @@
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+from config import Config
+from core.metrics import registry
+
+QUEUE_WAIT_SECONDS = registry.histogram(
+    "agent_queue_wait_seconds", "Time requests spent waiting for an agent slot.",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+QUEUE_DEPTH = registry.gauge("agent_queue_depth", "Requests waiting for an agent slot.")
+RUNNING_AGENTS = registry.gauge("agent_running", "Agent loops currently running.")
+REJECTED_REQUESTS = registry.counter("agent_rejected_total", "Requests rejected because the wait queue was full.")
+
+
+class QueueFullError(Exception):
+    """等待队列已满。retry_after 为建议的重试间隔（秒），对应 HTTP 429 的 Retry-After。"""
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server is busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """一个请求在准入控制器中的凭证：排队中或已获得运行名额。"""
+    def __init__(self, key: str):
+        self.key = key
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self._granted = asyncio.get_running_loop().create_future()
+
+    @property
+    def granted(self) -> bool:
+        return self._granted.done() and not self._granted.cancelled()
+
+
+class AdmissionController:
+    """
+    Agent 循环的准入控制。
+
+    同时运行的 Agent 循环不超过 max_running，其余请求进入有界等待队列；队列满时
+    enqueue 抛出 QueueFullError。等待中的请求按 key（会话或客户端）分组轮转出队：
+    同一个 key 连续提交的多个请求不会挤占其他用户的名额。
+    只在事件循环线程中使用，不需要加锁。
+    """
+    # 估算 Retry-After 时，平均运行时长的平滑系数
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, max_running: Optional[int] = None, max_queue: Optional[int] = None):
+        self.max_running = max_running or Config.AGENT_MAX_CONCURRENT
+        self.max_queue = Config.AGENT_MAX_QUEUE if max_queue is None else max_queue
+        self.running = 0
+        # key -> 该 key 的等待队列；OrderedDict 的顺序即轮转顺序
+        self._queues: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self._waiting = 0
+        # 单次运行时长的滑动平均（秒），用于估算 Retry-After
+        self._avg_run_seconds = 10.0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def _update_gauges(self):
+        QUEUE_DEPTH.set(self._waiting)
+        RUNNING_AGENTS.set(self.running)
+
+    def retry_after(self) -> int:
+        """按平均运行时长估算队列中的请求全部开始运行所需的时间。"""
+        rounds = (self._waiting + 1) / self.max_running
+        return max(1, math.ceil(rounds * self._avg_run_seconds))
+
+    def enqueue(self, key: str) -> Ticket:
+        """
+        申请运行名额。有空闲名额时立即获得，否则排队。
+
+        :raises QueueFullError: 等待队列已满
+        """
+        ticket = Ticket(key)
+        if self.running < self.max_running and not self._waiting:
+            self._grant(ticket)
+            return ticket
+        if self._waiting >= self.max_queue:
+            REJECTED_REQUESTS.inc()
+            raise QueueFullError(self.retry_after())
+        self._queues.setdefault(key, deque()).append(ticket)
+        self._waiting += 1
+        self._update_gauges()
+        return ticket
+
+    def _grant(self, ticket: Ticket):
+        self.running += 1
+        ticket.started_at = time.monotonic()
+        QUEUE_WAIT_SECONDS.observe(ticket.started_at - ticket.enqueued_at)
+        ticket._granted.set_result(True)
+        self._update_gauges()
+
+    def _dispatch(self):
+        """把空闲名额按轮转顺序分配给各 key 队首的请求。"""
+        while self.running < self.max_running and self._queues:
+            key, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            self._waiting -= 1
+            if queue:
+                # 该 key 还有请求，移到轮转末尾
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            self._grant(ticket)
+
+    def position(self, ticket: Ticket) -> int:
+        """排队位置（从 1 开始），即按轮转顺序还有几个请求会先于它开始运行；已获得名额时为 0。"""
+        if ticket.granted:
+            return 0
+        queue = self._queues.get(ticket.key)
+        if not queue or ticket not in queue:
+            return 0
+        rank = queue.index(ticket)
+        keys = list(self._queues)
+        own = keys.index(ticket.key)
+        ahead = 0
+        for i, other in enumerate(keys):
+            # 前 rank 轮中每个 key 各出一个；第 rank 轮中排在它前面的 key 再出一个
+            ahead += min(len(self._queues[other]), rank + (1 if i < own else 0))
+        return ahead + 1
+
+    async def wait(self, ticket: Ticket, timeout: Optional[float] = None) -> bool:
+        """等待获得名额，返回是否已获得（超时返回 False，仍在排队）。"""
+        if ticket.granted:
+            return True
+        done, _ = await asyncio.wait({ticket._granted}, timeout=timeout)
+        return bool(done)
+
+    def release(self, ticket: Ticket):
+        """运行结束或放弃排队（例如客户端断开）时调用，重复调用是安全的。"""
+        if ticket.granted:
+            if ticket.started_at is None:
+                return
+            elapsed = time.monotonic() - ticket.started_at
+            self._avg_run_seconds += self.EWMA_ALPHA * (elapsed - self._avg_run_seconds)
+            ticket.started_at = None
+            self.running -= 1
+        else:
+            queue = self._queues.get(ticket.key)
+            if queue and ticket in queue:
+                queue.remove(ticket)
+                self._waiting -= 1
+                if not queue:
+                    del self._queues[ticket.key]
+            if not ticket._granted.done():
+                ticket._granted.cancel()
+        self._dispatch()
+        self._update_gauges()
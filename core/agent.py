@@ -1,125 +1,458 @@
+import os
 import json
+import asyncio
 import datetime
-from core.llm_client import LLMClient
+import functools
+from core.llm_client import AsyncLLMClient
+from core.model_cascade import ModelCascade, FAST
+from core.llm_cache import llm_cache
 from core.vision_client import VisionClient
 from core.plato_client import PlatoClient
 from core.session_manager import SessionManager
 from core.persona_manager import PersonaManager
-from core.tools import TOOLS_SCHEMA, AVAILABLE_TOOLS
+from core.tools import AVAILABLE_TOOLS
+from core.tool_router import tool_router
+from core.result_store import result_store, set_result_session
+from core.tool_executor import run_blocking, run_tool, tool_scheduler, is_speculative, RunMemo
+from core.context_builder import ContextBuilder, TOKENS_KEY, count_message_tokens
+from core.summarizer import ConversationSummarizer
+from core.metrics import span, timed, start_trace, current_trace
+from core.cancellation import CANCELLED_MARKER, set_cancel_token, current_cancel_token
+from config import Config
+
+# 重复调用达到上限、提前结束运行时回复给用户的内容
+REPEAT_STOP_MESSAGE = "检测到重复执行相同的工具调用，已提前结束本次任务。可以补充更具体的要求后继续。"
+
+# 受 file_config 权限约束的文件类工具
+FILE_TOOLS = ["read_file", "list_directory", "write_file", "search_files"]
 
 class PersonalAgent:
     def __init__(self):
-        self.llm = LLMClient()
+        self.llm = AsyncLLMClient()
+        # 模型级联：简单步骤使用快速模型，未配置 LOGIC_FAST_MODEL 时全部使用 self.llm
+        self.cascade = ModelCascade(self.llm, AsyncLLMClient("fast"))
         self.vision = VisionClient()
         self.plato = PlatoClient()
         self.session_manager = SessionManager()
         self.persona_manager = PersonaManager()
+        self.context_builder = ContextBuilder()
+        self.summarizer = ConversationSummarizer(self.cascade.client(FAST), self.session_manager, self.context_builder)
+        # 回合结束后在后台运行的任务（摘要等），保留引用避免被垃圾回收
+        self._background_tasks = set()
         # self.history 已被移除，改为使用 session_manager
 
+    # ------------------------------------------------------------------
+    # 同步入口（main.py 等非异步调用方使用），内部驱动异步引擎
+    # ------------------------------------------------------------------
+
     def process_message(self, message, session_id=None):
         """
         处理来自 Plato 或 Web 的传入消息（字典）。
         预期结构: {"chat_id": "...", "text": "...", "image": "..."}
-        
+
+        同步包装，内部运行 aprocess_message。在事件循环中请直接 await aprocess_message。
+
         :param message: 消息字典
         :param session_id: 可选的会话 ID。如果未提供，则创建一个新的或使用默认值。
         :return: 响应文本
         """
-        # 为了兼容性保留此方法，但在内部我们可以调用流式处理并聚合结果
-        # 或者为了稳定性暂时保留原样。鉴于这是一个演示项目，
-        # 我们保留原样以避免破坏现有逻辑，而在下方添加新的流式方法。
-        # (此处代码与之前相同，略去修改)
+        async def run():
+            result = await self.aprocess_message(message, session_id=session_id)
+            await self._drain_background_tasks()
+            return result
+        return asyncio.run(run())
+
+    def process_message_stream(self, message, session_id=None):
+        """
+        process_message_stream 的同步包装，在独立事件循环中逐个取出 aprocess_message_stream 的事件。
+        """
+        loop = asyncio.new_event_loop()
+        agen = self.aprocess_message_stream(message, session_id=session_id)
+        try:
+            while True:
+                try:
+                    event = loop.run_until_complete(agen.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield event
+        finally:
+            loop.run_until_complete(agen.aclose())
+            loop.run_until_complete(self._drain_background_tasks())
+            loop.close()
+
+    async def _drain_background_tasks(self):
+        """同步包装使用临时事件循环，返回前等待本循环中的后台任务完成，否则它们会随循环关闭被丢弃。"""
+        loop = asyncio.get_running_loop()
+        tasks = [t for t in self._background_tasks if t.get_loop() is loop]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # ------------------------------------------------------------------
+    # 两个循环共用的辅助方法
+    # ------------------------------------------------------------------
+
+    def _build_system_prompt(self):
+        """
+        稳定的 system 提示词（人格 + 核心指令）。
+
+        内容在多次请求之间逐字节不变，服务商可以缓存这段前缀；
+        时间、数据库配置等每次请求都可能变化的内容放在 _build_request_context 中。
+        """
+        active_persona = self.persona_manager.get_active_persona()
+        base_system = active_persona["system_prompt"] if active_persona else "你是一个智能个人助手。"
+
+        system_content = f"{base_system}\n\n[核心指令]\n1. 收到复杂需求时，必须先输出【执行计划】，再调用工具。\n2. 能够感知当前时间，对于时间敏感的查询（如新闻、热搜），请使用当前日期进行搜索。当前时间见用户消息末尾的 [请求上下文]。"
+
+        return {"role": "system", "content": system_content}
+
+    def _build_request_context(self, db_config):
+        """每次请求变化的上下文，附加在本轮用户消息之后，不影响前面可缓存的前缀。"""
+        current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        context = f"[请求上下文]\n当前时间：{current_time_str}"
+
+        if db_config:
+            context += f"\n\n[MySQL配置信息]\nHost: {db_config.get('host')}\nPort: {db_config.get('port')}\nUser: {db_config.get('user')}\nPassword: {db_config.get('password')}\nDatabase: {db_config.get('database')}\n\n注意：上述配置是基础连接信息。\n1. 如果用户查询的是当前配置的数据库，直接使用上述所有参数。\n2. 如果用户查询的是**其他数据库**（例如 'test10'），请**保持 Host, Port, User, Password 不变**，仅将 'database' 参数修改为目标数据库名（例如 'test10'）。\n3. **严禁**为了查找数据库配置而浏览本地文件（如 list_directory, read_file），除非用户明确要求查看配置文件。直接尝试使用上述凭证连接。"
+
+        return context
+
+    async def _build_messages(self, session, db_config):
+        """
+        将会话消息转换为 LLM 格式，并在 token 预算内截取最近的上下文。
+        新计算出的 token 数和窗口起点先收集起来，组装完成后在线程池中一次性保存到会话。
+        """
+        session_id = session.get("id")
+        counts = {}
+        window = {}
+
+        def cache_tokens(seq, tokens):
+            counts[seq] = {TOKENS_KEY: tokens}
+
+        def save_window(start):
+            window["context_start"] = start
+
+        messages = self.context_builder.build(
+            session,
+            self._build_system_prompt(),
+            request_context=self._build_request_context(db_config),
+            on_count=cache_tokens,
+            on_window=save_window
+        )
+        if session_id and (counts or window):
+            await run_blocking(self._save_context_stats, session_id, counts, window)
+        return messages
+
+    def _save_context_stats(self, session_id, counts, window):
+        if counts:
+            self.session_manager.update_messages(session_id, counts)
+        if window:
+            self.session_manager.update_session(session_id, **window)
+
+    def _check_file_permission(self, func_name, func_args, file_config):
+        """检查文件类工具是否被 file_config 允许。允许时返回空字符串，否则返回错误信息。"""
+        if not file_config or func_name not in FILE_TOOLS:
+            return ""
+
+        allow_read = file_config.get("allow_read", True)
+        allowed_paths = file_config.get("allowed_paths", [])
+
+        target_path = func_args.get("file_path") or func_args.get("dir_path") or func_args.get("root_dir")
+
+        if not allow_read:
+            return f"Error: File access is disabled by user settings. Cannot execute '{func_name}'."
+        if allowed_paths and target_path:
+            target_abs = os.path.abspath(target_path)
+            for p in allowed_paths:
+                allowed_abs = os.path.abspath(p)
+                if target_abs.startswith(allowed_abs):
+                    return ""
+            return f"Error: Access to path '{target_path}' is denied. Allowed paths: {allowed_paths}"
+        return ""
+
+    async def _execute_tool_call(self, func_name, args_str, file_config, on_progress=None, memo=None):
+        """
+        解析参数、检查权限并执行一次工具调用。
+
+        :param on_progress: 支持流式输出的工具执行期间以 on_progress(chunk) 回调输出片段
+        :param memo: 本次运行的 RunMemo，相同的只读调用直接返回之前的结果
+
+        :return: (tool_result, parse_error)，parse_error 为 None 表示参数解析成功
+        """
+        try:
+            func_args = json.loads(args_str) if args_str else {}
+        except json.JSONDecodeError:
+            parse_error = f"Failed to parse arguments for {func_name}"
+            return f"Error: {parse_error}", parse_error
+
+        print(f"Executing tool: {func_name} with args: {func_args}")
+
+        error_msg = self._check_file_permission(func_name, func_args, file_config)
+        if error_msg:
+            return error_msg, None
+
+        if func_name not in AVAILABLE_TOOLS:
+            return f"Error: Tool '{func_name}' not found.", None
+
+        cancel_token = current_cancel_token()
+        if cancel_token is not None and cancel_token.cancelled:
+            return f"{CANCELLED_MARKER} 请求已取消，工具未执行。", None
+
+        if memo is None or not isinstance(func_args, dict):
+            return await self._run_tool(func_name, func_args, on_progress), None
+
+        previous = memo.lookup(func_name, func_args)
+        if previous is not None:
+            previous_result = await previous
+            if previous_result is not None:
+                print(f"Repeated tool call: {func_name}, returning the earlier result")
+                memo.record_repeat(func_name)
+                return self._repeat_result(func_name, previous_result), None
+
+        entry = memo.begin(func_name, func_args)
+        tool_result = None
+        try:
+            tool_result = await self._run_tool(func_name, func_args, on_progress)
+        finally:
+            if entry is None:
+                # 写操作结束后再清空一次，期间开始的读调用的结果也不保留
+                memo.invalidate()
+            else:
+                memo.finish(entry, tool_result)
+        return tool_result, None
+
+    @staticmethod
+    async def _run_tool(func_name, func_args, on_progress):
+        try:
+            with span("tool", tool=func_name):
+                return await run_tool(func_name, func_args, on_progress=on_progress)
+        except Exception as e:
+            return f"Error executing tool: {str(e)}"
+
+    @staticmethod
+    def _too_many_repeats(memo):
+        """本次运行中的重复调用次数达到 TOOL_REPEAT_LIMIT 时提前结束，不再消耗剩余步数。"""
+        if Config.TOOL_REPEAT_LIMIT > 0 and memo.repeats >= Config.TOOL_REPEAT_LIMIT:
+            print(f"Stopping run after {memo.repeats} repeated tool calls")
+            return True
+        return False
+
+    @staticmethod
+    def _repeat_result(func_name, result):
+        """重复调用的返回内容：带重复标记；结果较长时不再重复发送，只引用之前的结果。"""
+        note = f"[重复调用] 本次任务中已用相同参数调用过 {func_name}，期间没有写操作，结果不会变化。请直接使用已有结果，不要再次调用。"
+        if len(result) > result_store.inline_chars:
+            return note + "\n结果与之前该调用的返回内容相同。"
+        return f"{note}\n{result}"
+
+    def _speculate(self, current_tool_calls, speculative, file_config, memo=None):
+        """
+        推测执行：流式输出中，某个调用之后已出现下一个调用时，它的参数已经完整，
+        若为只读工具则立即开始执行，结果留到本轮输出结束后再使用。
+        按原顺序检查，遇到不能提前执行的调用即停止，保证读操作不会越过它前面的写操作。
+
+        :return: 本次新开始执行的调用下标
+        """
+        started = []
+        last = max(current_tool_calls)
+        for idx in sorted(current_tool_calls):
+            if idx >= last or len(speculative) >= Config.TOOL_MAX_PARALLEL:
+                break
+            if idx in speculative:
+                continue
+            function = current_tool_calls[idx]["function"]
+            try:
+                func_args = json.loads(function["arguments"]) if function["arguments"] else {}
+            except json.JSONDecodeError:
+                break
+            if not isinstance(func_args, dict) or not is_speculative(function["name"], func_args):
+                break
+            print(f"Speculatively executing tool: {function['name']}")
+            speculative[idx] = asyncio.create_task(tool_scheduler.run_one(
+                (function["name"], function["arguments"], file_config),
+                functools.partial(self._execute_tool_call, memo=memo)
+            ))
+            started.append(idx)
+        return started
+
+    async def _run_tool_calls(self, tool_calls, file_config, speculative=None, progress=False, memo=None):
+        """
+        并发执行一轮中的全部工具调用，按完成顺序产出 (kind, index, value)。
+        kind 为 "start"、"progress" 或 "result"；result 的 value 为 (tool_result, parse_error)，
+        progress 的 value 为工具的一段输出（仅 progress=True 时产出）。
+
+        :param speculative: {index: task}，流式输出期间已提前开始执行的调用，直接等待其结果
+        """
+        speculative = speculative or {}
+
+        async def execute(func_name, args_str, file_config, index, on_progress=None):
+            if index in speculative:
+                return await speculative.pop(index)
+            return await self._execute_tool_call(func_name, args_str, file_config, on_progress=on_progress, memo=memo)
+
+        calls = [(tc["function"]["name"], tc["function"]["arguments"], file_config, i) for i, tc in enumerate(tool_calls)]
+        async for kind, index, value in tool_scheduler.run(calls, execute, with_progress=progress):
+            if kind == "result" and isinstance(value, Exception):
+                value = (f"Error executing tool: {str(value)}", None)
+            yield kind, index, value
+
+    async def _record_tool_results(self, session_id, tool_calls, results, messages):
+        """按模型给出的原始顺序，把工具结果写入会话和本轮消息列表。"""
+        for tc, (tool_result, _) in zip(tool_calls, results):
+            func_name = tc["function"]["name"]
+            # 超长结果全文存档，历史中只保留预览和句柄
+            tool_result_truncated = await self._archive_tool_result(session_id, func_name, tool_result)
+
+            await self._add_message(
+                session_id,
+                "tool",
+                tool_result_truncated,
+                tool_call_id=tc["id"],
+                name=func_name
+            )
+
+            messages.append({
+                "role": "tool",
+                "content": tool_result_truncated,
+                "tool_call_id": tc["id"],
+                "name": func_name
+            })
+
+    async def _persist_cancelled(self, session_id, partial_content, pending_calls=None, results=None):
+        """
+        请求被取消时写入会话：尚未完成的工具调用补上"已取消"的结果，保证历史中调用和结果成对，
+        再追加一条带 cancelled 标记的助手消息（包含已输出的部分内容）。
+        """
+        if pending_calls:
+            cancelled_result = (f"{CANCELLED_MARKER} 请求已取消，工具调用未完成。", None)
+            await self._record_tool_results(
+                session_id, pending_calls, [r or cancelled_result for r in results], []
+            )
+            partial_content = ""
+        content = f"{partial_content}\n\n{CANCELLED_MARKER}" if partial_content else CANCELLED_MARKER
+        await self._add_message(session_id, "assistant", content, cancelled=True)
+
+    @staticmethod
+    async def _archive_tool_result(session_id, func_name, tool_result):
+        if func_name == "read_result" or len(tool_result) <= result_store.inline_chars:
+            # read_result 的输出已按页限制长度
+            return tool_result
+        return await run_blocking(result_store.archive, session_id, func_name, tool_result)
+
+    async def _tool_schemas(self, tools, session_id):
+        """
+        本次请求发送的工具定义；会话中已有存档结果时附带 read_result。
+        工具列表有追加时保存到会话头，之后的回合以同样的顺序继续提供，保持前缀缓存。
+        """
+        if result_store.has_results(session_id):
+            tools.include("read_result")
+        schemas = tools.schemas()
+        if tools.changed:
+            tools.changed = False
+            await run_blocking(self.session_manager.update_session, session_id, offered_tools=list(tools.order))
+        return schemas
+
+    async def _add_message(self, session_id, role, content, **kwargs):
+        # 写入时计算一次 token 数并随消息保存，组装上下文时不再重复计算
+        kwargs.setdefault(TOKENS_KEY, count_message_tokens({"role": role, "content": content, **kwargs}))
+        # 只修改内存工作集并追加 journal，完整写回在回合结束时进行；journal 写入放到线程池，不阻塞事件循环
+        return await run_blocking(self.session_manager.add_message, session_id, role, content, **kwargs)
+
+    async def _start_turn(self, message, session_id):
+        """确保会话存在并已加载到内存工作集，返回会话 ID。"""
+        with span("session_load"):
+            if not session_id:
+                user_text = message.get("text", "")
+                session = await run_blocking(self.session_manager.create_session, title=user_text[:20])
+                session_id = session["id"]
+            else:
+                # 首次访问时从磁盘加载，放到线程池中执行
+                await run_blocking(self.session_manager.get_session, session_id)
+        trace = current_trace()
+        if trace is not None:
+            trace.session_id = session_id
+        set_result_session(session_id)
+        return session_id
+
+    @staticmethod
+    def _wants_timing(message):
+        """是否在响应中附带耗时汇总：请求中的 timing 字段优先，未指定时使用 TRACE_TIMING_EVENT。"""
+        timing = message.get("timing")
+        return Config.TRACE_TIMING_EVENT if timing is None else bool(timing)
+
+    def _end_turn(self, session_id):
+        """回合结束，在后台把本轮消息批量写回磁盘并更新滚动摘要，不阻塞响应。"""
+        self._spawn_background(self._save_session(session_id))
+        if Config.CONTEXT_SUMMARY_ENABLED:
+            self._spawn_background(self.summarizer.update(session_id))
+
+    def _spawn_background(self, coro):
+        # 任务复制当前上下文，其中的 span 仍记录到本次请求的 Trace
+        task = asyncio.get_running_loop().create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _save_session(self, session_id):
+        try:
+            await run_blocking(timed("session_save", self.session_manager.flush), session_id)
+        except Exception as e:
+            print(f"写回会话出错 {session_id}: {e}")
+
+    # ------------------------------------------------------------------
+    # 异步引擎
+    # ------------------------------------------------------------------
+
+    async def aprocess_message(self, message, session_id=None):
+        """
+        process_message 的异步版本（非流式）。
+
+        :param message: 消息字典
+        :param session_id: 可选的会话 ID
+        :return: {"response": ..., "session_id": ..., "finish_reason": ...}
+        """
         chat_id = message.get("chat_id")
         user_text = message.get("text", "")
         image_url = message.get("image")
         db_config = message.get("db_config")
         file_config = message.get("file_config")
 
+        start_trace(session_id)
         # 确保会话存在
-        if not session_id:
-             session = self.session_manager.create_session(title=user_text[:20])
-             session_id = session["id"]
+        session_id = await self._start_turn(message, session_id)
 
         response_text = ""
 
         # 1. 视觉大脑
         if image_url:
             print(f"Processing image from {chat_id}...")
-            vision_desc = self.vision.analyze_image(image_url)
+            with span("vision"):
+                vision_desc = await run_blocking(self.vision.analyze_image, image_url)
             user_text += f"\n[System Note: User uploaded an image. Description: {vision_desc}]"
 
         # 2. 通过 Session Manager 更新历史记录
-        self.session_manager.add_message(session_id, "user", user_text)
+        session = await self._add_message(session_id, "user", user_text)
 
         # 3. 逻辑大脑
         print(f"Thinking for {chat_id} in session {session_id}...")
-        
-        # 从会话中获取历史记录
-        session = self.session_manager.get_session(session_id)
-        
-        # 将会话消息转换为 LLM 格式
-        history_messages = []
-        for m in session.get("messages", []):
-            msg = {"role": m["role"], "content": m["content"]}
-            if "tool_calls" in m:
-                msg["tool_calls"] = m["tool_calls"]
-            if "tool_call_id" in m:
-                msg["tool_call_id"] = m["tool_call_id"]
-            if "name" in m:
-                msg["name"] = m["name"]
-            history_messages.append(msg)
-        
-        # 构建 LLM 消息
-        active_persona = self.persona_manager.get_active_persona()
-        base_system = active_persona["system_prompt"] if active_persona else "你是一个智能个人助手。"
-        
-        current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        system_content = f"当前时间：{current_time_str}\n{base_system}\n\n[核心指令]\n1. 收到复杂需求时，必须先输出【执行计划】，再调用工具。\n2. 能够感知当前时间，对于时间敏感的查询（如新闻、热搜），请使用当前日期进行搜索。"
-        
-        if db_config:
-            system_content += f"\n\n[MySQL配置信息]\nHost: {db_config.get('host')}\nPort: {db_config.get('port')}\nUser: {db_config.get('user')}\nPassword: {db_config.get('password')}\nDatabase: {db_config.get('database')}\n\n注意：上述配置是基础连接信息。\n1. 如果用户查询的是当前配置的数据库，直接使用上述所有参数。\n2. 如果用户查询的是**其他数据库**（例如 'test10'），请**保持 Host, Port, User, Password 不变**，仅将 'database' 参数修改为目标数据库名（例如 'test10'）。\n3. **严禁**为了查找数据库配置而浏览本地文件（如 list_directory, read_file），除非用户明确要求查看配置文件。直接尝试使用上述凭证连接。"
+        messages = await self._build_messages(session or {}, db_config)
+        tools = tool_router.select(user_text, (session or {}).get("messages", []),
+                                   (session or {}).get("offered_tools", []))
+        persona = self.persona_manager.get_active_persona()
+        cascade = self.cascade.start(user_text, persona, tools.routed, cache=llm_cache.enabled_for(persona))
+        memo = RunMemo()
 
-        system_prompt = {
-            "role": "system", 
-            "content": system_content
-        }
-        
-        tool_id_to_name = {}
-        for msg in history_messages:
-            if msg.get("role") == "assistant" and "tool_calls" in msg:
-                for tc in msg["tool_calls"]:
-                    if isinstance(tc, dict):
-                        tid = tc.get("id")
-                        fname = tc.get("function", {}).get("name")
-                        if tid and fname:
-                            tool_id_to_name[tid] = fname
-            elif msg.get("role") == "tool" and ("name" not in msg or not msg["name"]):
-                tid = msg.get("tool_call_id")
-                if tid and tid in tool_id_to_name:
-                    msg["name"] = tool_id_to_name[tid]
-
-        start_index = len(history_messages) - 20
-        if start_index < 0:
-            start_index = 0
-            
-        while start_index > 0 and history_messages[start_index].get("role") != "user":
-            start_index -= 1
-            
-        recent_messages = history_messages[start_index:]
-        messages = [system_prompt] + recent_messages
-        
         max_turns = message.get("max_steps", 10)
         current_turn = 0
-        
+
+        trace = current_trace()
         while current_turn < max_turns:
-            llm_response = self.llm.chat(messages, tools=TOOLS_SCHEMA)
+            trace.turn = current_turn + 1
+            llm_response = await cascade.chat(messages, tools=await self._tool_schemas(tools, session_id))
             current_turn += 1
-            
+
             if not llm_response:
                 response_text = "抱歉，处理您的请求时遇到了错误。"
                 break
-                
+
             if llm_response.tool_calls:
                 tool_calls_data = []
                 for tc in llm_response.tool_calls:
@@ -131,329 +464,246 @@ class PersonalAgent:
                             "arguments": tc.function.arguments
                         }
                     })
-                
+                tools.observe(tc["function"]["name"] for tc in tool_calls_data)
+
                 display_content = llm_response.content
                 if not display_content:
-                     tool_names = ", ".join([t['function']['name'] for t in tool_calls_data])
-                     display_content = f"[正在调用工具: {tool_names}...]"
+                    tool_names = ", ".join([t['function']['name'] for t in tool_calls_data])
+                    display_content = f"[正在调用工具: {tool_names}...]"
 
-                self.session_manager.add_message(
-                    session_id, 
-                    "assistant", 
-                    display_content, 
+                await self._add_message(
+                    session_id,
+                    "assistant",
+                    display_content,
                     tool_calls=tool_calls_data
                 )
-                
-                assistant_msg = {
+
+                messages.append({
                     "role": "assistant",
                     "content": llm_response.content,
                     "tool_calls": tool_calls_data
-                }
-                messages.append(assistant_msg)
-                
-                for tool_call in llm_response.tool_calls:
-                    func_name = tool_call.function.name
-                    func_args = json.loads(tool_call.function.arguments)
-                    
-                    print(f"Executing tool: {func_name} with args: {func_args}")
-                    
-                    permission_granted = True
-                    error_msg = ""
-                    
-                    if file_config and func_name in ["read_file", "list_directory", "write_file", "search_files"]:
-                        allow_read = file_config.get("allow_read", True)
-                        allowed_paths = file_config.get("allowed_paths", [])
-                        
-                        target_path = func_args.get("file_path") or func_args.get("dir_path") or func_args.get("root_dir")
-                        
-                        if not allow_read:
-                            permission_granted = False
-                            error_msg = f"Error: File access is disabled by user settings. Cannot execute '{func_name}'."
-                        elif allowed_paths and target_path:
-                            import os
-                            target_abs = os.path.abspath(target_path)
-                            is_allowed = False
-                            for p in allowed_paths:
-                                allowed_abs = os.path.abspath(p)
-                                if target_abs.startswith(allowed_abs):
-                                    is_allowed = True
-                                    break
-                            
-                            if not is_allowed:
-                                permission_granted = False
-                                error_msg = f"Error: Access to path '{target_path}' is denied. Allowed paths: {allowed_paths}"
-
-                    if not permission_granted:
-                        tool_result = error_msg
-                    elif func_name in AVAILABLE_TOOLS:
-                        try:
-                            tool_result = AVAILABLE_TOOLS[func_name](**func_args)
-                        except Exception as e:
-                            tool_result = f"Error executing tool: {str(e)}"
-                    else:
-                        tool_result = f"Error: Tool '{func_name}' not found."
-                    
-                    if len(tool_result) > 2000:
-                         tool_result_truncated = tool_result[:2000] + "\n...(Output truncated due to length)..."
-                    else:
-                         tool_result_truncated = tool_result
-
-                    self.session_manager.add_message(
-                        session_id,
-                        "tool",
-                        tool_result_truncated,
-                        tool_call_id=tool_call.id,
-                        name=func_name
-                    )
-                    
-                    messages.append({
-                        "role": "tool",
-                        "content": tool_result_truncated,
-                        "tool_call_id": tool_call.id,
-                        "name": func_name
-                    })
+                })
+
+                results = [None] * len(tool_calls_data)
+                async for kind, index, value in self._run_tool_calls(tool_calls_data, file_config, memo=memo):
+                    if kind == "result":
+                        results[index] = value
+
+                await self._record_tool_results(session_id, tool_calls_data, results, messages)
+                cascade.observe_tools(tool_calls_data, results, tools.names)
+                if self._too_many_repeats(memo):
+                    response_text = REPEAT_STOP_MESSAGE
+                    await self._add_message(session_id, "assistant", response_text)
+                    break
             else:
                 response_text = llm_response.content
-                self.session_manager.add_message(session_id, "assistant", response_text)
+                await self._add_message(session_id, "assistant", response_text)
                 break
 
         finish_reason = "stop"
-        if current_turn >= max_turns and not response_text:
+        if response_text == REPEAT_STOP_MESSAGE:
+            finish_reason = "repeated_tool_calls"
+        elif current_turn >= max_turns and not response_text:
             finish_reason = "length"
             response_text = "任务执行步骤已达上限，是否继续？"
-            self.session_manager.add_message(session_id, "assistant", response_text)
+            await self._add_message(session_id, "assistant", response_text)
 
-        return {
+        cascade.finish()
+        self._end_turn(session_id)
+
+        result = {
             "response": response_text,
             "session_id": session_id,
             "finish_reason": finish_reason
         }
+        if self._wants_timing(message):
+            result["timing"] = trace.summary()
+        return result
 
-    def process_message_stream(self, message, session_id=None):
+    async def aprocess_message_stream(self, message, session_id=None, cancel_token=None):
         """
-        Stream version of process_message.
-        Yields events: 
+        Async stream version of process_message.
+
+        :param cancel_token: 可选的 CancelToken。取消后上游模型流被关闭、未完成的工具调用被跳过，
+            已产生的内容连同取消标记写入会话
+
+        Yields events:
         {"type": "content", "content": "..."}
-        {"type": "tool_start", "tool": "...", "input": "..."}
-        {"type": "tool_result", "tool": "...", "output": "..."}
+        {"type": "tool_start", "tool": "...", "input": "...", "id": "..."}
+        {"type": "tool_result", "tool": "...", "output": "...", "id": "..."}
         {"type": "meta", "session_id": "...", "finish_reason": "..."}
+        {"type": "meta", "timing": {...}}（可选，最后一个事件，见 Trace.summary）
         """
-        chat_id = message.get("chat_id")
+        trace = start_trace(session_id)
+        set_cancel_token(cancel_token)
+        session_id = await self._start_turn(message, session_id)
+        try:
+            async for event in self._stream_turn(message, session_id):
+                yield event
+            if self._wants_timing(message):
+                yield {"type": "meta", "timing": trace.summary()}
+        finally:
+            # 无论正常结束、出错还是客户端断开，都在后台写回本轮消息
+            self._end_turn(session_id)
+
+    async def _stream_turn(self, message, session_id):
         user_text = message.get("text", "")
         image_url = message.get("image")
         db_config = message.get("db_config")
         file_config = message.get("file_config")
 
-        if not session_id:
-             session = self.session_manager.create_session(title=user_text[:20])
-             session_id = session["id"]
-        
         yield {"type": "meta", "session_id": session_id}
 
         # 1. Vision Brain
         if image_url:
-            vision_desc = self.vision.analyze_image(image_url)
+            with span("vision"):
+                vision_desc = await run_blocking(self.vision.analyze_image, image_url)
             user_text += f"\n[System Note: User uploaded an image. Description: {vision_desc}]"
             yield {"type": "thought", "content": f"Analyzed image: {vision_desc}"}
 
         # 2. Update History
-        self.session_manager.add_message(session_id, "user", user_text)
+        session = await self._add_message(session_id, "user", user_text)
 
         # 3. Logic Brain setup (similar to process_message)
-        session = self.session_manager.get_session(session_id)
-        history_messages = []
-        for m in session.get("messages", []):
-            msg = {"role": m["role"], "content": m["content"]}
-            if "tool_calls" in m:
-                msg["tool_calls"] = m["tool_calls"]
-            if "tool_call_id" in m:
-                msg["tool_call_id"] = m["tool_call_id"]
-            if "name" in m:
-                msg["name"] = m["name"]
-            history_messages.append(msg)
-        
-        active_persona = self.persona_manager.get_active_persona()
-        base_system = active_persona["system_prompt"] if active_persona else "你是一个智能个人助手。"
-        current_time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        system_content = f"当前时间：{current_time_str}\n{base_system}\n\n[核心指令]\n1. 收到复杂需求时，必须先输出【执行计划】，再调用工具。\n2. 能够感知当前时间，对于时间敏感的查询（如新闻、热搜），请使用当前日期进行搜索。"
-        if db_config:
-            system_content += f"\n\n[MySQL配置信息]\nHost: {db_config.get('host')}\nPort: {db_config.get('port')}\nUser: {db_config.get('user')}\nPassword: {db_config.get('password')}\nDatabase: {db_config.get('database')}\n\n注意：上述配置是基础连接信息。\n1. 如果用户查询的是当前配置的数据库，直接使用上述所有参数。\n2. 如果用户查询的是**其他数据库**（例如 'test10'），请**保持 Host, Port, User, Password 不变**，仅将 'database' 参数修改为目标数据库名（例如 'test10'）。\n3. **严禁**为了查找数据库配置而浏览本地文件（如 list_directory, read_file），除非用户明确要求查看配置文件。直接尝试使用上述凭证连接。"
-
-        system_prompt = {"role": "system", "content": system_content}
-        
-        # Tool name fix for history
-        tool_id_to_name = {}
-        for msg in history_messages:
-            if msg.get("role") == "assistant" and "tool_calls" in msg:
-                for tc in msg["tool_calls"]:
-                    if isinstance(tc, dict):
-                        tid = tc.get("id")
-                        fname = tc.get("function", {}).get("name")
-                        if tid and fname:
-                            tool_id_to_name[tid] = fname
-            elif msg.get("role") == "tool" and ("name" not in msg or not msg["name"]):
-                tid = msg.get("tool_call_id")
-                if tid and tid in tool_id_to_name:
-                    msg["name"] = tool_id_to_name[tid]
-
-        # Slicing
-        start_index = len(history_messages) - 20
-        if start_index < 0: start_index = 0
-        while start_index > 0 and history_messages[start_index].get("role") != "user":
-            start_index -= 1
-        recent_messages = history_messages[start_index:]
-        messages = [system_prompt] + recent_messages
-        
+        messages = await self._build_messages(session or {}, db_config)
+        tools = tool_router.select(user_text, (session or {}).get("messages", []),
+                                   (session or {}).get("offered_tools", []))
+        persona = self.persona_manager.get_active_persona()
+        cascade = self.cascade.start(user_text, persona, tools.routed, cache=llm_cache.enabled_for(persona))
+        memo = RunMemo()
+
         max_turns = message.get("max_steps", 10)
         current_turn = 0
-        
-        while current_turn < max_turns:
-            current_turn += 1
-            stream = self.llm.chat_stream(messages, tools=TOOLS_SCHEMA)
-            
-            current_content = ""
-            current_tool_calls = {} 
-            
-            # Iterate stream
-            for chunk in stream:
-                if not chunk: continue
-                delta = chunk.choices[0].delta
-                
-                if delta.content:
-                    current_content += delta.content
-                    yield {"type": "content", "content": delta.content}
-                
-                if delta.tool_calls:
-                    for tc in delta.tool_calls:
-                        idx = tc.index
-                        if idx not in current_tool_calls:
-                            current_tool_calls[idx] = {
-                                "id": tc.id or "",
-                                "type": "function",
-                                "function": {"name": "", "arguments": ""}
-                            }
-                        if tc.id:
-                            current_tool_calls[idx]["id"] = tc.id
-                        if tc.function:
-                            if tc.function.name:
-                                # Prevent duplicate tool names if the stream sends the full name multiple times
-                                if current_tool_calls[idx]["function"]["name"] != tc.function.name:
-                                    current_tool_calls[idx]["function"]["name"] += tc.function.name
-                            if tc.function.arguments:
-                                current_tool_calls[idx]["function"]["arguments"] += tc.function.arguments
-            
-            # Stream finished for this turn
-            
-            if current_tool_calls:
-                tool_calls_list = [current_tool_calls[i] for i in sorted(current_tool_calls.keys())]
-                
-                # Save assistant msg
-                display_content = current_content
-                if not display_content:
-                     tool_names = ", ".join([t['function']['name'] for t in tool_calls_data]) if 'tool_calls_data' in locals() else "tools"
-                     display_content = f"[Calling tools...]"
-
-                self.session_manager.add_message(
-                    session_id, 
-                    "assistant", 
-                    display_content, # Might be empty if only tool calls
-                    tool_calls=tool_calls_list
-                )
-                
-                messages.append({
-                    "role": "assistant",
-                    "content": current_content, # None in API but string here is safer
-                    "tool_calls": tool_calls_list
-                })
-                
-                # Execute tools
-                for tc in tool_calls_list:
-                    func_name = tc["function"]["name"]
-                    args_str = tc["function"]["arguments"]
-                    
-                    yield {"type": "tool_start", "tool": func_name, "input": args_str}
-                    
-                    # Parse args
-                    parse_error = False
-                    try:
-                        func_args = json.loads(args_str)
-                    except json.JSONDecodeError:
-                        func_args = {}
-                        parse_error = True
-                        error_msg = f"Failed to parse arguments for {func_name}"
-                        yield {"type": "error", "content": error_msg}
-
-                    # Permission check
-                    permission_granted = True
-                    if not parse_error:
-                        error_msg = ""
-                    
-                    if not parse_error and file_config and func_name in ["read_file", "list_directory", "write_file", "search_files"]:
-                        allow_read = file_config.get("allow_read", True)
-                        allowed_paths = file_config.get("allowed_paths", [])
-                        
-                        target_path = func_args.get("file_path") or func_args.get("dir_path") or func_args.get("root_dir")
-                        
-                        if not allow_read:
-                            permission_granted = False
-                            error_msg = f"Error: File access is disabled by user settings. Cannot execute '{func_name}'."
-                        elif allowed_paths and target_path:
-                            import os
-                            target_abs = os.path.abspath(target_path)
-                            is_allowed = False
-                            for p in allowed_paths:
-                                allowed_abs = os.path.abspath(p)
-                                if target_abs.startswith(allowed_abs):
-                                    is_allowed = True
-                                    break
-                            
-                            if not is_allowed:
-                                permission_granted = False
-                                error_msg = f"Error: Access to path '{target_path}' is denied. Allowed paths: {allowed_paths}"
-
-                    if not permission_granted:
-                        tool_result = error_msg
-                    elif func_name in AVAILABLE_TOOLS:
-                        try:
-                            tool_result = AVAILABLE_TOOLS[func_name](**func_args)
-                        except Exception as e:
-                            tool_result = f"Error executing tool: {str(e)}"
-                    else:
-                        tool_result = f"Error: Tool '{func_name}' not found."
-
-                    # Yield result
-                    yield {"type": "tool_result", "tool": func_name, "output": tool_result}
-                    
-                    # Truncate for history
-                    if len(tool_result) > 2000:
-                         tool_result_truncated = tool_result[:2000] + "\n...(Output truncated due to length)..."
-                    else:
-                         tool_result_truncated = tool_result
-
-                    self.session_manager.add_message(
+
+        # 流式输出期间已提前执行的只读调用 {index: task}
+        speculative = {}
+        trace = current_trace()
+        current_content = ""
+        # 已写入会话、但结果尚未写入的工具调用，取消时需要补上结果
+        pending_calls, results = None, None
+        try:
+            while current_turn < max_turns:
+                current_turn += 1
+                trace.turn = current_turn
+
+                current_content = ""
+                current_tool_calls = {}
+                speculative = {}
+
+                # Iterate stream
+                async for chunk in cascade.chat_stream(messages, tools=await self._tool_schemas(tools, session_id)):
+                    if not chunk or not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+
+                    if delta.content:
+                        current_content += delta.content
+                        yield {"type": "content", "content": delta.content}
+
+                    if delta.tool_calls:
+                        for tc in delta.tool_calls:
+                            idx = tc.index
+                            if idx not in current_tool_calls:
+                                current_tool_calls[idx] = {
+                                    "id": tc.id or "",
+                                    "type": "function",
+                                    "function": {"name": "", "arguments": ""}
+                                }
+                            if tc.id:
+                                current_tool_calls[idx]["id"] = tc.id
+                            if tc.function:
+                                if tc.function.name:
+                                    # Prevent duplicate tool names if the stream sends the full name multiple times
+                                    if current_tool_calls[idx]["function"]["name"] != tc.function.name:
+                                        current_tool_calls[idx]["function"]["name"] += tc.function.name
+                                if tc.function.arguments:
+                                    current_tool_calls[idx]["function"]["arguments"] += tc.function.arguments
+
+                        if Config.TOOL_SPECULATIVE_ENABLED:
+                            for idx in self._speculate(current_tool_calls, speculative, file_config, memo):
+                                tc = current_tool_calls[idx]
+                                yield {"type": "tool_start", "tool": tc["function"]["name"], "input": tc["function"]["arguments"], "id": tc["id"]}
+
+                # Stream finished for this turn
+
+                if current_tool_calls:
+                    tool_calls_list = [current_tool_calls[i] for i in sorted(current_tool_calls.keys())]
+                    tools.observe(tc["function"]["name"] for tc in tool_calls_list)
+
+                    # Save assistant msg
+                    display_content = current_content or "[Calling tools...]"
+
+                    await self._add_message(
                         session_id,
-                        "tool",
-                        tool_result_truncated,
-                        tool_call_id=tc["id"],
-                        name=func_name
+                        "assistant",
+                        display_content,
+                        tool_calls=tool_calls_list
                     )
-                    
+
                     messages.append({
-                        "role": "tool",
-                        "content": tool_result_truncated,
-                        "tool_call_id": tc["id"],
-                        "name": func_name
+                        "role": "assistant",
+                        "content": current_content, # None in API but string here is safer
+                        "tool_calls": tool_calls_list
                     })
-                
-                # Loop continues to next turn (LLM sees tool results)
-            else:
-                # No tool calls, just content. Done.
-                self.session_manager.add_message(session_id, "assistant", current_content)
-                yield {"type": "meta", "finish_reason": "stop"}
-                break
-        
+
+                    # Execute tools concurrently; events are streamed as each call starts / finishes
+                    results = [None] * len(tool_calls_list)
+                    pending_calls = tool_calls_list
+                    started = set(speculative)
+                    async for kind, index, value in self._run_tool_calls(tool_calls_list, file_config, speculative, progress=True, memo=memo):
+                        tc = tool_calls_list[index]
+                        func_name = tc["function"]["name"]
+
+                        if kind == "progress":
+                            yield {"type": "tool_progress", "tool": func_name, "content": value, "id": tc["id"]}
+                            continue
+
+                        if kind == "start":
+                            if index in started:
+                                # 推测执行的调用在流式输出期间已经发出过 tool_start
+                                continue
+                            yield {"type": "tool_start", "tool": func_name, "input": tc["function"]["arguments"], "id": tc["id"]}
+                            continue
+
+                        tool_result, parse_error = value
+                        results[index] = value
+                        if parse_error:
+                            yield {"type": "error", "content": parse_error}
+
+                        # Yield result
+                        yield {"type": "tool_result", "tool": func_name, "output": tool_result, "id": tc["id"]}
+
+                    # History keeps the model's original call order
+                    await self._record_tool_results(session_id, tool_calls_list, results, messages)
+                    cascade.observe_tools(tool_calls_list, results, tools.names)
+                    pending_calls = None
+                    current_content = ""
+
+                    if self._too_many_repeats(memo):
+                        await self._add_message(session_id, "assistant", REPEAT_STOP_MESSAGE)
+                        yield {"type": "content", "content": REPEAT_STOP_MESSAGE}
+                        yield {"type": "meta", "finish_reason": "repeated_tool_calls"}
+                        return
+
+                    # Loop continues to next turn (LLM sees tool results)
+                else:
+                    # No tool calls, just content. Done.
+                    await self._add_message(session_id, "assistant", current_content)
+                    yield {"type": "meta", "finish_reason": "stop"}
+                    break
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端断开：保存已产生的内容并标记为已取消
+            print(f"Request cancelled in session {session_id}")
+            await self._persist_cancelled(session_id, current_content, pending_calls, results)
+            raise
+        finally:
+            # 出错或客户端断开时，取消尚未被使用的推测执行
+            for task in speculative.values():
+                task.cancel()
+            cascade.finish()
+
         if current_turn >= max_turns:
             yield {"type": "meta", "finish_reason": "length"}
             cont_msg = "任务执行步骤已达上限，是否继续？"
-            self.session_manager.add_message(session_id, "assistant", cont_msg)
+            await self._add_message(session_id, "assistant", cont_msg)
             yield {"type": "content", "content": cont_msg}
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import contextvars
+from typing import Optional
+
+# 取消后写入会话的标记文本
+CANCELLED_MARKER = "[已取消]"
+
+
+class CancelToken:
+    """
+    一次请求的取消信号。
+
+    基于 threading.Event，线程池中执行的阻塞工具（例如 run_python）也可以检查或等待它。
+    取消时同时取消绑定的 asyncio 任务，使 Agent 循环在当前的 await 处立即退出：
+    上游模型流被关闭，排队中的工具调用不再执行。
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def bind(self, task: asyncio.Task):
+        """绑定执行 Agent 循环的任务，取消时一并取消。"""
+        self._task = task
+        if self.cancelled:
+            task.cancel()
+
+    def cancel(self, reason: str = "client_disconnected"):
+        if self._event.is_set():
+            return
+        self.reason = reason
+        self._event.set()
+        if self._task is not None and not self._task.done():
+            self._task.get_loop().call_soon_threadsafe(self._task.cancel)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """阻塞等待取消，返回是否已取消。供线程中的工具轮询使用。"""
+        return self._event.wait(timeout)
+
+
+# 当前请求的取消信号。run_blocking 会把上下文带入线程池，工具函数可以直接读取
+_current_token: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar("cancel_token", default=None)
+
+
+def set_cancel_token(token: Optional[CancelToken]):
+    _current_token.set(token)
+
+
+def current_cancel_token() -> Optional[CancelToken]:
+    return _current_token.get()
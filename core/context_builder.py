@@ -0,0 +1,191 @@
+import re
+import json
+from typing import Callable, Dict, List, Optional
+from config import Config
+
+# 每条消息在对话格式中的固定开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+# 缓存在会话消息上的 token 数字段
+TOKENS_KEY = "tokens"
+
+_CJK_RE = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+_encoding = None
+_encoding_loaded = False
+
+def _get_encoding():
+    """tiktoken 为可选依赖，未安装或无法加载词表时使用估算。"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = None
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # 估算：中日韩字符约 1 token/字，其余约 4 字符/token
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def count_message_tokens(message: Dict) -> int:
+    """一条消息发送给模型时占用的 token 数（正文 + 工具调用参数 + 固定开销）。"""
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += count_tokens(content)
+    if message.get("tool_calls"):
+        tokens += count_tokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+    if message.get("name"):
+        tokens += count_tokens(message["name"])
+    return tokens
+
+
+class ContextBuilder:
+    """
+    按 token 预算组装发送给模型的上下文。
+
+    历史消息从新到旧按"单元"装入预算：发起工具调用的 assistant 消息和它的 tool 结果是一个单元，
+    要么整体保留要么整体丢弃，不会出现缺少调用的 tool 消息。每条消息的 token 数只计算一次，
+    缓存在会话消息的 tokens 字段上。
+
+    为了利用服务商的前缀缓存，提示词按"稳定在前、易变在后"组装：
+    [稳定的 system 提示词] + [对话摘要] + [历史窗口] ，时间等易变的请求上下文只附加在本轮用户消息上。
+    窗口起点记录在会话上（context_start），只要还装得下就保持不动，超出预算时一次性
+    向后滑动到 REPACK_RATIO 的预算处，使连续多轮请求共享同一段前缀。
+    """
+    # 窗口超出预算重新装填时使用的预算比例，为后续几轮留出增长空间
+    REPACK_RATIO = 0.75
+
+    def __init__(self, token_budget: Optional[int] = None):
+        self.token_budget = token_budget or Config.CONTEXT_TOKEN_BUDGET
+
+    @staticmethod
+    def _message_tokens(messages: List[Dict], seq: int, on_count: Optional[Callable[[int, int], None]]) -> int:
+        tokens = messages[seq].get(TOKENS_KEY)
+        if tokens is None:
+            tokens = count_message_tokens(messages[seq])
+            if on_count:
+                # 旧会话中没有缓存的消息，计算后写回会话
+                on_count(seq, tokens)
+        return tokens
+
+    @staticmethod
+    def units(messages: List[Dict], start: int = 0) -> List[List[int]]:
+        """把 start 之后的消息下标切分为单元：tool 消息归属于它前面的 assistant 工具调用。"""
+        units = []
+        for seq in range(start, len(messages)):
+            m = messages[seq]
+            if m.get("role") == "tool" and units:
+                units[-1].append(seq)
+            else:
+                units.append([seq])
+        return units
+
+    def select(self, messages: List[Dict], budget: int,
+               on_count: Optional[Callable[[int, int], None]] = None, start: int = 0,
+               anchor: Optional[int] = None) -> List[int]:
+        """
+        在预算内从新到旧选择 start 之后的历史消息，返回选中的消息下标（按原顺序）。
+        最新的单元（本轮用户消息）总是保留；窗口从用户消息开始。
+
+        :param anchor: 上一次的窗口起点；从它开始的消息仍在预算内时直接沿用
+        """
+        if anchor is not None and start <= anchor < len(messages) and messages[anchor].get("role") == "user":
+            tokens = sum(self._message_tokens(messages, seq, on_count) for seq in range(anchor, len(messages)))
+            if tokens <= budget:
+                return list(range(anchor, len(messages)))
+            budget = int(budget * self.REPACK_RATIO)
+
+        selected: List[List[int]] = []
+        used = 0
+        for unit in reversed(self.units(messages, start)):
+            unit_tokens = sum(self._message_tokens(messages, seq, on_count) for seq in unit)
+            if selected and used + unit_tokens > budget:
+                break
+            selected.append(unit)
+            used += unit_tokens
+        selected.reverse()
+
+        # 窗口以用户消息开头；开头的 assistant / 孤立的 tool 消息丢弃
+        while len(selected) > 1 and messages[selected[0][0]].get("role") != "user":
+            selected.pop(0)
+        return [seq for unit in selected for seq in unit]
+
+    def build(self, session: Dict, system_message: Dict, request_context: str = "",
+              on_count: Optional[Callable[[int, int], None]] = None,
+              on_window: Optional[Callable[[int], None]] = None) -> List[Dict]:
+        """
+        组装 [system] + [对话摘要] + 预算内的历史消息。
+
+        已折叠进会话摘要（session["summary"]）的消息不再重复发送，摘要紧跟在 system 提示词之后。
+
+        :param request_context: 每次请求都会变化的上下文（当前时间等），附加在最后一条用户消息之后
+        :param on_count: 回调 on_count(seq, tokens)，用于缓存新计算出的 token 数
+        :param on_window: 回调 on_window(start)，窗口起点变化时调用，用于保存 context_start
+        """
+        stored = session.get("messages", [])
+        prefix = [system_message]
+        summary_message = self.summary_message(session)
+        if summary_message:
+            prefix.append(summary_message)
+        budget = self.token_budget - sum(count_message_tokens(m) for m in prefix) - count_tokens(request_context)
+        window = self.select(stored, budget, on_count, start=self.summarized_upto(session),
+                             anchor=session.get("context_start"))
+        if window and on_window and window[0] != session.get("context_start"):
+            on_window(window[0])
+
+        history_messages = []
+        for seq in window:
+            m = stored[seq]
+            msg = {"role": m["role"], "content": m["content"]}
+            if "tool_calls" in m:
+                msg["tool_calls"] = m["tool_calls"]
+            if "tool_call_id" in m:
+                msg["tool_call_id"] = m["tool_call_id"]
+            if "name" in m:
+                msg["name"] = m["name"]
+            history_messages.append(msg)
+
+        # Tool name fix for history
+        tool_id_to_name = {}
+        for msg in history_messages:
+            if msg.get("role") == "assistant" and "tool_calls" in msg:
+                for tc in msg["tool_calls"]:
+                    if isinstance(tc, dict):
+                        tid = tc.get("id")
+                        fname = tc.get("function", {}).get("name")
+                        if tid and fname:
+                            tool_id_to_name[tid] = fname
+            elif msg.get("role") == "tool" and ("name" not in msg or not msg["name"]):
+                tid = msg.get("tool_call_id")
+                if tid and tid in tool_id_to_name:
+                    msg["name"] = tool_id_to_name[tid]
+
+        if request_context:
+            for msg in reversed(history_messages):
+                if msg["role"] == "user":
+                    msg["content"] = f"{msg['content']}\n\n{request_context}"
+                    break
+
+        return prefix + history_messages
+
+    @staticmethod
+    def summarized_upto(session: Dict) -> int:
+        """已折叠进摘要的消息数（摘要覆盖 messages[:upto]）。"""
+        summary = session.get("summary") or {}
+        return min(summary.get("upto", 0), len(session.get("messages", [])))
+
+    @staticmethod
+    def summary_message(session: Dict) -> Optional[Dict]:
+        summary = session.get("summary") or {}
+        if not summary.get("content"):
+            return None
+        return {"role": "system", "content": f"[早前对话摘要]\n{summary['content']}"}
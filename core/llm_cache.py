@@ -0,0 +1,304 @@
+import os
+import re
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional
+from openai.types.chat import ChatCompletionChunk, ChatCompletionMessage
+from config import Config
+from core.metrics import registry
+
+LLM_CACHE_LOOKUPS = registry.counter(
+    "llm_cache_lookups_total", "Model response cache lookups by result (hit, miss).", ["result"]
+)
+LLM_CACHE_SAVED_TOKENS = registry.counter(
+    "llm_cache_saved_tokens_total", "Tokens not spent because a cached model response was replayed.", ["kind"]
+)
+LLM_CACHE_EVICTIONS = registry.counter(
+    "llm_cache_evictions_total", "Model response cache entries evicted to stay within the size limits."
+)
+LLM_CACHE_BYTES = registry.gauge("llm_cache_bytes", "Size of the model response cache on disk.")
+LLM_CACHE_ENTRIES = registry.gauge("llm_cache_entries", "Number of entries in the model response cache.")
+
+# 请求上下文中每次请求都会变化、但不影响回答的内容，计算键时去掉：当前时间只保留日期
+VOLATILE_PATTERNS = [
+    (re.compile(r"(当前时间：\d{4}-\d{2}-\d{2}) \d{2}:\d{2}:\d{2}"), r"\1"),
+]
+# 回放时每个内容 chunk 的字符数
+REPLAY_CHUNK_CHARS = 24
+
+
+def _normalize(content):
+    if isinstance(content, str):
+        for pattern, replacement in VOLATILE_PATTERNS:
+            content = pattern.sub(replacement, content)
+    return content
+
+
+def _canonical_messages(messages: List[Dict]) -> List[Dict]:
+    """
+    计算键用的消息：去掉易变内容，工具调用 ID 按出现顺序替换为序号。
+    ID 由服务商（或缓存回放）随机生成，不影响回答，保留会使工具结果之后的步骤永远无法命中。
+    """
+    ids: Dict[str, str] = {}
+
+    def canonical_id(call_id):
+        return ids.setdefault(call_id, f"call_{len(ids)}") if call_id else call_id
+
+    result = []
+    for m in messages:
+        m = {**m, "content": _normalize(m.get("content"))}
+        if m.get("tool_calls"):
+            m["tool_calls"] = [{**tc, "id": canonical_id(tc.get("id"))} for tc in m["tool_calls"]]
+        if m.get("tool_call_id"):
+            m["tool_call_id"] = canonical_id(m["tool_call_id"])
+        result.append(m)
+    return result
+
+
+class StreamRecorder:
+    """在流式响应经过时拼出完整的助手消息，流正常结束后写入缓存。"""
+    def __init__(self):
+        self.content = ""
+        self.tool_calls: Dict[int, Dict] = {}
+        self.finish_reason = None
+
+    def add(self, chunk):
+        if not chunk.choices:
+            return
+        choice = chunk.choices[0]
+        delta = choice.delta
+        if delta.content:
+            self.content += delta.content
+        for tc in delta.tool_calls or []:
+            call = self.tool_calls.setdefault(tc.index, {"id": "", "type": "function",
+                                                         "function": {"name": "", "arguments": ""}})
+            if tc.id:
+                call["id"] = tc.id
+            if tc.function:
+                if tc.function.name and call["function"]["name"] != tc.function.name:
+                    call["function"]["name"] += tc.function.name
+                if tc.function.arguments:
+                    call["function"]["arguments"] += tc.function.arguments
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+
+    @property
+    def complete(self) -> bool:
+        return self.finish_reason is not None and bool(self.content or self.tool_calls)
+
+    def message(self) -> Dict:
+        message = {"role": "assistant", "content": self.content or None}
+        if self.tool_calls:
+            message["tool_calls"] = [self.tool_calls[i] for i in sorted(self.tool_calls)]
+        return message
+
+
+class LLMResponseCache:
+    """
+    模型响应的精确匹配缓存，对在 LLM_CACHE_PERSONAS 中的人格生效。
+
+    键为 (模型, 消息, 工具定义, temperature) 规范化 JSON 的 SHA-256，消息中只在请求上下文里变化的
+    当前时刻只保留日期，因此同一天内重复的请求（每日报表、对未变化数据的同一个问题、界面重连后的重试）
+    直接返回之前的回答。工具结果是消息的一部分，数据变化后键随之变化。
+    每个条目一个 JSON 文件，存放在 LLM_CACHE_DIR 下；首次使用时扫描目录按修改时间建立 LRU 索引，
+    命中时更新修改时间，总字节数或条数超过上限时淘汰最久未使用的条目。
+    流式和非流式请求共用条目，流式命中时回放为合成的 chunk。
+    """
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None,
+                 max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        self.cache_dir = Config.LLM_CACHE_DIR if cache_dir is None else cache_dir
+        self.max_bytes = Config.LLM_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_entries = Config.LLM_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.ttl = Config.LLM_CACHE_TTL if ttl is None else ttl
+        self.personas = {name.strip() for name in Config.LLM_CACHE_PERSONAS.split(",") if name.strip()}
+        # key -> 文件字节数，按最近使用排序
+        self._index: Optional["OrderedDict[str, int]"] = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0,
+                      "saved_prompt_tokens": 0, "saved_completion_tokens": 0}
+
+    def enabled_for(self, persona: Optional[Dict]) -> bool:
+        if not self.cache_dir or not self.personas:
+            return False
+        return "*" in self.personas or bool(persona and persona.get("id") in self.personas)
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], tools: Optional[List[Dict]] = None,
+                 temperature: Optional[float] = None) -> str:
+        canonical = {
+            "model": model,
+            "messages": _canonical_messages(messages),
+            "tools": tools or [],
+            "temperature": temperature,
+        }
+        text = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _ensure_index(self):
+        """首次使用时扫描磁盘，按修改时间从旧到新建立 LRU 索引。调用方持有锁。"""
+        if self._index is not None:
+            return
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    try:
+                        st = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, name[:-5], st.st_size))
+        files.sort()
+        self._index = OrderedDict((key, size) for _, key, size in files)
+        self._bytes = sum(size for _, _, size in files)
+        self._evict()
+
+    def _evict(self):
+        while self._index and (len(self._index) > self.max_entries or self._bytes > self.max_bytes):
+            key, size = self._index.popitem(last=False)
+            self._bytes -= size
+            self.stats["evictions"] += 1
+            LLM_CACHE_EVICTIONS.inc()
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        LLM_CACHE_BYTES.set(self._bytes)
+        LLM_CACHE_ENTRIES.set(len(self._index))
+
+    def _drop(self, key: str):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    # ------------------------------------------------------------------
+
+    def get(self, key: str) -> Optional[Dict]:
+        """返回缓存条目 {"message", "usage", "created_at"}，未命中或已过期时返回 None。"""
+        with self._lock:
+            self._ensure_index()
+            entry = None
+            if key in self._index:
+                try:
+                    with open(self._path(key), "r", encoding="utf-8") as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    entry = None
+                if entry is None or (self.ttl and time.time() - entry.get("created_at", 0) > self.ttl):
+                    self._drop(key)
+                    entry = None
+                else:
+                    self._index.move_to_end(key)
+                    try:
+                        os.utime(self._path(key))
+                    except OSError:
+                        pass
+            if entry is None:
+                self.stats["misses"] += 1
+                LLM_CACHE_LOOKUPS.inc(result="miss")
+                return None
+            usage = entry.get("usage") or {}
+            self.stats["hits"] += 1
+            self.stats["saved_prompt_tokens"] += usage.get("prompt_tokens", 0)
+            self.stats["saved_completion_tokens"] += usage.get("completion_tokens", 0)
+        LLM_CACHE_LOOKUPS.inc(result="hit")
+        LLM_CACHE_SAVED_TOKENS.inc(usage.get("prompt_tokens", 0), kind="prompt")
+        LLM_CACHE_SAVED_TOKENS.inc(usage.get("completion_tokens", 0), kind="completion")
+        return entry
+
+    def put(self, key: str, message: Dict, usage: Optional[Dict] = None):
+        entry = {"message": message, "usage": usage or {}, "created_at": time.time()}
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        with self._lock:
+            self._ensure_index()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"写入模型响应缓存出错: {e}")
+                return
+            self._bytes -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._bytes += len(data)
+            self.stats["stores"] += 1
+            self._evict()
+
+    async def aget(self, key: str) -> Optional[Dict]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, message: Dict, usage: Optional[Dict] = None):
+        await asyncio.to_thread(self.put, key, message, usage)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0,
+                "entries": len(self._index or ()),
+                "bytes": self._bytes,
+                "personas": sorted(self.personas),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._index = OrderedDict()
+            self._bytes = 0
+            if self.cache_dir:
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+            LLM_CACHE_BYTES.set(0)
+            LLM_CACHE_ENTRIES.set(0)
+
+
+def cached_message(entry: Dict) -> ChatCompletionMessage:
+    """非流式命中时返回的消息对象，与模型返回的 message 类型相同。"""
+    return ChatCompletionMessage.model_validate(_fresh_call_ids(entry["message"]))
+
+
+def replay_chunks(entry: Dict, model: str) -> Iterator[ChatCompletionChunk]:
+    """把缓存的消息拆成流式 chunk：正文分段输出，每个工具调用一个 chunk，最后一个 chunk 带 finish_reason。"""
+    message = _fresh_call_ids(entry["message"])
+    created = int(time.time())
+
+    def chunk(delta, finish_reason=None):
+        return ChatCompletionChunk.model_validate({
+            "id": "chatcmpl-cache", "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        })
+
+    content = message.get("content") or ""
+    for start in range(0, len(content), REPLAY_CHUNK_CHARS):
+        yield chunk({"role": "assistant", "content": content[start:start + REPLAY_CHUNK_CHARS]})
+    tool_calls = message.get("tool_calls") or []
+    for i, call in enumerate(tool_calls):
+        yield chunk({"tool_calls": [{"index": i, **call}]})
+    yield chunk({}, "tool_calls" if tool_calls else "stop")
+
+
+def _fresh_call_ids(message: Dict) -> Dict:
+    """回放的工具调用使用新的 ID，避免与会话中已有的调用重复。"""
+    if not message.get("tool_calls"):
+        return message
+    return {**message, "tool_calls": [{**call, "id": "call_" + secrets.token_hex(8)} for call in message["tool_calls"]]}
+
+
+llm_cache = LLMResponseCache()
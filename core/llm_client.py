@@ -1,18 +1,333 @@
-from openai import OpenAI
+import time
+import random
+import threading
+from collections import deque
+from typing import Awaitable, Callable, List, Optional
+from urllib.parse import urlparse
+import openai
 from config import Config
+from core.metrics import registry, record_span, LLM_TOKENS_PER_SECOND
+from core.model_transport import model_transport, RETRYABLE_ERRORS
+from core.llm_cache import llm_cache, StreamRecorder, cached_message, replay_chunks
+from core.rate_limiter import rate_limiter, estimate_tokens
+
+MODEL_ROUTED_REQUESTS = registry.counter(
+    "model_routed_requests_total", "Model requests by the endpoint the router picked and the outcome.",
+    ["pool", "endpoint", "outcome"]
+)
+MODEL_FAILOVERS = registry.counter(
+    "model_failovers_total", "Model requests that moved to another endpoint after a failure.", ["pool"]
+)
+MODEL_CIRCUIT_STATE = registry.gauge(
+    "model_endpoint_circuit_state", "Circuit breaker state per endpoint (0 closed, 1 half-open, 2 open).",
+    ["pool", "endpoint"]
+)
+MODEL_ENDPOINT_TTFT = registry.gauge(
+    "model_endpoint_ttft_seconds", "Rolling average time to first token per endpoint.", ["pool", "endpoint"]
+)
+MODEL_ENDPOINT_TPS = registry.gauge(
+    "model_endpoint_tokens_per_second", "Rolling average output speed per endpoint.", ["pool", "endpoint"]
+)
+LLM_TIER_REQUEST_SECONDS = registry.histogram(
+    "llm_tier_request_seconds", "Model request duration by cascade tier.", ["tier", "stream"]
+)
+LLM_TIER_TTFT = registry.histogram(
+    "llm_tier_ttft_seconds", "Time to first token by cascade tier.", ["tier"]
+)
+LLM_TIER_TOKENS = registry.counter(
+    "llm_tier_tokens_total", "Tokens used by cascade tier (prompt, cached, completion).", ["tier", "kind"]
+)
+MODEL_ENDPOINT_ERROR_RATE = registry.gauge(
+    "model_endpoint_error_rate", "Error rate over the recent requests per endpoint.", ["pool", "endpoint"]
+)
+
+# 这些状态码说明端点本身不可用（密钥无效、模型不存在），换一个端点可能成功
+ENDPOINT_STATUS_ERRORS = (401, 403, 404)
+
+
+def _is_endpoint_failure(error: BaseException) -> bool:
+    """错误是否应计入端点健康度并切换端点；参数错误等请求本身的问题换端点也不会成功。"""
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in ENDPOINT_STATUS_ERRORS
+
+
+class ModelEndpoint:
+    """一个 OpenAI 兼容端点（base_url + 模型），以及它的滚动健康统计和熔断状态。"""
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+    # 滚动统计的平滑系数和错误率窗口大小
+    EWMA_ALPHA = 0.3
+    ERROR_WINDOW = 20
+
+    def __init__(self, pool: str, base_url: str, model: str, api_key: str, weight: float = 1.0):
+        self.pool = pool
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.weight = weight
+        self.name = f"{urlparse(base_url).netloc or base_url}/{model}"
+        self.ttft: Optional[float] = None
+        self.tokens_per_sec: Optional[float] = None
+        self.outcomes = deque(maxlen=self.ERROR_WINDOW)
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+        self._publish()
+
+    @property
+    def error_rate(self) -> float:
+        return (len(self.outcomes) - sum(self.outcomes)) / len(self.outcomes) if self.outcomes else 0.0
+
+    def available(self, now: float) -> bool:
+        """熔断关闭时可用；打开超过冷却时间后允许一次试探请求（半开）。"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return now - self.opened_at >= Config.MODEL_CIRCUIT_COOLDOWN
+        return not self.trial_in_flight
+
+    def acquire(self, now: float):
+        """选中该端点。熔断打开且已过冷却期时转为半开，本次请求即为试探请求。"""
+        with self._lock:
+            if self.state == self.OPEN and now - self.opened_at >= Config.MODEL_CIRCUIT_COOLDOWN:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                self.trial_in_flight = True
+            self._publish()
+
+    def record_success(self, ttft: Optional[float] = None, tokens_per_sec: Optional[float] = None):
+        with self._lock:
+            self.outcomes.append(True)
+            self.consecutive_failures = 0
+            if ttft is not None:
+                self.ttft = ttft if self.ttft is None else self.ttft + self.EWMA_ALPHA * (ttft - self.ttft)
+            if tokens_per_sec:
+                self.tokens_per_sec = tokens_per_sec if self.tokens_per_sec is None else \
+                    self.tokens_per_sec + self.EWMA_ALPHA * (tokens_per_sec - self.tokens_per_sec)
+            if self.state != self.CLOSED:
+                print(f"Model endpoint {self.name} recovered, closing circuit")
+            self.state = self.CLOSED
+            self.trial_in_flight = False
+            self._publish()
+
+    def record_failure(self):
+        with self._lock:
+            self.outcomes.append(False)
+            self.consecutive_failures += 1
+            tripped = (self.consecutive_failures >= Config.MODEL_CIRCUIT_FAILURES or
+                       (len(self.outcomes) >= self.ERROR_WINDOW // 2 and self.error_rate >= Config.MODEL_CIRCUIT_ERROR_RATE))
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and tripped):
+                print(f"Model endpoint {self.name} failing, opening circuit for {Config.MODEL_CIRCUIT_COOLDOWN}s")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+            self._publish()
+
+    def release(self):
+        """请求未产生结论（例如被取消）时释放试探名额。"""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def _publish(self):
+        labels = {"pool": self.pool, "endpoint": self.name}
+        MODEL_CIRCUIT_STATE.set(self.state, **labels)
+        MODEL_ENDPOINT_ERROR_RATE.set(self.error_rate, **labels)
+        if self.ttft is not None:
+            MODEL_ENDPOINT_TTFT.set(self.ttft, **labels)
+        if self.tokens_per_sec is not None:
+            MODEL_ENDPOINT_TPS.set(self.tokens_per_sec, **labels)
+
+
+def parse_endpoints(pool: str, spec: str, api_key: Optional[str], base_url: str, model: str) -> List[ModelEndpoint]:
+    """
+    解析端点配置。spec 为分号分隔的多个端点，每个端点为 "base_url|model|weight|api_key"，
+    后三项可省略，省略时使用该组的默认模型、权重 1 和默认密钥。spec 为空时只有默认端点。
+    """
+    endpoints = []
+    for entry in (spec or "").replace("\n", ";").split(";"):
+        parts = [part.strip() for part in entry.split("|")]
+        if not parts[0]:
+            continue
+        endpoint_model = parts[1] if len(parts) > 1 and parts[1] else model
+        weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1.0
+        endpoint_key = parts[3] if len(parts) > 3 and parts[3] else api_key
+        if endpoint_key and endpoint_model:
+            endpoints.append(ModelEndpoint(pool, parts[0], endpoint_model, endpoint_key, weight))
+    if not endpoints and api_key and model:
+        endpoints.append(ModelEndpoint(pool, base_url, model, api_key))
+    return endpoints
+
+
+class ModelRouter:
+    """
+    在多个 OpenAI 兼容端点之间分配请求，并在失败时切换端点。
+
+    每个端点维护滚动的 TTFT、输出速度和最近请求的错误率。选择端点时按
+    权重 × (1 - 错误率)² / TTFT 加权随机，健康且快的端点获得大部分流量，其余端点仍有少量流量以更新统计。
+    连续失败 MODEL_CIRCUIT_FAILURES 次或错误率超过 MODEL_CIRCUIT_ERROR_RATE 时熔断打开，
+    冷却 MODEL_CIRCUIT_COOLDOWN 秒后放行一次试探请求，成功则恢复。
+    请求失败时换下一个端点重试（流式请求只在收到第一个 chunk 之前切换）；
+    有多个端点时，每个端点自身的重试次数降为 MODEL_ROUTER_RETRIES_PER_ENDPOINT，尽快切换。
+    """
+    def __init__(self, pool: str, endpoints: List[ModelEndpoint]):
+        self.pool = pool
+        self.endpoints = endpoints
+
+    @classmethod
+    def from_config(cls, pool: str) -> "ModelRouter":
+        if pool == "vision":
+            endpoints = parse_endpoints(pool, Config.VISION_ENDPOINTS, Config.VISION_API_KEY,
+                                        Config.VISION_BASE_URL, Config.VISION_MODEL)
+        elif pool == "logic_fast":
+            # 快速模型未单独配置地址和密钥时与逻辑模型共用
+            endpoints = parse_endpoints(pool, Config.LOGIC_FAST_ENDPOINTS,
+                                        Config.LOGIC_FAST_API_KEY or Config.LOGIC_API_KEY,
+                                        Config.LOGIC_FAST_BASE_URL or Config.LOGIC_BASE_URL, Config.LOGIC_FAST_MODEL)
+        else:
+            endpoints = parse_endpoints(pool, Config.LOGIC_ENDPOINTS, Config.LOGIC_API_KEY,
+                                        Config.LOGIC_BASE_URL, Config.LOGIC_MODEL)
+        return cls(pool, endpoints)
+
+    @property
+    def models(self) -> str:
+        """该组端点提供的模型，作为响应缓存键的一部分。"""
+        return ",".join(sorted({e.model for e in self.endpoints}))
+
+    @property
+    def retries_per_endpoint(self) -> Optional[int]:
+        return Config.MODEL_ROUTER_RETRIES_PER_ENDPOINT if len(self.endpoints) > 1 else None
+
+    def _score(self, endpoint: ModelEndpoint, default_ttft: float) -> float:
+        ttft = endpoint.ttft if endpoint.ttft is not None else default_ttft
+        return endpoint.weight * (1 - endpoint.error_rate) ** 2 / max(ttft, 0.05)
+
+    def choose(self, exclude=()) -> Optional[ModelEndpoint]:
+        """选择下一个端点；全部熔断时选择最早熔断的端点，而不是直接失败。"""
+        now = time.monotonic()
+        remaining = [e for e in self.endpoints if e not in exclude]
+        if not remaining:
+            return None
+        candidates = [e for e in remaining if e.available(now)]
+        if candidates:
+            known = [e.ttft for e in candidates if e.ttft is not None]
+            # 还没有统计的端点按已知端点的平均 TTFT 估计，使新端点也能分到流量
+            default_ttft = sum(known) / len(known) if known else 1.0
+            weights = [self._score(e, default_ttft) for e in candidates]
+            if sum(weights) > 0:
+                chosen = random.choices(candidates, weights)[0]
+            else:
+                chosen = random.choice(candidates)
+        else:
+            chosen = min(remaining, key=lambda e: e.opened_at)
+        chosen.acquire(now)
+        return chosen
+
+    def _failed(self, endpoint: ModelEndpoint, error: BaseException, tried: List[ModelEndpoint]) -> bool:
+        """记录失败，返回是否应换一个端点重试。"""
+        MODEL_ROUTED_REQUESTS.inc(pool=self.pool, endpoint=endpoint.name, outcome="error")
+        if not _is_endpoint_failure(error):
+            endpoint.release()
+            return False
+        endpoint.record_failure()
+        if len(tried) < len(self.endpoints):
+            print(f"Model endpoint {endpoint.name} failed ({error}), failing over")
+            MODEL_FAILOVERS.inc(pool=self.pool)
+            return True
+        return False
+
+    def _succeeded(self, endpoint: ModelEndpoint, **stats):
+        MODEL_ROUTED_REQUESTS.inc(pool=self.pool, endpoint=endpoint.name, outcome="ok")
+        endpoint.record_success(**stats)
+
+    def call(self, request: Callable[[ModelEndpoint], object], tokens: int = 0):
+        """
+        同步请求：request(endpoint) 向指定端点发起一次调用。
+        tokens 为预估的 token 数，发出前按端点的 RPM/TPM 限制排队（见 core/rate_limiter.py）。
+        """
+        tried = []
+        while True:
+            endpoint = self.choose(tried)
+            tried.append(endpoint)
+            try:
+                result = model_transport.call(lambda: request(endpoint), max_retries=self.retries_per_endpoint,
+                                              limiter=rate_limiter.for_endpoint(endpoint.base_url), tokens=tokens)
+            except Exception as e:
+                if self._failed(endpoint, e, tried):
+                    continue
+                raise
+            self._succeeded(endpoint)
+            return result
+
+    async def acall(self, request: Callable[[ModelEndpoint], Awaitable], tokens: int = 0):
+        """异步请求，返回 (endpoint, result)。"""
+        tried = []
+        while True:
+            endpoint = self.choose(tried)
+            tried.append(endpoint)
+            try:
+                result = await model_transport.acall(lambda: request(endpoint), max_retries=self.retries_per_endpoint,
+                                                     limiter=rate_limiter.for_endpoint(endpoint.base_url), tokens=tokens)
+            except BaseException as e:
+                if isinstance(e, Exception) and self._failed(endpoint, e, tried):
+                    continue
+                if not isinstance(e, Exception):
+                    endpoint.release()
+                raise
+            self._succeeded(endpoint)
+            return endpoint, result
+
+    async def open_stream(self, request: Callable[[ModelEndpoint], Awaitable], tokens: int = 0):
+        """
+        发起流式请求，等到第一个 chunk 后返回 (endpoint, chunks)。
+        chunks 是从第一个 chunk 开始的异步生成器；流结束后由调用方调用 finish_stream 记录结果。
+        """
+        tried = []
+        while True:
+            endpoint = self.choose(tried)
+            tried.append(endpoint)
+            start = time.perf_counter()
+            stream = model_transport.stream(lambda: request(endpoint), endpoint.name,
+                                            max_retries=self.retries_per_endpoint,
+                                            limiter=rate_limiter.for_endpoint(endpoint.base_url), tokens=tokens)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException as e:
+                await stream.aclose()
+                if isinstance(e, Exception) and self._failed(endpoint, e, tried):
+                    continue
+                if not isinstance(e, Exception):
+                    endpoint.release()
+                raise
+            return endpoint, self._resume(stream, first), time.perf_counter() - start
+
+    @staticmethod
+    async def _resume(stream, first):
+        try:
+            if first is not None:
+                yield first
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    def finish_stream(self, endpoint: ModelEndpoint, ttft: float, tokens_per_sec: Optional[float] = None,
+                      error: Optional[BaseException] = None):
+        if error is None:
+            self._succeeded(endpoint, ttft=ttft, tokens_per_sec=tokens_per_sec)
+        elif isinstance(error, Exception):
+            self._failed(endpoint, error, self.endpoints)
+        else:
+            endpoint.release()
+
 
 class LLMClient:
     def __init__(self):
         # Updated to use LOGIC_ config variables
-        if Config.LOGIC_API_KEY:
-            self.client = OpenAI(
-                api_key=Config.LOGIC_API_KEY,
-                base_url=Config.LOGIC_BASE_URL
-            )
-            self.model = Config.LOGIC_MODEL
-        else:
-            self.client = None
-            self.model = None
+        self.router = ModelRouter.from_config("logic")
 
     def chat(self, messages, tools=None):
         """
@@ -22,21 +337,22 @@ class LLMClient:
         :param tools: Optional list of tool definitions
         :return: Response object or content string
         """
-        if not self.client:
+        if not self.router.endpoints:
             print("Error: Logic client not initialized.")
             return None
 
         try:
             params = {
-                "model": self.model,
                 "messages": messages,
             }
             # Note: Gemini models via OpenAI compat layer might have different tool support
             # For now we keep it, but be aware 'thinking' models might not support tools in all versions
             if tools:
                 params["tools"] = tools
-                
-            response = self.client.chat.completions.create(**params)
+
+            response = self.router.call(lambda endpoint: model_transport.client(
+                endpoint.api_key, endpoint.base_url
+            ).chat.completions.create(model=endpoint.model, **params), tokens=estimate_tokens(messages, tools))
             return response.choices[0].message
         except Exception as e:
             print(f"Error calling Logic API: {e}")
@@ -47,22 +363,203 @@ class LLMClient:
         Stream a chat completion request.
         Yields chunks of the response.
         """
-        if not self.client:
+        if not self.router.endpoints:
             yield None
             return
 
         try:
             params = {
-                "model": self.model,
                 "messages": messages,
                 "stream": True
             }
             if tools:
                 params["tools"] = tools
-                
-            stream = self.client.chat.completions.create(**params)
+
+            stream = self.router.call(lambda endpoint: model_transport.client(
+                endpoint.api_key, endpoint.base_url
+            ).chat.completions.create(model=endpoint.model, **params), tokens=estimate_tokens(messages, tools))
             for chunk in stream:
                 yield chunk
         except Exception as e:
             print(f"Error calling Logic API (Stream): {e}")
             yield None
+
+
+class AsyncLLMClient:
+    """
+    LLMClient 的异步版本，基于 AsyncOpenAI。
+    等待模型响应时不会阻塞事件循环，供 server.py 中的异步 Agent 引擎使用。
+    连接池、超时、重试和对冲由 model_transport 统一处理；配置了多个端点时由 ModelRouter 选择端点并切换。
+
+    tier 为模型级联中的层级："thinking" 使用 LOGIC_* 配置的思考模型，"fast" 使用 LOGIC_FAST_* 配置的快速模型。
+    """
+    def __init__(self, tier: str = "thinking"):
+        self.tier = tier
+        self.router = ModelRouter.from_config("logic_fast" if tier == "fast" else "logic")
+        # 累计用量，cached_tokens 为命中服务商前缀缓存的输入 token 数
+        self.usage_totals = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+    @staticmethod
+    def _create(params):
+        """返回向指定端点发起一次请求的函数。"""
+        def create(endpoint: ModelEndpoint):
+            client = model_transport.async_client(endpoint.api_key, endpoint.base_url)
+            return client.chat.completions.create(model=endpoint.model, **params)
+        return create
+
+    def _record_usage(self, usage):
+        """累计并打印一次请求的用量，用于观察前缀缓存命中率。"""
+        if not usage:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+        totals = self.usage_totals
+        totals["requests"] += 1
+        totals["prompt_tokens"] += prompt_tokens
+        totals["cached_tokens"] += cached_tokens
+        totals["completion_tokens"] += completion_tokens
+        LLM_TIER_TOKENS.inc(prompt_tokens, tier=self.tier, kind="prompt")
+        LLM_TIER_TOKENS.inc(cached_tokens, tier=self.tier, kind="cached")
+        LLM_TIER_TOKENS.inc(completion_tokens, tier=self.tier, kind="completion")
+
+        hit_rate = cached_tokens / prompt_tokens * 100 if prompt_tokens else 0
+        total_rate = totals["cached_tokens"] / totals["prompt_tokens"] * 100 if totals["prompt_tokens"] else 0
+        print(f"LLM usage ({self.tier}): prompt={prompt_tokens} cached={cached_tokens} ({hit_rate:.0f}%) "
+              f"completion={completion_tokens} | total cache hit {total_rate:.0f}%")
+
+    def _cache_key(self, params):
+        return llm_cache.make_key(self.router.models, params["messages"], params.get("tools"),
+                                  params.get("temperature"))
+
+    async def chat(self, messages, tools=None, cache=False):
+        """
+        Async chat completion request.
+
+        :param messages: List of message dicts (role, content)
+        :param tools: Optional list of tool definitions
+        :param cache: Use the on-disk response cache (see core/llm_cache.py)
+        :return: Response message or None on error
+        """
+        if not self.router.endpoints:
+            print("Error: Logic client not initialized.")
+            return None
+
+        try:
+            params = {
+                "messages": messages,
+            }
+            if tools:
+                params["tools"] = tools
+
+            key = self._cache_key(params) if cache else None
+            if key:
+                entry = await llm_cache.aget(key)
+                if entry is not None:
+                    return cached_message(entry)
+
+            estimated = estimate_tokens(messages, tools)
+            start = time.perf_counter()
+            endpoint, response = await self.router.acall(self._create(params), tokens=estimated)
+            elapsed = time.perf_counter() - start
+            usage = getattr(response, "usage", None)
+            self._record_usage(usage)
+            if usage:
+                rate_limiter.settle(endpoint.base_url, estimated, getattr(usage, "total_tokens", 0) or 0)
+            record_span("llm_request", elapsed, stream=False, endpoint=endpoint.name, tier=self.tier)
+            LLM_TIER_REQUEST_SECONDS.observe(elapsed, tier=self.tier, stream="false")
+            completion_tokens = getattr(usage, "completion_tokens", 0) if usage else 0
+            if completion_tokens and elapsed > 0:
+                LLM_TOKENS_PER_SECOND.observe(completion_tokens / elapsed)
+            message = response.choices[0].message
+            if key and (message.content or message.tool_calls):
+                await llm_cache.aput(key, message.model_dump(exclude_none=True), {
+                    "prompt_tokens": (getattr(usage, "prompt_tokens", 0) or 0) if usage else 0,
+                    "completion_tokens": completion_tokens or 0,
+                })
+            return message
+        except Exception as e:
+            print(f"Error calling Logic API: {e}")
+            return None
+
+    async def chat_stream(self, messages, tools=None, cache=False):
+        """
+        Async stream of a chat completion request.
+        Yields chunks of the response (None on error).
+        Cached responses are replayed as synthetic chunks.
+        """
+        if not self.router.endpoints:
+            yield None
+            return
+
+        try:
+            params = {
+                "messages": messages,
+                "stream": True
+            }
+            if Config.LOGIC_STREAM_USAGE:
+                # 最后一个 chunk 携带本次请求的 usage（choices 为空）
+                params["stream_options"] = {"include_usage": True}
+            if tools:
+                params["tools"] = tools
+
+            key = self._cache_key(params) if cache else None
+            if key:
+                entry = await llm_cache.aget(key)
+                if entry is not None:
+                    for chunk in replay_chunks(entry, self.router.models):
+                        yield chunk
+                    return
+            recorder = StreamRecorder() if key else None
+
+            start = time.perf_counter()
+            first_token_at = None
+            # 没有 usage 时以输出的 chunk 数近似 token 数
+            output_chunks = 0
+            completion_tokens = 0
+            prompt_tokens = 0
+            estimated = estimate_tokens(messages, tools)
+            endpoint, stream, ttft = await self.router.open_stream(self._create(params), tokens=estimated)
+            error = None
+            tokens_per_sec = None
+            try:
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        self._record_usage(chunk.usage)
+                        completion_tokens = getattr(chunk.usage, "completion_tokens", 0) or 0
+                        prompt_tokens = getattr(chunk.usage, "prompt_tokens", 0) or 0
+                    if recorder is not None:
+                        recorder.add(chunk)
+                    if chunk.choices and (chunk.choices[0].delta.content or chunk.choices[0].delta.tool_calls):
+                        output_chunks += 1
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            record_span("llm_ttft", first_token_at - start, endpoint=endpoint.name, tier=self.tier)
+                            LLM_TIER_TTFT.observe(first_token_at - start, tier=self.tier)
+                    yield chunk
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                # 提前退出（例如请求被取消）时关闭上游连接，服务商随即停止生成
+                await stream.aclose()
+                end = time.perf_counter()
+                record_span("llm_request", end - start, stream=True, endpoint=endpoint.name, tier=self.tier)
+                LLM_TIER_REQUEST_SECONDS.observe(end - start, tier=self.tier, stream="true")
+                tokens = completion_tokens or output_chunks
+                if first_token_at is not None and tokens > 1 and end > first_token_at:
+                    tokens_per_sec = tokens / (end - first_token_at)
+                    LLM_TOKENS_PER_SECOND.observe(tokens_per_sec)
+                self.router.finish_stream(endpoint, ttft, tokens_per_sec, error)
+                if prompt_tokens:
+                    rate_limiter.settle(endpoint.base_url, estimated, prompt_tokens + completion_tokens)
+            # 只缓存完整结束的响应
+            if recorder is not None and recorder.complete:
+                await llm_cache.aput(key, recorder.message(), {
+                    "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens or output_chunks
+                })
+        except Exception as e:
+            print(f"Error calling Logic API (Stream): {e}")
+            yield None
@@ -0,0 +1,237 @@
+import json
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+from config import Config
+
+# 默认耗时分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Histogram:
+    """Prometheus 直方图：按标签组合分别累计各分桶计数、总和与次数。"""
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各分桶计数..., sum, count]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [0] * (len(self.buckets) + 2)
+                self._series[key] = series
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, ("le", "+Inf"))
+            lines.append(f"{self.name}_bucket{labels} {int(values[-1])}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{labels} {int(values[-1])}")
+        return lines
+
+
+class _Value:
+    """计数器 / 仪表盘的公共实现：按标签组合保存一个数值。"""
+    TYPE = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values[()] = 0
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Value):
+    TYPE = "counter"
+
+
+class Gauge(_Value):
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, cls, name: str, *args):
+        if name not in self._metrics:
+            self._metrics[name] = cls(name, *args)
+        return self._metrics[name]
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def render(self) -> str:
+        """Prometheus 文本格式（text/plain; version=0.0.4）。"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# 各阶段耗时。span 取值见 Trace 的说明；tool 仅在 span="tool" 时有值
+SPAN_SECONDS = registry.histogram(
+    "agent_span_duration_seconds", "Duration of agent loop phases.", ("span", "tool")
+)
+LLM_TOKENS_PER_SECOND = registry.histogram(
+    "agent_llm_tokens_per_second", "Model output speed after the first token.",
+    buckets=(5, 10, 20, 40, 60, 80, 120, 160, 240, 320)
+)
+
+
+# ----------------------------------------------------------------------
+# 单次请求的追踪
+# ----------------------------------------------------------------------
+
+class Trace:
+    """
+    一次用户请求内的全部 span。
+
+    span 名称：llm_request（一次模型请求）、llm_ttft（首 token 延迟）、tool（一次工具调用）、
+    session_load / session_save（会话读写）、vision（图片分析）。
+    每个 span 记录所属会话和 Agent 循环的轮次（turn），汇总后可作为 meta 事件返回给客户端。
+    """
+    def __init__(self, session_id: Optional[str] = None):
+        self.session_id = session_id
+        self.turn = 0
+        self.started = time.perf_counter()
+        self.spans: List[Dict] = []
+
+    def add(self, name: str, duration: float, **attrs):
+        record = {"span": name, "session_id": self.session_id, "turn": self.turn,
+                  "duration_ms": round(duration * 1000, 1), **attrs}
+        self.spans.append(record)
+        if Config.TRACE_LOG_SPANS:
+            print(f"[trace] {json.dumps(record, ensure_ascii=False)}")
+
+    def summary(self) -> Dict:
+        """按 span 名称汇总的耗时：{total_ms, turns, spans: {name: {count, total_ms, max_ms}}}。"""
+        spans: Dict[str, Dict] = {}
+        for record in self.spans:
+            item = spans.setdefault(record["span"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            item["count"] += 1
+            item["total_ms"] = round(item["total_ms"] + record["duration_ms"], 1)
+            item["max_ms"] = max(item["max_ms"], record["duration_ms"])
+        return {
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "turns": self.turn,
+            "spans": spans
+        }
+
+
+# 当前请求的 Trace。asyncio 任务创建时复制上下文，工具调用等子任务共享同一个 Trace
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("agent_trace", default=None)
+
+
+def start_trace(session_id: Optional[str] = None) -> Trace:
+    trace = Trace(session_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def record_span(name: str, duration: float, **attrs):
+    """记录一个已结束的 span：计入直方图，并追加到当前请求的 Trace（如果有）。"""
+    SPAN_SECONDS.observe(duration, span=name, tool=attrs.get("tool", ""))
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, duration, **attrs)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    计时上下文管理器。
+
+    with span("tool", tool="query_mysql"):
+        ...
+    """
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        record_span(name, time.perf_counter() - start, **attrs)
+
+
+def timed(name: str, func, **attrs):
+    """包装一个同步函数，调用时记录 span（用于放到线程池执行的函数）。"""
+    def wrapper(*args, **kwargs):
+        with span(name, **attrs):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,165 @@
+import re
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from config import Config
+from core.llm_client import AsyncLLMClient
+from core.metrics import registry
+
+FAST, THINKING = "fast", "thinking"
+
+CASCADE_DECISIONS = registry.counter(
+    "llm_cascade_decisions_total", "Model requests by the cascade tier chosen and the reason.", ["tier", "reason"]
+)
+AGENT_LOOP_SECONDS = registry.histogram(
+    "agent_loop_seconds", "Duration of the agent model/tool loop by the model tiers it used (fast, thinking, mixed).",
+    ["tiers"]
+)
+
+# 出现这些说法时通常是需要先规划的多步任务
+MULTI_STEP_RE = re.compile(
+    r"步骤|计划|方案|分析|对比|比较|然后|之后再|先.{0,20}再|设计|实现|重构|排查|为什么|原因|优化|写一(个|段|篇|份)|"
+    r"\bplan|\bsteps?\b|analy[sz]|compare|design|implement|debug|\bwhy\b",
+    re.IGNORECASE
+)
+# 工具结果开头出现这些内容时视为调用失败
+TOOL_FAILURE_RE = re.compile(r"^\s*(Error|错误)|^[^\n]{0,20}(出错|失败|错误)")
+
+
+def _names(value: str) -> Set[str]:
+    return {name.strip() for name in value.split(",") if name.strip()}
+
+
+class ModelCascade:
+    """
+    模型级联：Agent 循环的每一步在快速模型和思考模型之间选择。
+
+    第一步（规划）按人格、消息长度、多步任务的说法和本轮提供的工具决定层级，
+    都不命中时使用快速模型（意图判断、闲聊和简单问答）。
+    第一步使用思考模型的运行在工具结果返回后继续使用思考模型；第一步使用快速模型的运行，
+    工具结果返回后提供的工具中没有规划类工具（下一步只是总结结果）时继续使用快速模型，否则改用思考模型。
+    工具调用失败、调用次数累计达到 CASCADE_ESCALATE_TOOL_CALLS，或人格在 CASCADE_THINKING_PERSONAS 中时
+    使用思考模型，且本次运行不再降级。
+    快速模型请求失败时，同一步改用思考模型重新请求。
+    未配置 LOGIC_FAST_MODEL 时所有请求都使用思考模型。
+    """
+    def __init__(self, thinking: AsyncLLMClient, fast: Optional[AsyncLLMClient] = None):
+        self.clients: Dict[str, AsyncLLMClient] = {THINKING: thinking}
+        if fast is not None and fast.router.endpoints:
+            self.clients[FAST] = fast
+        self.thinking_tools = _names(Config.CASCADE_THINKING_TOOLS)
+        self.thinking_personas = _names(Config.CASCADE_THINKING_PERSONAS)
+
+    @property
+    def enabled(self) -> bool:
+        return FAST in self.clients
+
+    def client(self, tier: str) -> AsyncLLMClient:
+        return self.clients.get(tier) or self.clients[THINKING]
+
+    def plan(self, user_text: str, persona: Optional[Dict] = None,
+             offered: Optional[Set[str]] = None) -> Tuple[str, str, bool]:
+        """
+        第一步的层级，返回 (tier, reason, sticky)。sticky 为 True 时整次运行都使用该层级。
+
+        :param offered: 本轮提供给模型的工具名；None 表示全部工具，此时不按工具判断
+        """
+        if not self.enabled:
+            return THINKING, "disabled", True
+        if persona and persona.get("id") in self.thinking_personas:
+            return THINKING, "persona", True
+        user_text = user_text or ""
+        if len(user_text) > Config.CASCADE_FAST_MAX_CHARS:
+            return THINKING, "long_request", False
+        if MULTI_STEP_RE.search(user_text):
+            return THINKING, "multi_step", False
+        if offered is not None and offered & self.thinking_tools:
+            return THINKING, "planning_tools", False
+        return FAST, "simple", False
+
+    def start(self, user_text: str, persona: Optional[Dict] = None,
+              offered: Optional[Set[str]] = None, cache: bool = False) -> "CascadeRun":
+        """为一次 Agent 运行创建级联状态。cache 为 True 时本次运行的模型请求使用响应缓存。"""
+        return CascadeRun(self, *self.plan(user_text, persona, offered), cache=cache)
+
+
+class CascadeRun:
+    """一次 Agent 运行中的级联状态：当前层级、累计的工具调用，以及用过的层级（用于统计）。"""
+    def __init__(self, cascade: ModelCascade, tier: str, reason: str, sticky: bool, cache: bool = False):
+        self.cascade = cascade
+        self.cache = cache
+        self.tier = tier
+        self.reason = reason
+        self.sticky = sticky
+        self.tool_calls = 0
+        self.used: Set[str] = set()
+        self.started = time.perf_counter()
+
+    def _next(self) -> str:
+        CASCADE_DECISIONS.inc(tier=self.tier, reason=self.reason)
+        self.used.add(self.tier)
+        return self.tier
+
+    def escalate(self, reason: str):
+        """改用思考模型，本次运行不再降级。"""
+        if self.tier != THINKING:
+            print(f"Model cascade: escalating to the thinking model ({reason})")
+        self.tier, self.reason, self.sticky = THINKING, reason, True
+
+    async def chat(self, messages, tools=None):
+        """以当前层级发起一次非流式请求；快速模型失败时改用思考模型。"""
+        tier = self._next()
+        response = await self.cascade.client(tier).chat(messages, tools=tools, cache=self.cache)
+        if response is None and tier == FAST:
+            self.escalate("fast_error")
+            response = await self.cascade.client(self._next()).chat(messages, tools=tools, cache=self.cache)
+        return response
+
+    async def chat_stream(self, messages, tools=None):
+        """
+        以当前层级发起一次流式请求。快速模型在输出任何内容之前失败时改用思考模型，
+        已经开始输出后失败则与单一模型时一样产出 None。
+        """
+        tier = self._next()
+        received = False
+        async for chunk in self.cascade.client(tier).chat_stream(messages, tools=tools, cache=self.cache):
+            if chunk is None and tier == FAST and not received:
+                break
+            received = True
+            yield chunk
+        else:
+            return
+        self.escalate("fast_error")
+        async for chunk in self.cascade.client(self._next()).chat_stream(messages, tools=tools, cache=self.cache):
+            yield chunk
+
+    def observe_tools(self, tool_calls: List[Dict], results: List, offered: Optional[Set[str]] = None):
+        """
+        一轮工具调用结束后决定下一步的层级。results 为 (tool_result, parse_error) 列表。
+
+        :param offered: 下一步提供给模型的工具名；None 表示全部工具，此时不按工具判断
+        """
+        self.tool_calls += len(tool_calls)
+        if self.sticky:
+            return
+        called = {tc["function"]["name"] for tc in tool_calls}
+        if any(parse_error or TOOL_FAILURE_RE.search(tool_result or "")
+               for tool_result, parse_error in (r for r in results if r is not None)):
+            self.escalate("tool_error")
+        elif self.tool_calls >= Config.CASCADE_ESCALATE_TOOL_CALLS:
+            self.escalate("tool_count")
+        elif self.tier == THINKING:
+            # 按思考模型规划的运行，下一步可能还要写 SQL/代码，不降级
+            return
+        elif called & self.cascade.thinking_tools:
+            self.escalate("planning_tools")
+        elif offered is not None and offered & self.cascade.thinking_tools:
+            self.tier, self.reason = THINKING, "planning_tools"
+        else:
+            self.reason = "tool_summary"
+
+    def finish(self):
+        """记录本次运行的循环耗时，按用过的层级分组。"""
+        if not self.used:
+            return
+        tiers = "mixed" if len(self.used) > 1 else next(iter(self.used))
+        AGENT_LOOP_SECONDS.observe(time.perf_counter() - self.started, tiers=tiers)
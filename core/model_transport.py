@@ -0,0 +1,299 @@
+import time
+import random
+import asyncio
+import weakref
+import threading
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+from config import Config
+from core.metrics import registry
+
+MODEL_RETRIES = registry.counter(
+    "model_request_retries_total", "Model API requests retried after a transient error.", ["reason"]
+)
+MODEL_FAILURES = registry.counter(
+    "model_request_failures_total", "Model API requests that failed after all retries.", ["reason"]
+)
+MODEL_HEDGES = registry.counter(
+    "model_hedged_requests_total", "Streaming requests that started a hedged second attempt, by which attempt won.", ["winner"]
+)
+
+# 可以重试的错误：限流、服务端错误、连接失败和超时。4xx 参数错误重试也不会成功
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,   # 包含 APITimeoutError
+    asyncio.TimeoutError,
+)
+
+
+class FirstTokenTimeout(asyncio.TimeoutError):
+    """流式请求在 MODEL_FIRST_TOKEN_TIMEOUT 内没有收到第一个 chunk。"""
+
+
+def _error_reason(error: BaseException) -> str:
+    if isinstance(error, FirstTokenTimeout):
+        return "first_token_timeout"
+    if isinstance(error, openai.APIStatusError):
+        return str(error.status_code)
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    return type(error).__name__
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    """429/503 响应中的 Retry-After（秒），没有或无法解析时返回 None。"""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class ModelTransport:
+    """
+    所有模型客户端共用的传输层。
+
+    - 连接池：同一个 base_url 共用一个 httpx 连接池（异步客户端按事件循环分别维护），
+      OpenAI 客户端按 (api_key, base_url) 复用，不再每次调用新建
+    - 超时：连接、读取分别设置上限；流式请求另有首 token 超时
+    - 重试：限流、5xx、连接错误和超时按带抖动的指数退避重试，优先使用服务商返回的 Retry-After；
+      流式请求只在收到第一个 chunk 之前重试，已输出的内容不会重复
+    - 限流：传入端点的 EndpointLimiter 时，每次发出请求前先等待 RPM/TPM 额度；收到 429 时由限流器暂停整个端点，
+      排队中的请求一起等待，而不是各自退避重试
+    - 对冲：启用 MODEL_HEDGE_ENABLED 时，流式请求的首 token 等待超过近期 TTFT 的
+      MODEL_HEDGE_PERCENTILE 分位数仍未到达，就并行发起第二次请求，先返回首 token 的一方胜出，另一方关闭
+    OpenAI SDK 自带的重试关闭（max_retries=0），统一由这里处理。
+    """
+    # 每个 base_url 保留的近期 TTFT 样本数
+    TTFT_WINDOW = 200
+
+    def __init__(self):
+        self.timeout = httpx.Timeout(
+            connect=Config.MODEL_CONNECT_TIMEOUT, read=Config.MODEL_READ_TIMEOUT,
+            write=Config.MODEL_READ_TIMEOUT, pool=Config.MODEL_CONNECT_TIMEOUT
+        )
+        self.limits = httpx.Limits(
+            max_connections=Config.MODEL_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.MODEL_POOL_MAX_CONNECTIONS,
+            keepalive_expiry=Config.MODEL_POOL_KEEPALIVE
+        )
+        self.max_retries = Config.MODEL_MAX_RETRIES
+        self._lock = threading.Lock()
+        self._http: Dict[str, httpx.Client] = {}
+        self._clients: Dict[Tuple[str, str], OpenAI] = {}
+        # 事件循环 -> {"http": {base_url: AsyncClient}, "clients": {(api_key, base_url): AsyncOpenAI}}
+        self._async = weakref.WeakKeyDictionary()
+        self._ttft: Dict[str, Deque[float]] = {}
+
+    # ------------------------------------------------------------------
+    # 客户端
+    # ------------------------------------------------------------------
+
+    def client(self, api_key: str, base_url: str) -> OpenAI:
+        """同步 OpenAI 客户端，同一个 base_url 共用连接池。"""
+        with self._lock:
+            client = self._clients.get((api_key, base_url))
+            if client is None:
+                http = self._http.get(base_url)
+                if http is None:
+                    http = httpx.Client(timeout=self.timeout, limits=self.limits)
+                    self._http[base_url] = http
+                client = OpenAI(api_key=api_key, base_url=base_url, timeout=self.timeout,
+                                max_retries=0, http_client=http)
+                self._clients[(api_key, base_url)] = client
+            return client
+
+    def async_client(self, api_key: str, base_url: str) -> AsyncOpenAI:
+        """
+        异步 OpenAI 客户端。httpx.AsyncClient 的连接池绑定在创建它的事件循环上，
+        同步包装方法会使用独立的事件循环，因此按循环分别维护。
+        """
+        loop = asyncio.get_running_loop()
+        state = self._async.get(loop)
+        if state is None:
+            state = {"http": {}, "clients": {}}
+            self._async[loop] = state
+        client = state["clients"].get((api_key, base_url))
+        if client is None:
+            http = state["http"].get(base_url)
+            if http is None:
+                http = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+                state["http"][base_url] = http
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=self.timeout,
+                                 max_retries=0, http_client=http)
+            state["clients"][(api_key, base_url)] = client
+        return client
+
+    # ------------------------------------------------------------------
+    # 重试
+    # ------------------------------------------------------------------
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        """第 attempt 次重试前的等待时间：Retry-After 优先，否则为带完全抖动的指数退避。"""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, Config.MODEL_BACKOFF_MAX)
+        ceiling = min(Config.MODEL_BACKOFF_MAX, Config.MODEL_BACKOFF_BASE * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def _retry_delay(self, attempt: int, error: BaseException, limiter) -> float:
+        """
+        重试前的等待时间。有限流器时 429 的暂停交给限流器执行，这里不再单独等待。
+        暂停时间与 _backoff 一样以 MODEL_BACKOFF_MAX 为上限，过大或错误的 Retry-After 不会长时间冻结整个端点。
+        """
+        if limiter is not None and isinstance(error, openai.RateLimitError):
+            retry_after = _retry_after(error)
+            if retry_after is None:
+                retry_after = Config.MODEL_BACKOFF_BASE * (2 ** (attempt - 1))
+            limiter.throttle(min(retry_after, Config.MODEL_BACKOFF_MAX))
+            return 0.0
+        return self._backoff(attempt, error)
+
+    def _should_retry(self, attempt: int, error: BaseException, max_retries: Optional[int]) -> bool:
+        reason = _error_reason(error)
+        limit = self.max_retries if max_retries is None else max_retries
+        if not isinstance(error, RETRYABLE_ERRORS) or attempt > limit:
+            MODEL_FAILURES.inc(reason=reason)
+            return False
+        MODEL_RETRIES.inc(reason=reason)
+        print(f"Model request failed ({reason}), retry {attempt}/{limit}")
+        return True
+
+    def call(self, request: Callable, max_retries: Optional[int] = None, limiter=None, tokens: int = 0):
+        """
+        同步执行 request()，遇到可重试的错误时退避重试。max_retries 默认为 MODEL_MAX_RETRIES。
+        limiter 为目标端点的 EndpointLimiter，tokens 为本次请求预估的 token 数。
+        """
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire(tokens)
+            try:
+                return request()
+            except Exception as e:
+                attempt += 1
+                if not self._should_retry(attempt, e, max_retries):
+                    raise
+                time.sleep(self._retry_delay(attempt, e, limiter))
+
+    async def acall(self, request: Callable[[], Awaitable], max_retries: Optional[int] = None,
+                    limiter=None, tokens: int = 0):
+        """异步执行 await request()，遇到可重试的错误时退避重试。"""
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await limiter.aacquire(tokens)
+            try:
+                return await request()
+            except Exception as e:
+                attempt += 1
+                if not self._should_retry(attempt, e, max_retries):
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt, e, limiter))
+
+    # ------------------------------------------------------------------
+    # 流式请求
+    # ------------------------------------------------------------------
+
+    def _record_ttft(self, key: str, ttft: float):
+        samples = self._ttft.get(key)
+        if samples is None:
+            samples = deque(maxlen=self.TTFT_WINDOW)
+            self._ttft[key] = samples
+        samples.append(ttft)
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """发起对冲请求前等待首 token 的时间；未启用或样本不足时返回 None。"""
+        if not Config.MODEL_HEDGE_ENABLED:
+            return None
+        samples = self._ttft.get(key)
+        if not samples or len(samples) < Config.MODEL_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * Config.MODEL_HEDGE_PERCENTILE))
+        return max(Config.MODEL_HEDGE_MIN_DELAY, ordered[index])
+
+    async def _open_once(self, request: Callable[[], Awaitable], key: str, limiter=None, tokens: int = 0):
+        """发起一次流式请求并等到第一个 chunk，返回 (stream, iterator, first_chunk)。"""
+        if limiter is not None:
+            await limiter.aacquire(tokens)
+        start = time.perf_counter()
+        stream = await request()
+        iterator = stream.__aiter__()
+        try:
+            try:
+                first = await asyncio.wait_for(iterator.__anext__(), Config.MODEL_FIRST_TOKEN_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise FirstTokenTimeout(f"No first token within {Config.MODEL_FIRST_TOKEN_TIMEOUT}s")
+            except StopAsyncIteration:
+                first = None
+        except BaseException:
+            await stream.close()
+            raise
+        self._record_ttft(key, time.perf_counter() - start)
+        return stream, iterator, first
+
+    async def _open_hedged(self, request: Callable[[], Awaitable], key: str, limiter=None, tokens: int = 0):
+        primary = asyncio.ensure_future(self._open_once(request, key, limiter, tokens))
+        delay = self.hedge_delay(key)
+        if delay is None:
+            return await primary
+        tasks = [primary]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                tasks.append(asyncio.ensure_future(self._open_once(request, key, limiter, tokens)))
+                pending = set(tasks)
+                while pending and winner is None:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    winner = next((t for t in tasks if t in done and t.exception() is None), None)
+                if winner is not None:
+                    MODEL_HEDGES.inc(winner="primary" if winner is primary else "backup")
+            # 两次都失败时抛出首次请求的错误
+            return (winner or primary).result()
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif winner is not None and not task.cancelled() and task.exception() is None:
+                    # 落后的一方也拿到了首 token，关闭它的连接
+                    await task.result()[0].close()
+
+    async def stream(self, request: Callable[[], Awaitable], key: str, max_retries: Optional[int] = None,
+                     limiter=None, tokens: int = 0):
+        """
+        流式请求的异步生成器。request() 发起一次请求并返回 AsyncStream，重试和对冲时会被多次调用。
+        key 用于区分 TTFT 样本（通常为 base_url）。
+        """
+        attempt = 0
+        while True:
+            try:
+                stream, iterator, first = await self._open_hedged(request, key, limiter, tokens)
+                break
+            except Exception as e:
+                attempt += 1
+                if not self._should_retry(attempt, e, max_retries):
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt, e, limiter))
+        try:
+            if first is not None:
+                yield first
+            async for chunk in iterator:
+                yield chunk
+        finally:
+            # 提前退出（例如请求被取消）时关闭上游连接，服务商随即停止生成
+            await stream.close()
+
+
+model_transport = ModelTransport()
@@ -0,0 +1,245 @@
+import time
+import asyncio
+import threading
+import contextvars
+from typing import Dict, List, Optional
+from config import Config
+from core.context_builder import count_message_tokens, count_tokens
+from core.metrics import registry
+
+RATE_LIMIT_WAIT_SECONDS = registry.histogram(
+    "model_rate_limit_wait_seconds", "Time model requests waited for the client-side rate limiter.",
+    ["endpoint", "priority"], buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+RATE_LIMIT_QUEUE = registry.gauge(
+    "model_rate_limit_queue", "Model requests waiting for the client-side rate limiter.", ["endpoint"]
+)
+RATE_LIMIT_THROTTLED = registry.counter(
+    "model_rate_limit_throttled_total", "429 responses that paused an endpoint's rate limiter.", ["endpoint"]
+)
+
+INTERACTIVE, BACKGROUND = "interactive", "background"
+# 请求中每张图片按该 token 数估算
+IMAGE_INPUT_TOKENS = 1000
+
+# 当前请求的优先级。用户对话为 interactive，回合结束后的摘要等后台任务设为 background
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+
+
+def set_request_priority(priority: str):
+    _priority.set(priority)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+def estimate_tokens(messages: List[Dict], tools: Optional[List] = None, completion_tokens: Optional[int] = None) -> int:
+    """按发出的消息估算一次请求占用的 TPM 额度：输入 token + 工具定义 + 预计的输出 token。"""
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            # 多模态消息：文本部分计数，图片按固定值估算
+            for part in content:
+                if part.get("type") == "text":
+                    tokens += count_tokens(part.get("text", ""))
+                else:
+                    tokens += IMAGE_INPUT_TOKENS
+            message = {**message, "content": None}
+        tokens += count_message_tokens(message)
+    if tools:
+        tokens += sum(count_tokens(str(tool)) for tool in tools)
+    return tokens + (Config.MODEL_RATE_LIMIT_COMPLETION_TOKENS if completion_tokens is None else completion_tokens)
+
+
+class TokenBucket:
+    """令牌桶：按每分钟的额度匀速补充，最多积累 burst_seconds 秒的额度。额度可以为负（实际用量超出预估）。"""
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float) -> float:
+        """额度达到 amount 还需等待的秒数。amount 超过容量时按容量计算，大请求不会永远等待。"""
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float):
+        self.level -= amount
+
+
+class _Waiter:
+    def __init__(self, tokens: int, priority: str, loop: Optional[asyncio.AbstractEventLoop]):
+        self.tokens = tokens
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        # 后台请求按晚到 MODEL_RATE_LIMIT_BACKGROUND_DELAY 秒排序：交互请求优先，后台请求也不会一直等下去
+        self.rank = self.enqueued_at + (Config.MODEL_RATE_LIMIT_BACKGROUND_DELAY if priority == BACKGROUND else 0)
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else threading.Event()
+
+    def wake(self):
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.event.set)
+            except RuntimeError:
+                # 事件循环已关闭（同步包装的临时循环），等待方已不存在
+                pass
+        else:
+            self.event.set()
+
+
+class EndpointLimiter:
+    """
+    一个端点（base_url）的客户端限流：请求数（RPM）和 token 数（TPM）两个令牌桶。
+
+    额度不足时请求排队而不是发出后收到 429。排在队首的请求等待额度补足，其余请求等待被唤醒；
+    队列按优先级和到达时间排序。同步客户端（线程中）和异步客户端共用同一个队列。
+    收到 429 时整个端点暂停 Retry-After 秒，排队的请求一起等待，避免重试风暴。
+    """
+    # 非队首的请求在没有被唤醒时重新检查的间隔（秒），只是兜底
+    IDLE_POLL = 1.0
+
+    def __init__(self, key: str, rpm: float, tpm: float, burst_seconds: Optional[float] = None):
+        burst_seconds = Config.MODEL_RATE_LIMIT_BURST_SECONDS if burst_seconds is None else burst_seconds
+        self.key = key
+        self.requests = TokenBucket(rpm, burst_seconds) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm, burst_seconds) if tpm > 0 else None
+        self.blocked_until = 0.0
+        self._waiters: List[_Waiter] = []
+        self._lock = threading.Lock()
+
+    def _head(self) -> Optional[_Waiter]:
+        return min(self._waiters, key=lambda w: w.rank) if self._waiters else None
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        waits = [self.blocked_until - now]
+        for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+            if bucket is not None:
+                bucket.refill(now)
+                waits.append(bucket.time_until(amount))
+        return max(waits)
+
+    def _poll(self, waiter: _Waiter) -> Optional[float]:
+        """轮到该请求且额度足够时扣减额度并返回 None，否则返回需要等待的秒数。"""
+        with self._lock:
+            if waiter is not self._head():
+                return self.IDLE_POLL
+            wait = self._wait_time(waiter.tokens, time.monotonic())
+            if wait > 0:
+                return wait
+            for bucket, amount in ((self.requests, 1), (self.tokens, waiter.tokens)):
+                if bucket is not None:
+                    bucket.take(min(amount, bucket.capacity))
+            self._remove(waiter)
+        RATE_LIMIT_WAIT_SECONDS.observe(time.monotonic() - waiter.enqueued_at, endpoint=self.key, priority=waiter.priority)
+        return None
+
+    def _enqueue(self, tokens: int, loop=None) -> _Waiter:
+        waiter = _Waiter(tokens, current_priority(), loop)
+        with self._lock:
+            self._waiters.append(waiter)
+            RATE_LIMIT_QUEUE.set(len(self._waiters), endpoint=self.key)
+        return waiter
+
+    def _remove(self, waiter: _Waiter):
+        """持锁调用。移出队列并唤醒新的队首。"""
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            RATE_LIMIT_QUEUE.set(len(self._waiters), endpoint=self.key)
+            head = self._head()
+            if head is not None:
+                head.wake()
+
+    def acquire(self, tokens: int):
+        """同步等待额度（在线程中调用）。"""
+        waiter = self._enqueue(tokens)
+        try:
+            while True:
+                delay = self._poll(waiter)
+                if delay is None:
+                    return
+                waiter.event.wait(delay)
+                waiter.event.clear()
+        finally:
+            with self._lock:
+                self._remove(waiter)
+
+    async def aacquire(self, tokens: int):
+        """异步等待额度。被取消时离开队列。"""
+        waiter = self._enqueue(tokens, asyncio.get_running_loop())
+        try:
+            while True:
+                delay = self._poll(waiter)
+                if delay is None:
+                    return
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                waiter.event.clear()
+        finally:
+            with self._lock:
+                self._remove(waiter)
+
+    def settle(self, delta: int):
+        """请求结束后按实际用量修正 TPM 额度：delta 为实际 token 数减去预估值。"""
+        if self.tokens is None or not delta:
+            return
+        with self._lock:
+            self.tokens.refill(time.monotonic())
+            self.tokens.take(delta)
+            self.tokens.level = min(self.tokens.level, self.tokens.capacity)
+
+    def throttle(self, seconds: float):
+        """服务商返回 429：暂停该端点 seconds 秒并清空请求额度。"""
+        RATE_LIMIT_THROTTLED.inc(endpoint=self.key)
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            if self.requests is not None:
+                self.requests.level = min(self.requests.level, 0)
+
+
+class RateLimiter:
+    """
+    按端点（base_url）管理 EndpointLimiter，逻辑、视觉和图像生成请求只要发往同一个端点就共用额度。
+
+    MODEL_RATE_LIMITS 为分号分隔的 "base_url|rpm|tpm"，未列出的端点使用 MODEL_RPM / MODEL_TPM，
+    两者为 0 表示不限制。
+    """
+    def __init__(self, spec: Optional[str] = None, default_rpm: Optional[float] = None,
+                 default_tpm: Optional[float] = None):
+        spec = Config.MODEL_RATE_LIMITS if spec is None else spec
+        self.default_rpm = Config.MODEL_RPM if default_rpm is None else default_rpm
+        self.default_tpm = Config.MODEL_TPM if default_tpm is None else default_tpm
+        self.limits: Dict[str, tuple] = {}
+        for entry in (spec or "").split(";"):
+            parts = [part.strip() for part in entry.split("|")]
+            if len(parts) >= 2 and parts[0]:
+                rpm = float(parts[1] or 0)
+                tpm = float(parts[2] or 0) if len(parts) > 2 else 0.0
+                self.limits[parts[0].rstrip("/")] = (rpm, tpm)
+        self._limiters: Dict[str, Optional[EndpointLimiter]] = {}
+        self._lock = threading.Lock()
+
+    def for_endpoint(self, base_url: str) -> Optional[EndpointLimiter]:
+        """该端点的限流器；没有配置限制时返回 None。"""
+        key = (base_url or "").rstrip("/")
+        with self._lock:
+            if key not in self._limiters:
+                rpm, tpm = self.limits.get(key, (self.default_rpm, self.default_tpm))
+                self._limiters[key] = EndpointLimiter(key, rpm, tpm) if rpm > 0 or tpm > 0 else None
+            return self._limiters[key]
+
+    def settle(self, base_url: str, estimated: int, actual: Optional[int]):
+        limiter = self.for_endpoint(base_url)
+        if limiter is not None and actual:
+            limiter.settle(actual - estimated)
+
+
+rate_limiter = RateLimiter()
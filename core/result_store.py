@@ -0,0 +1,218 @@
+import os
+import re
+import json
+import time
+import shutil
+import secrets
+import contextvars
+from typing import Dict, List, Optional, Tuple
+from config import Config
+
+# 句柄格式：res_ + 12 位十六进制，读取时校验格式，防止路径穿越
+_HANDLE_RE = re.compile(r"^res_[0-9a-f]{12}$")
+# 会话 ID 只允许这些字符出现在目录名中
+_SESSION_RE = re.compile(r"^[\w-]+$")
+# 关键词搜索最多返回的匹配行数，以及每行最多显示的字符数
+GREP_MAX_MATCHES = 50
+GREP_LINE_CHARS = 300
+# 正则由模型给出，在工具线程中执行：每行只匹配前这么多字符，并拒绝嵌套量词（如 (a+)+），避免灾难性回溯占住线程
+GREP_REGEX_LINE_CHARS = 1000
+_NESTED_QUANTIFIER_RE = re.compile(r"\((?:\\.|[^()\\])*[+*{](?:\\.|[^()\\])*\)[+*{]")
+
+# 当前请求所属的会话。read_result 工具只能读取本会话的结果
+_current_session: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("result_session", default=None)
+
+
+def set_result_session(session_id: Optional[str]):
+    _current_session.set(session_id)
+
+
+def current_result_session() -> Optional[str]:
+    return _current_session.get()
+
+
+def _as_rows(text: str) -> Optional[List]:
+    """结果是 JSON 数组（例如 SQL 查询结果）时返回各行，否则返回 None。"""
+    if not text.lstrip().startswith("["):
+        return None
+    try:
+        rows = json.loads(text)
+    except ValueError:
+        return None
+    return rows if isinstance(rows, list) else None
+
+
+class ResultStore:
+    """
+    超长工具结果的会话级存档。
+
+    工具结果超过 inline_chars 时全文写入 <base_dir>/<session_id>/<handle>.txt，
+    写入会话历史（即发送给模型）的只有开头的预览、体积统计和句柄，模型需要更多内容时
+    调用 read_result 工具按页、按行范围或按关键词读取。
+    JSON 数组结果按"每行一条记录"存储，行号即记录序号，按行读取和搜索都以记录为单位。
+    """
+    def __init__(self, base_dir: Optional[str] = None, inline_chars: Optional[int] = None,
+                 page_chars: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.base_dir = base_dir or Config.TOOL_RESULT_DIR
+        self.inline_chars = inline_chars or Config.TOOL_RESULT_INLINE_CHARS
+        self.page_chars = page_chars or Config.TOOL_RESULT_PAGE_CHARS
+        self.max_bytes = max_bytes or Config.TOOL_RESULT_MAX_BYTES
+
+    def _session_dir(self, session_id: str) -> str:
+        if not session_id or not _SESSION_RE.match(session_id):
+            raise ValueError(f"Invalid session id: {session_id!r}")
+        return os.path.join(self.base_dir, session_id)
+
+    def _paths(self, session_id: str, handle: str) -> Tuple[str, str]:
+        base = os.path.join(self._session_dir(session_id), handle)
+        return base + ".txt", base + ".json"
+
+    def has_results(self, session_id: Optional[str]) -> bool:
+        try:
+            return bool(session_id) and os.path.isdir(self._session_dir(session_id))
+        except ValueError:
+            return False
+
+    # ------------------------------------------------------------------
+    # 写入
+    # ------------------------------------------------------------------
+
+    def archive(self, session_id: str, tool: str, result: str) -> str:
+        """
+        需要时存档结果，返回写入会话历史的内容：未超长时原样返回，否则为预览 + 句柄说明。
+        存档失败时退回到截断。
+        """
+        if len(result) <= self.inline_chars:
+            return result
+        rows = _as_rows(result)
+        text = "\n".join(json.dumps(row, ensure_ascii=False, default=str) for row in rows) if rows is not None else result
+        truncated = False
+        if len(text.encode("utf-8")) > self.max_bytes:
+            text = text.encode("utf-8")[:self.max_bytes].decode("utf-8", errors="ignore")
+            truncated = True
+        meta = {
+            "tool": tool,
+            "chars": len(text),
+            "lines": text.count("\n") + 1,
+            "rows": len(rows) if rows is not None else None,
+            "truncated": truncated,
+            "created_at": time.time(),
+        }
+        handle = "res_" + secrets.token_hex(6)
+        try:
+            text_path, meta_path = self._paths(session_id, handle)
+            os.makedirs(os.path.dirname(text_path), exist_ok=True)
+            with open(text_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+        except (OSError, ValueError) as e:
+            print(f"存档工具结果出错: {e}")
+            return result[:self.inline_chars] + "\n...(Output truncated due to length)..."
+        return self._preview(handle, text, meta)
+
+    def _preview(self, handle: str, text: str, meta: Dict) -> str:
+        budget = self.inline_chars
+        head = text[:budget]
+        # 在行边界处截断预览，避免半行 JSON
+        cut = head.rfind("\n")
+        if cut > budget // 2:
+            head = head[:cut]
+        shown_lines = head.count("\n") + 1
+        if meta["rows"] is not None:
+            size = f"共 {meta['rows']} 行记录（每行一条 JSON），{meta['chars']} 字符，已显示前 {shown_lines} 行"
+        else:
+            size = f"共 {meta['lines']} 行，{meta['chars']} 字符，已显示前 {len(head)} 字符"
+        note = "（原始结果超过存档上限，已截断）" if meta["truncated"] else ""
+        pages = (meta["chars"] + self.page_chars - 1) // self.page_chars
+        return (
+            f"{head}\n...\n"
+            f"[结果过长，全文已存档] handle={handle}，{size}，按每页 {self.page_chars} 字符共 {pages} 页{note}。\n"
+            f"需要其余内容时调用 read_result：指定 page、start_line/end_line 或 pattern（关键词，regex=true 时为正则），不要重复执行原工具。"
+        )
+
+    # ------------------------------------------------------------------
+    # 读取
+    # ------------------------------------------------------------------
+
+    def load(self, session_id: str, handle: str) -> Tuple[str, Dict]:
+        if not _HANDLE_RE.match(handle or ""):
+            raise KeyError(handle)
+        text_path, meta_path = self._paths(session_id, handle)
+        try:
+            with open(text_path, "r", encoding="utf-8") as f:
+                text = f.read()
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except OSError:
+            raise KeyError(handle)
+        return text, meta
+
+    def page(self, text: str, page: int) -> str:
+        pages = max(1, (len(text) + self.page_chars - 1) // self.page_chars)
+        if page < 1 or page > pages:
+            return f"错误: 页码超出范围（共 {pages} 页）。"
+        start = (page - 1) * self.page_chars
+        return f"[第 {page}/{pages} 页]\n{text[start:start + self.page_chars]}"
+
+    def lines(self, text: str, start_line: int, end_line: Optional[int]) -> str:
+        """第 start_line 到 end_line 行（从 1 开始，含两端），超出单页字符数时在整行处截断。"""
+        all_lines = text.split("\n")
+        total = len(all_lines)
+        start = max(1, start_line)
+        end = min(total, end_line if end_line is not None else total)
+        if start > total:
+            return f"错误: 起始行超出范围（共 {total} 行）。"
+        out, size, last = [], 0, start - 1
+        for number in range(start, end + 1):
+            line = all_lines[number - 1]
+            if out and size + len(line) + 1 > self.page_chars:
+                break
+            out.append(line[:self.page_chars])
+            size += len(line) + 1
+            last = number
+        more = f"，下一次可从第 {last + 1} 行继续" if last < end else ""
+        return f"[第 {start}-{last} 行，共 {total} 行{more}]\n" + "\n".join(out)
+
+    def grep(self, text: str, pattern: str, regex: bool = False) -> str:
+        """
+        返回包含 pattern 的行（带行号），不区分大小写。
+        regex 为 True 时按正则匹配，每行只匹配前 GREP_REGEX_LINE_CHARS 个字符。
+        """
+        if regex:
+            if _NESTED_QUANTIFIER_RE.search(pattern):
+                return "错误: 正则表达式包含嵌套量词（例如 (a+)+），请简化后重试，或改用关键词搜索。"
+            try:
+                compiled = re.compile(pattern, re.IGNORECASE)
+            except re.error as e:
+                return f"错误: 正则表达式无效: {e}"
+
+            def match(line):
+                return compiled.search(line[:GREP_REGEX_LINE_CHARS])
+        else:
+            needle = pattern.lower()
+
+            def match(line):
+                return needle in line.lower()
+        matches, total, size = [], 0, 0
+        for number, line in enumerate(text.split("\n"), 1):
+            if match(line):
+                total += 1
+                snippet = line if len(line) <= GREP_LINE_CHARS else line[:GREP_LINE_CHARS] + "..."
+                entry = f"{number}: {snippet}"
+                if len(matches) < GREP_MAX_MATCHES and size + len(entry) <= self.page_chars:
+                    matches.append(entry)
+                    size += len(entry) + 1
+        if not matches:
+            return f"没有匹配 '{pattern}' 的行。"
+        more = f"，只显示前 {GREP_MAX_MATCHES} 条" if total > len(matches) else ""
+        return f"[匹配 {total} 行{more}]\n" + "\n".join(matches)
+
+    def delete_session(self, session_id: str):
+        try:
+            shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+        except ValueError:
+            pass
+
+
+result_store = ResultStore()
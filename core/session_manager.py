@@ -2,15 +2,61 @@ import os
 import json
 import time
 import uuid
+import atexit
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import List, Dict, Optional
+from config import Config
+from core.session_store import SessionStore, create_session_store
+from core.session_search import SessionSearchIndex
+from core.result_store import result_store
 
 class SessionManager:
-    def __init__(self, storage_dir: str = "data/sessions"):
+    """
+    会话管理。
+
+    活跃会话保存在内存工作集中，add_message 只修改内存并把新消息追加到 journal，
+    新增的消息在回合结束（flush）或后台定时器触发时批量写入存储后端，
+    进程被杀死时未写回的消息可以从 journal 中恢复。
+    持有 _lock 时只做内存操作和 journal 追加，读写存储后端都在锁外进行，
+    事件循环上的调用不会等待线程池中的磁盘 I/O。
+    """
+    def __init__(self, storage_dir: str = "data/sessions", flush_interval: Optional[float] = None,
+                 store: Optional[SessionStore] = None):
         self.storage_dir = storage_dir
         os.makedirs(self.storage_dir, exist_ok=True)
+        self.store = store or create_session_store(Config.SESSION_BACKEND, storage_dir)
+
+        # 内存工作集: session_id -> session，按最近访问排序
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        self.cache_size = Config.SESSION_CACHE_SIZE
+        # 每个会话中已经写入存储后端的消息数
+        self._persisted: Dict[str, int] = {}
+        # 已修改但尚未写回磁盘的会话
+        self._dirty = set()
+        # 被 update_messages 修改过、尚未写回的消息下标。写回时存储后端只更新其中已持久化的消息
+        # （更新的消息随新消息一起写入）；写回期间被修改的消息留到下一次写回
+        self._patched: Dict[str, set] = {}
+        self._lock = threading.RLock()
+        # 串行化写回，避免定时器与回合结束同时写同一个会话
+        self._flush_lock = threading.Lock()
+
+        # 全文索引：新消息先记在内存中，写回会话时批量写入索引
+        self.search_index = SessionSearchIndex(storage_dir)
+        self._search_pending: Dict[str, List] = {}
+        if self.search_index.available and self.search_index.is_new:
+            threading.Thread(target=self._rebuild_search_index, name="session-search-rebuild", daemon=True).start()
 
-    def _get_file_path(self, session_id: str) -> str:
-        return os.path.join(self.storage_dir, f"{session_id}.json")
+        self.flush_interval = Config.SESSION_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._stop_event = threading.Event()
+        if self.flush_interval > 0:
+            flusher = threading.Thread(target=self._flush_loop, name="session-flusher", daemon=True)
+            flusher.start()
+        atexit.register(self.close)
+
+    def _get_journal_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.journal")
 
     def create_session(self, title: str = "新对话") -> Dict:
         session_id = str(uuid.uuid4())
@@ -22,46 +68,248 @@ class SessionManager:
             "updated_at": now,
             "messages": []
         }
-        self._save_session(session)
+        with self._lock:
+            self._sessions[session_id] = session
+            self._persisted[session_id] = 0
+            self._evict()
+        # 新会话立即落盘，保证会话列表中可见
+        self.store.create(session)
         return session
 
-    def get_session(self, session_id: str) -> Optional[Dict]:
-        file_path = self._get_file_path(session_id)
-        if not os.path.exists(file_path):
-            return None
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"加载会话出错 {session_id}: {e}")
+    def _load_session(self, session_id: str) -> Optional[Dict]:
+        """获取工作集中的会话，不在内存中时从存储后端加载并回放 journal。读盘时不持有锁。"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                return session
+
+        session = self.store.load(session_id)
+        if session is None:
             return None
+        persisted_count = len(session["messages"])
+        patched = set()
+        recovered = self._replay_journal(session, patched)
+
+        with self._lock:
+            # 读盘期间其他线程可能已经加载了同一个会话，以工作集中的为准
+            existing = self._sessions.get(session_id)
+            if existing is not None:
+                self._sessions.move_to_end(session_id)
+                return existing
+            self._persisted[session_id] = persisted_count
+            if patched:
+                self._patched[session_id] = patched
+            if recovered:
+                self._dirty.add(session_id)
+            self._sessions[session_id] = session
+            self._evict()
+            return session
+
+    @contextmanager
+    def _locked_session(self, session_id: str):
+        """在锁外加载会话，然后持有锁产出它；加载后到加锁前会话被淘汰时重新加载。会话不存在时产出 None。"""
+        while True:
+            session = self._load_session(session_id)
+            with self._lock:
+                if session is None or self._sessions.get(session_id) is session:
+                    yield session
+                    return
+
+    def _evict(self):
+        """工作集超出上限时，淘汰最久未访问且已写回磁盘的会话。"""
+        if len(self._sessions) <= self.cache_size:
+            return
+        for sid in list(self._sessions.keys()):
+            if len(self._sessions) <= self.cache_size:
+                break
+            if sid not in self._dirty:
+                del self._sessions[sid]
+                self._persisted.pop(sid, None)
+
+    def _replay_journal(self, session: Dict, patched: set) -> bool:
+        """
+        把 journal 中尚未写入存储的记录应用到会话上。返回是否有记录被恢复。
+        更新了已在存储中的消息时，把下标加入 patched。
+        """
+        journal_path = self._get_journal_path(session["id"])
+        if not os.path.exists(journal_path):
+            return False
+
+        recovered = False
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程在写入半行时被杀死，忽略残缺的最后一行
+                    continue
+                if "header" in record:
+                    session.update(record["header"])
+                    recovered = True
+                    continue
+                seq = record.get("seq", 0)
+                if "patch" in record:
+                    if seq < len(session["messages"]):
+                        session["messages"][seq].update(record["patch"])
+                        patched.add(seq)
+                        recovered = True
+                    continue
+                # seq 是消息在会话中的下标，已写回的记录直接跳过
+                if seq < len(session["messages"]):
+                    continue
+                self._apply_message(session, record["message"])
+                recovered = True
+        return recovered
+
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        with self._locked_session(session_id) as session:
+            if session is None:
+                return None
+            # 返回快照，避免调用方在序列化时与 add_message 并发修改冲突
+            return {**session, "messages": list(session["messages"])}
 
     def list_sessions(self) -> List[Dict]:
+        return self.list_sessions_page()["sessions"]
+
+    def list_sessions_page(self, limit: Optional[int] = None, before: Optional[str] = None,
+                           after: Optional[str] = None) -> Dict:
+        """
+        按 updated_at 降序分页列出会话。
+
+        :param limit: 每页条数，为空时返回全部
+        :param before: 游标，返回比它更旧的一页
+        :param after: 游标，返回比它更新的一页
+        :return: {"sessions": [...], "next_cursor": 更旧一页的游标, "prev_cursor": 更新一页的游标}，
+                 没有更多时游标为 None
+        """
+        before_key, after_key = self._parse_cursor(before), self._parse_cursor(after)
+        # 尚未写回的会话以内存中的会话头为准（updated_at / title 可能比存储中的新），不为列表强制写回
+        with self._lock:
+            pending = {sid: SessionStore.header_of(self._sessions[sid]) for sid in self._dirty if sid in self._sessions}
+        # 多取 len(pending) 条：其中属于未写回会话的旧会话头会被替换掉
+        stored = self.store.list_headers(
+            limit=limit + 1 + len(pending) if limit else None,
+            before=before_key,
+            after=after_key
+        )
+        headers = SessionStore.paginate_headers(
+            [h for h in stored if h.get("id") not in pending] + list(pending.values()),
+            limit=limit + 1 if limit else None, before=before_key, after=after_key
+        )
+        has_more = bool(limit) and len(headers) > limit
+        if has_more:
+            # 多取的一条用于判断是否还有下一页：after 分页时它在最新的一端
+            headers = headers[1:] if after else headers[:limit]
+
         sessions = []
-        if not os.path.exists(self.storage_dir):
-            return []
-            
-        for filename in os.listdir(self.storage_dir):
-            if filename.endswith(".json"):
-                session_id = filename[:-5]
-                session = self.get_session(session_id)
-                if session:
-                    # 仅返回元数据用于列表
-                    sessions.append({
-                        "id": session["id"],
-                        "title": session.get("title", "新对话"),
-                        "created_at": session.get("created_at", 0),
-                        "updated_at": session.get("updated_at", 0)
-                    })
-        # 按 updated_at 降序排序
-        sessions.sort(key=lambda x: x["updated_at"], reverse=True)
-        return sessions
+        for session in headers:
+            if not session.get("id"):
+                continue
+            # 仅返回元数据用于列表
+            sessions.append({
+                "id": session["id"],
+                "title": session.get("title", "新对话"),
+                "created_at": session.get("created_at", 0),
+                "updated_at": session.get("updated_at", 0)
+            })
+        next_cursor = prev_cursor = None
+        if sessions:
+            # 按 after 翻页时游标本身就是更旧的一条，按 before 翻页时同理存在更新的一页
+            older = has_more if not after else True
+            newer = has_more if after else bool(before)
+            if older:
+                next_cursor = self._make_cursor(sessions[-1])
+            if newer:
+                prev_cursor = self._make_cursor(sessions[0])
+        return {"sessions": sessions, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
 
-    def add_message(self, session_id: str, role: str, content: str, **kwargs) -> Optional[Dict]:
-        session = self.get_session(session_id)
-        if not session:
+    @staticmethod
+    def _make_cursor(header: Dict) -> str:
+        return f"{header['updated_at']!r}|{header['id']}"
+
+    @staticmethod
+    def _parse_cursor(cursor: Optional[str]):
+        """游标格式为 "updated_at|id"。"""
+        if not cursor:
             return None
-        
+        updated_at, _, session_id = cursor.partition("|")
+        try:
+            return float(updated_at), session_id
+        except ValueError:
+            raise ValueError(f"Invalid cursor: {cursor}")
+
+    def get_messages(self, session_id: str, limit: Optional[int] = None, before: Optional[int] = None,
+                     after: Optional[int] = None, view: str = "full") -> Optional[Dict]:
+        """
+        按消息下标分页读取会话历史。
+
+        :param limit: 每页条数；没有 after 时返回最新的一页
+        :param before: 只返回下标小于 before 的消息（向上翻页）
+        :param after: 只返回下标大于 after 的消息（向下翻页）
+        :param view: "full" 返回原始消息；"display" 只返回界面需要展示的用户消息和最终回复
+        :return: 会话头 + {"messages": [...], "has_more": 是否还有更早（after 时为更晚）的消息}；
+                 每条消息带有 index 字段，作为下一页的游标
+        """
+        if view not in ("full", "display"):
+            raise ValueError(f"Unknown view: {view}")
+        with self._locked_session(session_id) as session:
+            if session is None:
+                return None
+            header = SessionStore.header_of(session)
+            indexed = list(enumerate(session["messages"]))
+
+        if before is not None:
+            indexed = [(i, m) for i, m in indexed if i < before]
+        if after is not None:
+            indexed = [(i, m) for i, m in indexed if i > after]
+        if view == "display":
+            indexed = [(i, self._display_message(m)) for i, m in indexed if self._is_display_message(m)]
+        else:
+            indexed = [(i, dict(m)) for i, m in indexed]
+
+        has_more = False
+        if limit is not None and len(indexed) > limit:
+            has_more = True
+            indexed = indexed[:limit] if after is not None else indexed[-limit:]
+
+        messages = []
+        for index, message in indexed:
+            message["index"] = index
+            messages.append(message)
+        return {**header, "messages": messages, "has_more": has_more}
+
+    @staticmethod
+    def _is_display_message(message: Dict) -> bool:
+        # 工具结果和发起工具调用的助手消息只在模型上下文中使用，界面不展示
+        if message.get("role") == "user":
+            return True
+        return message.get("role") == "assistant" and not message.get("tool_calls")
+
+    @staticmethod
+    def _display_message(message: Dict) -> Dict:
+        return {
+            "role": message["role"],
+            "content": message.get("content") or "",
+            "timestamp": message.get("timestamp", 0)
+        }
+
+    def _apply_message(self, session: Dict, message: Dict):
+        session["messages"].append(message)
+        session["updated_at"] = message.get("timestamp", time.time())
+
+        # 如果是第一条用户消息且标题为默认值，自动更新标题
+        if len(session["messages"]) == 1 and message["role"] == "user":
+            # 简单的标题生成：前 20 个字符
+            content = message["content"] or ""
+            session["title"] = content[:20] + "..." if len(content) > 20 else content
+
+    def add_message(self, session_id: str, role: str, content: str, **kwargs) -> Optional[Dict]:
+        """
+        向会话追加一条消息。只修改内存工作集并追加 journal，消息在下次写回时批量写入存储后端。
+
+        :return: 会话工作集（调用方只读，不要在外部修改）
+        """
         message = {
             "role": role,
             "content": content,
@@ -69,26 +317,151 @@ class SessionManager:
         }
         # 添加任何其他字段（例如 tool_calls, tool_call_id）
         message.update(kwargs)
-        
-        session["messages"].append(message)
-        session["updated_at"] = time.time()
-        
-        # 如果是第一条用户消息且标题为默认值，自动更新标题
-        if len(session["messages"]) == 1 and role == "user":
-            # 简单的标题生成：前 20 个字符
-            session["title"] = content[:20] + "..." if len(content) > 20 else content
-            
-        self._save_session(session)
+
+        with self._locked_session(session_id) as session:
+            if not session:
+                return None
+
+            seq = len(session["messages"])
+            self._apply_message(session, message)
+            self._append_journal(session_id, {"seq": seq, "message": message})
+            # 新消息和会话头（updated_at / title）在写回时更新
+            self._dirty.add(session_id)
+            self._search_pending.setdefault(session_id, []).append((seq, message))
         return session
 
-    def delete_session(self, session_id: str) -> bool:
-        file_path = self._get_file_path(session_id)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            return True
-        return False
+    def update_message(self, session_id: str, seq: int, **fields) -> bool:
+        """更新会话中第 seq 条消息的部分字段（例如缓存的统计信息）。"""
+        return self.update_messages(session_id, {seq: fields})
+
+    def update_messages(self, session_id: str, patches: Dict[int, Dict]) -> bool:
+        """
+        批量更新多条消息的部分字段。{seq: fields}，只修改内存并写一次 journal，在下次写回时持久化。
+        """
+        with self._locked_session(session_id) as session:
+            if not session:
+                return False
+            messages = session["messages"]
+            patches = {seq: fields for seq, fields in patches.items() if seq < len(messages)}
+            if not patches:
+                return False
+            for seq, fields in patches.items():
+                # 替换而不是原地修改，写回线程序列化快照时不会与这里并发修改同一个字典
+                messages[seq] = {**messages[seq], **fields}
+                # 不论是否已持久化都记录：正在写回的快照中的旧消息在写回完成后即算作已持久化
+                self._patched.setdefault(session_id, set()).add(seq)
+            self._append_journal(session_id, *({"seq": seq, "patch": fields} for seq, fields in patches.items()))
+            self._dirty.add(session_id)
+        return True
+
+    def update_session(self, session_id: str, **fields) -> bool:
+        """更新会话头上的字段（例如对话摘要），写入 journal，在下次写回时持久化。"""
+        with self._locked_session(session_id) as session:
+            if not session:
+                return False
+            session.update(fields)
+            self._append_journal(session_id, {"header": fields})
+            self._dirty.add(session_id)
+        return True
 
-    def _save_session(self, session: Dict):
-        file_path = self._get_file_path(session["id"])
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(session, f, ensure_ascii=False, indent=2)
+    def _append_journal(self, session_id: str, *records: Dict):
+        # 追加写并 flush 到操作系统，进程被杀死也不会丢失
+        with open(self._get_journal_path(session_id), 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+            f.flush()
+
+    def flush(self, session_id: Optional[str] = None):
+        """
+        把内存中已修改的会话写回存储。
+
+        :param session_id: 仅写回指定会话；为空时写回全部已修改会话
+        """
+        with self._flush_lock:
+            self._flush(session_id)
+
+    def _flush(self, session_id: Optional[str]):
+        with self._lock:
+            if session_id is None:
+                pending = list(self._dirty)
+            else:
+                pending = [session_id] if session_id in self._dirty else []
+
+        for sid in pending:
+            with self._lock:
+                session = self._sessions.get(sid)
+                if session is None:
+                    self._dirty.discard(sid)
+                    continue
+                snapshot = {**session, "messages": list(session["messages"])}
+                persisted_count = self._persisted.get(sid, 0)
+                patched = self._patched.pop(sid, set())
+                self._dirty.discard(sid)
+
+            self.store.save(snapshot, persisted_count, patched)
+
+            with self._lock:
+                if sid in self._persisted:
+                    self._persisted[sid] = max(self._persisted[sid], len(snapshot["messages"]))
+                # 写回期间没有新消息时，journal 中的记录都已落盘，可以删除
+                if sid not in self._dirty:
+                    journal_path = self._get_journal_path(sid)
+                    if os.path.exists(journal_path):
+                        os.remove(journal_path)
+
+        with self._lock:
+            self._evict()
+        self._index_pending()
+
+    def _index_pending(self):
+        """把尚未索引的新消息写入全文索引。"""
+        with self._lock:
+            pending = self._search_pending
+            self._search_pending = {}
+            titles = {sid: self._sessions[sid].get("title") for sid in pending if sid in self._sessions}
+        for sid, messages in pending.items():
+            try:
+                self.search_index.add_messages(sid, titles.get(sid), messages)
+            except Exception as e:
+                print(f"更新搜索索引出错 {sid}: {e}")
+
+    def _rebuild_search_index(self):
+        try:
+            count = self.search_index.rebuild(self.store)
+            if count:
+                print(f"已为 {count} 个会话建立搜索索引")
+        except Exception as e:
+            print(f"建立搜索索引出错: {e}")
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """全文搜索所有会话的消息，返回按相关度排序的命中消息及摘要。"""
+        self._index_pending()
+        return self.search_index.search(query, limit=limit, offset=offset)
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.store.maintenance()
+            except Exception as e:
+                print(f"后台写回会话出错: {e}")
+
+    def close(self):
+        """停止后台定时器并写回所有会话。"""
+        self._stop_event.set()
+        self.flush()
+
+    def delete_session(self, session_id: str) -> bool:
+        # 持有 _flush_lock 避免与写回并发；存储和索引的删除在 _lock 之外进行，不阻塞 add_message
+        with self._flush_lock:
+            with self._lock:
+                self._sessions.pop(session_id, None)
+                self._persisted.pop(session_id, None)
+                self._patched.pop(session_id, None)
+                self._dirty.discard(session_id)
+                journal_path = self._get_journal_path(session_id)
+                if os.path.exists(journal_path):
+                    os.remove(journal_path)
+                self._search_pending.pop(session_id, None)
+            self.search_index.delete_session(session_id)
+            result_store.delete_session(session_id)
+            return self.store.delete(session_id)
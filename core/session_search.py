@@ -0,0 +1,236 @@
+import os
+import re
+import html
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 中日韩文字没有空格分词，按相邻两个字（bigram）切分；英文和数字按单词切分
+_CJK = "぀-ヿ㐀-䶿一-鿿가-힯豈-﫿"
+_TOKEN_RE = re.compile(rf"[{_CJK}]+|[^\W{_CJK}]+", re.UNICODE)
+_CJK_RE = re.compile(rf"[{_CJK}]")
+
+
+def tokenize(text: str) -> List[str]:
+    """把文本切分为索引词：英文单词小写，中文连续片段切为 bigram。"""
+    tokens = []
+    for run in _TOKEN_RE.findall((text or "").lower()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def searchable_text(message: Dict) -> str:
+    """
+    消息中参与索引的文本：用户和助手的正文，以及工具调用的名称和参数（例如执行的 SQL）。
+    工具返回结果体积大且噪声多，不进入索引。
+    """
+    if message.get("role") not in ("user", "assistant"):
+        return ""
+    parts = []
+    content = message.get("content")
+    if isinstance(content, str):
+        parts.append(content)
+    for call in message.get("tool_calls") or []:
+        function = call.get("function") or {}
+        parts.append(function.get("name") or "")
+        parts.append(function.get("arguments") or "")
+    return "\n".join(p for p in parts if p)
+
+
+class SessionSearchIndex:
+    """
+    会话历史的全文索引（SQLite FTS5）。
+
+    docs 表保存每条消息的原文和切分后的索引词，messages_fts 是以 docs 为外部内容的 FTS5 表，
+    由触发器同步维护。SessionManager 在写回会话时增量写入新消息，查询只访问索引，不读取会话文件。
+    """
+    # 参与相关度排序的最大命中数
+    RANK_WINDOW = 2000
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS docs (
+        id INTEGER PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT,
+        content TEXT,
+        tokens TEXT,
+        timestamp REAL,
+        UNIQUE(session_id, seq)
+    );
+    CREATE TABLE IF NOT EXISTS titles (
+        session_id TEXT PRIMARY KEY,
+        title TEXT
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        tokens, content='docs', content_rowid='id'
+    );
+    CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+        INSERT INTO messages_fts(rowid, tokens) VALUES (new.id, new.tokens);
+    END;
+    CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, tokens) VALUES ('delete', old.id, old.tokens);
+    END;
+    """
+
+    def __init__(self, storage_dir: str, db_name: str = "search.db"):
+        self.db_path = os.path.join(storage_dir, db_name)
+        os.makedirs(storage_dir, exist_ok=True)
+        self._local = threading.local()
+        self.available = True
+        self.is_new = not os.path.exists(self.db_path)
+        try:
+            self._conn().executescript(self.SCHEMA)
+        except sqlite3.OperationalError as e:
+            # 部分 Python 发行版的 SQLite 未编译 FTS5
+            print(f"全文搜索不可用: {e}")
+            self.available = False
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add_messages(self, session_id: str, title: Optional[str], messages: Iterable[Tuple[int, Dict]],
+                     replace_title: bool = True):
+        """
+        写入一个会话的新消息。
+
+        :param messages: [(seq, message), ...]；已索引的 seq 会被忽略，重复写入是安全的
+        :param replace_title: 为 False 时不覆盖已有的标题（重建索引读到的可能是旧标题）
+        """
+        if not self.available:
+            return
+        rows = []
+        for seq, message in messages:
+            text = searchable_text(message)
+            if text:
+                rows.append((
+                    session_id, seq, message.get("role"), text,
+                    " ".join(tokenize(text)), message.get("timestamp", 0)
+                ))
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if rows:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO docs (session_id, seq, role, content, tokens, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+            if title is not None:
+                conn.execute(
+                    "INSERT INTO titles (session_id, title) VALUES (?, ?) "
+                    + ("ON CONFLICT(session_id) DO UPDATE SET title=excluded.title" if replace_title
+                       else "ON CONFLICT(session_id) DO NOTHING"),
+                    (session_id, title)
+                )
+
+    def delete_session(self, session_id: str):
+        if not self.available:
+            return
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM docs WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM titles WHERE session_id = ?", (session_id,))
+
+    def rebuild(self, store):
+        """从存储后端重建索引（新建索引时用于导入已有会话）。"""
+        count = 0
+        for header in store.list_headers():
+            session = store.load(header["id"])
+            if session:
+                self.add_messages(session["id"], session.get("title"), enumerate(session["messages"]),
+                                  replace_title=False)
+                count += 1
+        return count
+
+    @staticmethod
+    def _match_query(query: str) -> str:
+        """
+        把用户输入转为 FTS5 查询：每个以空格分隔的词切分后作为短语（要求相邻），多个词之间为 AND。
+        单个汉字没有独立的索引词，按前缀匹配以它开头的 bigram。
+        """
+        phrases = []
+        for term in query.split():
+            tokens = tokenize(term)
+            if not tokens:
+                continue
+            phrase = '"' + " ".join(t.replace('"', '""') for t in tokens) + '"'
+            if len(tokens) == 1 and _CJK_RE.match(tokens[0]) and len(tokens[0]) == 1:
+                phrase += "*"
+            phrases.append(phrase)
+        return " ".join(phrases)
+
+    @staticmethod
+    def _snippet(content: str, query: str, width: int = 120) -> str:
+        """截取第一个命中位置附近的原文，并用 <mark> 标出命中的词。"""
+        terms = [t for t in query.lower().split() if t]
+        lowered = content.lower()
+        positions = [lowered.find(t) for t in terms]
+        positions = [p for p in positions if p >= 0]
+        start = max(0, min(positions) - width // 3) if positions else 0
+        end = min(len(content), start + width)
+        text = content[start:end]
+        if terms:
+            pattern = re.compile("|".join(re.escape(t) for t in sorted(set(terms), key=len, reverse=True)), re.IGNORECASE)
+            pieces, last = [], 0
+            for m in pattern.finditer(text):
+                pieces.append(html.escape(text[last:m.start()]))
+                pieces.append(f"<mark>{html.escape(m.group(0))}</mark>")
+                last = m.end()
+            pieces.append(html.escape(text[last:]))
+            text = "".join(pieces)
+        else:
+            text = html.escape(text)
+        return ("..." if start > 0 else "") + text + ("..." if end < len(content) else "")
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """
+        按 BM25 相关度搜索消息。
+
+        :return: [{session_id, title, index, role, snippet, timestamp, score}, ...]
+        """
+        if not self.available:
+            raise RuntimeError("Full-text search is not available (SQLite built without FTS5)")
+        match = self._match_query(query)
+        if not match:
+            return []
+        conn = self._conn()
+        # 非常常见的词会命中大部分消息，对全部命中计算 BM25 代价很高，
+        # 此时只在最近的 RANK_WINDOW 条命中中排序（rowid 随写入递增）
+        row = conn.execute(
+            "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+            (match, self.RANK_WINDOW)
+        ).fetchone()
+        min_rowid = row[0] if row else 0
+        rows = conn.execute(
+            "SELECT d.session_id, t.title, d.seq, d.role, d.content, d.timestamp, m.score FROM ("
+            "  SELECT rowid, bm25(messages_fts) AS score FROM messages_fts"
+            "  WHERE messages_fts MATCH ? AND rowid > ? ORDER BY score LIMIT ? OFFSET ?"
+            ") m JOIN docs d ON d.id = m.rowid "
+            "LEFT JOIN titles t ON t.session_id = d.session_id ORDER BY m.score",
+            (match, min_rowid, limit, offset)
+        ).fetchall()
+        return [
+            {
+                "session_id": session_id,
+                "title": title or "新对话",
+                "index": seq,
+                "role": role,
+                "snippet": self._snippet(content, query),
+                "timestamp": timestamp,
+                "score": -score
+            }
+            for session_id, title, seq, role, content, timestamp, score in rows
+        ]
@@ -0,0 +1,485 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+class SessionStore:
+    """
+    会话持久化后端接口，由 SessionManager 调用。
+
+    会话结构: {"id", "title", "created_at", "updated_at", ..., "messages": [...]}，
+    除 messages 之外的字段统称为会话头（header）。
+    """
+    def create(self, session: Dict):
+        raise NotImplementedError
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def save(self, session: Dict, persisted_count: int, patched: Iterable[int] = ()):
+        """
+        写回会话。messages[:persisted_count] 已经在存储中，之后的消息是新增的。
+        patched 为已在存储中、但之后字段被修改过的消息下标。
+        """
+        raise NotImplementedError
+
+    def list_headers(self, limit: Optional[int] = None, before: Optional[Tuple[float, str]] = None,
+                     after: Optional[Tuple[float, str]] = None) -> List[Dict]:
+        """
+        返回会话头，按 (updated_at, id) 降序排列。
+
+        :param limit: 最多返回的条数
+        :param before: 游标 (updated_at, id)，只返回比它更旧的会话
+        :param after: 游标 (updated_at, id)，只返回比它更新的会话（取紧挨着游标的一页）
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> bool:
+        raise NotImplementedError
+
+    def maintenance(self):
+        """后台维护任务（例如日志压缩），由 SessionManager 的后台线程定期调用。"""
+        pass
+
+    @staticmethod
+    def header_of(session: Dict) -> Dict:
+        return {k: v for k, v in session.items() if k != "messages"}
+
+    @staticmethod
+    def paginate_headers(headers: List[Dict], limit=None, before=None, after=None) -> List[Dict]:
+        """在内存中对会话头做游标分页，供没有索引的后端使用。"""
+        def key(h):
+            return (h.get("updated_at", 0), h.get("id", ""))
+
+        headers = sorted(headers, key=key, reverse=True)
+        if before is not None:
+            headers = [h for h in headers if key(h) < tuple(before)]
+        if after is not None:
+            headers = [h for h in headers if key(h) > tuple(after)]
+            if limit is not None:
+                headers = headers[-limit:]
+        if limit is not None:
+            headers = headers[:limit]
+        return headers
+
+def _write_json_atomic(path: str, data, indent=None):
+    # 先写临时文件再替换，写到一半被杀死也不会损坏原文件
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
+class JsonSessionStore(SessionStore):
+    """原有格式：每个会话一个完整的 <id>.json 文件，写回时整体重写。"""
+    def __init__(self, storage_dir: str):
+        self.storage_dir = storage_dir
+        os.makedirs(self.storage_dir, exist_ok=True)
+
+    def _get_file_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.json")
+
+    def create(self, session: Dict):
+        self.save(session, 0)
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        file_path = self._get_file_path(session_id)
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"加载会话出错 {session_id}: {e}")
+            return None
+
+    def save(self, session: Dict, persisted_count: int, patched: Iterable[int] = ()):
+        _write_json_atomic(self._get_file_path(session["id"]), session, indent=2)
+
+    def list_headers(self, limit=None, before=None, after=None) -> List[Dict]:
+        headers = []
+        for filename in os.listdir(self.storage_dir):
+            if filename.endswith(".json"):
+                session = self.load(filename[:-5])
+                if session:
+                    headers.append(self.header_of(session))
+        return self.paginate_headers(headers, limit, before, after)
+
+    def delete(self, session_id: str) -> bool:
+        file_path = self._get_file_path(session_id)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            return True
+        return False
+
+class JsonlSessionStore(SessionStore):
+    """
+    追加式日志格式：
+    - <id>.jsonl: 每行一条记录，{"seq": n, "message": {...}} 追加消息，{"seq": n, "patch": {...}} 更新消息字段
+    - <id>.meta: 会话头（title, created_at, updated_at 等），体积很小，写回时整体替换
+
+    追加消息只写一行，与会话长度无关。更新记录、重复记录（崩溃恢复产生）和残缺行
+    由后台压缩合并掉。旧的 <id>.json 会话在首次访问时自动迁移。
+    """
+
+    def __init__(self, storage_dir: str, compact_threshold: int = 200):
+        self.storage_dir = storage_dir
+        os.makedirs(self.storage_dir, exist_ok=True)
+        # 日志中可被压缩掉的冗余记录数达到该值时触发压缩
+        self.compact_threshold = compact_threshold
+        self._garbage: Dict[str, int] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, session_id: str) -> threading.Lock:
+        with self._locks_guard:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                lock = threading.Lock()
+                self._locks[session_id] = lock
+            return lock
+
+    def _log_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.jsonl")
+
+    def _meta_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.meta")
+
+    def _legacy_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.json")
+
+    def create(self, session: Dict):
+        with self._lock_for(session["id"]):
+            self._write_log(session["id"], session["messages"])
+            _write_json_atomic(self._meta_path(session["id"]), self.header_of(session))
+
+    def _write_log(self, session_id: str, messages: List[Dict]):
+        tmp_path = self._log_path(session_id) + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for seq, message in enumerate(messages):
+                f.write(json.dumps({"seq": seq, "message": message}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self._log_path(session_id))
+
+    def _append_records(self, session_id: str, records: List[Dict]):
+        with open(self._log_path(session_id), 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+            f.flush()
+
+    def _migrate_legacy(self, session_id: str) -> bool:
+        """把旧的 <id>.json 会话转换为日志 + 会话头。"""
+        legacy_path = self._legacy_path(session_id)
+        if not os.path.exists(legacy_path):
+            return False
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                session = json.load(f)
+        except Exception as e:
+            print(f"迁移会话出错 {session_id}: {e}")
+            return False
+        self._write_log(session_id, session.get("messages", []))
+        _write_json_atomic(self._meta_path(session_id), self.header_of(session))
+        os.remove(legacy_path)
+        print(f"会话 {session_id} 已迁移为追加式日志格式")
+        return True
+
+    def iter_messages(self, session_id: str) -> Iterator[Dict]:
+        """
+        逐行读取日志并产出消息，更新记录合并到对应消息上。
+        同时统计冗余记录数，供后台压缩判断。
+        """
+        log_path = self._log_path(session_id)
+        if not os.path.exists(log_path):
+            return
+        messages: List[Dict] = []
+        garbage = 0
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程在写入半行时被杀死，忽略残缺的行
+                    garbage += 1
+                    continue
+                seq = record.get("seq", len(messages))
+                if "patch" in record:
+                    if seq < len(messages):
+                        messages[seq].update(record["patch"])
+                    garbage += 1
+                elif seq < len(messages):
+                    # 重复的追加记录
+                    garbage += 1
+                else:
+                    messages.append(record["message"])
+        self._garbage[session_id] = garbage
+        yield from messages
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        with self._lock_for(session_id):
+            if not os.path.exists(self._meta_path(session_id)):
+                if not self._migrate_legacy(session_id):
+                    return None
+            try:
+                with open(self._meta_path(session_id), 'r', encoding='utf-8') as f:
+                    session = json.load(f)
+                session["messages"] = list(self.iter_messages(session_id))
+                return session
+            except Exception as e:
+                print(f"加载会话出错 {session_id}: {e}")
+                return None
+
+    def save(self, session: Dict, persisted_count: int, patched: Iterable[int] = ()):
+        session_id = session["id"]
+        messages = session["messages"]
+        with self._lock_for(session_id):
+            # 已有消息的修改写成更新记录（整条消息作为补丁），之后追加新消息
+            records = [{"seq": seq, "patch": messages[seq]} for seq in sorted(patched) if seq < persisted_count]
+            records += [{"seq": persisted_count + i, "message": m} for i, m in enumerate(messages[persisted_count:])]
+            if records:
+                self._append_records(session_id, records)
+            self._garbage[session_id] = self._garbage.get(session_id, 0) + sum("patch" in r for r in records)
+            _write_json_atomic(self._meta_path(session_id), self.header_of(session))
+
+    def list_headers(self, limit=None, before=None, after=None) -> List[Dict]:
+        headers = []
+        for filename in os.listdir(self.storage_dir):
+            try:
+                if filename.endswith(".meta"):
+                    with open(os.path.join(self.storage_dir, filename), 'r', encoding='utf-8') as f:
+                        headers.append(json.load(f))
+                elif filename.endswith(".json"):
+                    # 尚未迁移的旧会话
+                    with open(os.path.join(self.storage_dir, filename), 'r', encoding='utf-8') as f:
+                        headers.append(self.header_of(json.load(f)))
+            except Exception as e:
+                print(f"读取会话头出错 {filename}: {e}")
+        return self.paginate_headers(headers, limit, before, after)
+
+    def delete(self, session_id: str) -> bool:
+        found = False
+        with self._lock_for(session_id):
+            for path in (self._log_path(session_id), self._meta_path(session_id), self._legacy_path(session_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+                    found = True
+            self._garbage.pop(session_id, None)
+        with self._locks_guard:
+            self._locks.pop(session_id, None)
+        return found
+
+    def compact(self, session_id: str):
+        """重写日志：合并更新记录，去掉重复记录和残缺行。"""
+        with self._lock_for(session_id):
+            if not os.path.exists(self._log_path(session_id)):
+                return
+            messages = list(self.iter_messages(session_id))
+            self._write_log(session_id, messages)
+            self._garbage[session_id] = 0
+
+    def maintenance(self):
+        for session_id, garbage in list(self._garbage.items()):
+            if garbage >= self.compact_threshold:
+                try:
+                    self.compact(session_id)
+                except Exception as e:
+                    print(f"压缩会话日志出错 {session_id}: {e}")
+
+class SqliteSessionStore(SessionStore):
+    """
+    SQLite 存储（WAL 模式）：
+    - sessions 表保存会话头，updated_at 上有索引，会话列表是一次索引查询；
+    - messages 表每条消息一行，(session_id, seq) 唯一，追加消息是一次 INSERT。
+
+    新建数据库时，会自动导入同目录下已有的 .json / .jsonl 会话。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        title TEXT,
+        created_at REAL,
+        updated_at REAL,
+        extra TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions(updated_at);
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT,
+        content TEXT,
+        data TEXT NOT NULL,
+        UNIQUE(session_id, seq)
+    );
+    """
+
+    def __init__(self, storage_dir: str, db_name: str = "sessions.db"):
+        self.storage_dir = storage_dir
+        os.makedirs(self.storage_dir, exist_ok=True)
+        self.db_path = os.path.join(storage_dir, db_name)
+        # sqlite3 连接不能跨线程共享，每个线程使用自己的连接
+        self._local = threading.local()
+
+        is_new = not os.path.exists(self.db_path)
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        if is_new:
+            count = import_legacy_sessions(storage_dir, self)
+            if count:
+                print(f"已从 {storage_dir} 导入 {count} 个会话到 SQLite")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _header_row(session: Dict):
+        header = SessionStore.header_of(session)
+        extra = {k: v for k, v in header.items() if k not in ("id", "title", "created_at", "updated_at")}
+        return (
+            header["id"],
+            header.get("title"),
+            header.get("created_at", 0),
+            header.get("updated_at", 0),
+            json.dumps(extra, ensure_ascii=False) if extra else None
+        )
+
+    @staticmethod
+    def _message_row(session_id: str, seq: int, message: Dict):
+        content = message.get("content")
+        return (
+            session_id,
+            seq,
+            message.get("role"),
+            content if isinstance(content, str) else None,
+            json.dumps(message, ensure_ascii=False)
+        )
+
+    def _upsert_header(self, conn, session: Dict):
+        conn.execute(
+            "INSERT INTO sessions (id, title, created_at, updated_at, extra) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET title=excluded.title, updated_at=excluded.updated_at, extra=excluded.extra",
+            self._header_row(session)
+        )
+
+    def _insert_messages(self, conn, session_id: str, start_seq: int, messages: List[Dict]):
+        conn.executemany(
+            "INSERT OR IGNORE INTO messages (session_id, seq, role, content, data) VALUES (?, ?, ?, ?, ?)",
+            [self._message_row(session_id, start_seq + i, m) for i, m in enumerate(messages)]
+        )
+
+    def create(self, session: Dict):
+        self.save(session, 0)
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT id, title, created_at, updated_at, extra FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        session = {"id": row[0], "title": row[1], "created_at": row[2], "updated_at": row[3]}
+        if row[4]:
+            session.update(json.loads(row[4]))
+        session["messages"] = [
+            json.loads(data) for (data,) in conn.execute(
+                "SELECT data FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+            )
+        ]
+        return session
+
+    def save(self, session: Dict, persisted_count: int, patched: Iterable[int] = ()):
+        session_id = session["id"]
+        messages = session["messages"]
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # 已有消息的修改与新消息、会话头在同一个事务中写入
+            conn.executemany(
+                "UPDATE messages SET role = ?, content = ?, data = ? WHERE session_id = ? AND seq = ?",
+                [self._message_row(session_id, seq, messages[seq])[2:] + (session_id, seq)
+                 for seq in sorted(patched) if seq < persisted_count]
+            )
+            self._insert_messages(conn, session_id, persisted_count, messages[persisted_count:])
+            self._upsert_header(conn, session)
+
+    def list_headers(self, limit=None, before=None, after=None) -> List[Dict]:
+        sql = "SELECT id, title, created_at, updated_at FROM sessions"
+        params: list = []
+        if before is not None:
+            sql += " WHERE (updated_at < ? OR (updated_at = ? AND id < ?))"
+            params += [before[0], before[0], before[1]]
+        elif after is not None:
+            sql += " WHERE (updated_at > ? OR (updated_at = ? AND id > ?))"
+            params += [after[0], after[0], after[1]]
+        # after 游标取紧挨着游标的一页，因此按升序查询后再反转
+        order = "ASC" if after is not None and before is None else "DESC"
+        sql += f" ORDER BY updated_at {order}, id {order}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = self._conn().execute(sql, params).fetchall()
+        if order == "ASC":
+            rows.reverse()
+        return [
+            {"id": r[0], "title": r[1], "created_at": r[2], "updated_at": r[3]}
+            for r in rows
+        ]
+
+    def delete(self, session_id: str) -> bool:
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            cur = conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            return cur.rowcount > 0
+
+    def maintenance(self):
+        # 把 WAL 中的内容合并回主库，避免 WAL 文件无限增长
+        self._conn().execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+def import_legacy_sessions(storage_dir: str, target: SessionStore) -> int:
+    """
+    把目录中的 .json（旧格式）和 .jsonl（追加式日志）会话导入到目标存储。
+    已存在的消息会被忽略，可以重复执行。返回导入的会话数。
+    """
+    jsonl_store = JsonlSessionStore(storage_dir)
+
+    session_ids = []
+    for filename in os.listdir(storage_dir):
+        if filename.endswith(".json"):
+            session_ids.append(("json", filename[:-5]))
+        elif filename.endswith(".meta"):
+            session_ids.append(("jsonl", filename[:-5]))
+
+    count = 0
+    for kind, session_id in session_ids:
+        try:
+            if kind == "json":
+                with open(os.path.join(storage_dir, f"{session_id}.json"), 'r', encoding='utf-8') as f:
+                    session = json.load(f)
+            else:
+                session = jsonl_store.load(session_id)
+                if session is None:
+                    continue
+            session.setdefault("id", session_id)
+            session.setdefault("messages", [])
+            target.save(session, 0)
+            count += 1
+        except Exception as e:
+            print(f"导入会话出错 {session_id}: {e}")
+    return count
+
+def create_session_store(backend: str, storage_dir: str) -> SessionStore:
+    backends = {
+        "json": JsonSessionStore,
+        "jsonl": JsonlSessionStore,
+        "sqlite": SqliteSessionStore,
+    }
+    if backend not in backends:
+        raise ValueError(f"Unknown session backend: {backend}")
+    return backends[backend](storage_dir)
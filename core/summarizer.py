@@ -0,0 +1,116 @@
+import time
+from typing import Dict, List
+from config import Config
+from core.context_builder import ContextBuilder, count_message_tokens, TOKENS_KEY
+from core.tool_executor import run_blocking
+from core.rate_limiter import set_request_priority, BACKGROUND
+
+SUMMARY_PROMPT = """你是对话摘要助手。下面给出一段较早的对话记录（以及此前已有的摘要），请把它们合并为一份新的摘要，供后续对话参考。
+要求：
+1. 保留用户提出的需求、约束、偏好和已经确认的结论；
+2. 保留关键的事实和数据（例如数据库名、表名、文件路径、执行结果中的关键数字）；
+3. 记录尚未完成的任务；
+4. 省略寒暄和工具调用的过程细节；
+5. 使用中文，不超过 {max_chars} 字，直接输出摘要正文。"""
+
+# 工具结果在摘要输入中保留的最大长度
+TOOL_RESULT_PREVIEW_CHARS = 500
+
+
+class ConversationSummarizer:
+    """
+    滚动摘要：把滑出上下文窗口的早期消息增量折叠进会话摘要（session["summary"]）。
+
+    在回合结束后于后台执行，不占用用户请求的响应时间。摘要覆盖 messages[:upto]，
+    ContextBuilder 只发送 upto 之后的消息，并把摘要放在 system 提示词之后，
+    因此无论会话多长，每轮的提示词大小都有上界。
+    """
+    def __init__(self, llm, session_manager, context_builder: ContextBuilder):
+        self.llm = llm
+        self.session_manager = session_manager
+        self.context_builder = context_builder
+        self.min_tokens = Config.CONTEXT_SUMMARY_MIN_TOKENS
+        self.chunk_tokens = Config.CONTEXT_SUMMARY_CHUNK_TOKENS
+        self.max_chars = Config.CONTEXT_SUMMARY_MAX_CHARS
+        # 正在生成摘要的会话，避免同一会话并发折叠
+        self._running = set()
+
+    def _pending_range(self, session: Dict):
+        """返回滑出窗口、尚未折叠的消息区间 [start, end)。窗口起点由 ContextBuilder 记录在 context_start 上。"""
+        start = self.context_builder.summarized_upto(session)
+        end = min(session.get("context_start") or 0, len(session["messages"]))
+        return start, max(start, end)
+
+    @staticmethod
+    def _render(messages: List[Dict]) -> str:
+        lines = []
+        for m in messages:
+            role = m.get("role")
+            content = m.get("content") or ""
+            if role == "tool":
+                if len(content) > TOOL_RESULT_PREVIEW_CHARS:
+                    content = content[:TOOL_RESULT_PREVIEW_CHARS] + "..."
+                lines.append(f"[工具结果 {m.get('name', '')}] {content}")
+            elif role == "assistant" and m.get("tool_calls"):
+                calls = ", ".join(
+                    f"{tc.get('function', {}).get('name')}({tc.get('function', {}).get('arguments', '')})"
+                    for tc in m["tool_calls"]
+                )
+                lines.append(f"[助手调用工具] {calls}")
+            else:
+                lines.append(f"[{'用户' if role == 'user' else '助手'}] {content}")
+        return "\n".join(lines)
+
+    async def _fold(self, previous: str, messages: List[Dict]) -> str:
+        user_content = ""
+        if previous:
+            user_content += f"[已有摘要]\n{previous}\n\n"
+        user_content += f"[新的对话记录]\n{self._render(messages)}"
+        response = await self.llm.chat([
+            {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=self.max_chars)},
+            {"role": "user", "content": user_content}
+        ])
+        if not response or not response.content:
+            return None
+        return response.content.strip()
+
+    async def update(self, session_id: str):
+        """把滑出窗口的消息折叠进摘要。未达到 CONTEXT_SUMMARY_MIN_TOKENS 时不做任何事。"""
+        if session_id in self._running:
+            return
+        # 在独立任务中运行，只影响本任务的请求：端点限流排队时让位于用户对话
+        set_request_priority(BACKGROUND)
+        self._running.add(session_id)
+        try:
+            session = await run_blocking(self.session_manager.get_session, session_id)
+            if not session:
+                return
+            start, end = self._pending_range(session)
+            messages = session["messages"]
+            pending_tokens = sum(m.get(TOKENS_KEY) or count_message_tokens(m) for m in messages[start:end])
+            if end <= start or pending_tokens < self.min_tokens:
+                return
+
+            summary = dict(session.get("summary") or {})
+            # 旧会话第一次折叠时区间可能很长，按单元分块逐次合并，每块完成后立即保存进度
+            units = self.context_builder.units(messages[:end], start)
+            chunk = []
+            chunk_tokens = 0
+            for i, unit in enumerate(units):
+                chunk.extend(unit)
+                chunk_tokens += sum(messages[seq].get(TOKENS_KEY) or count_message_tokens(messages[seq]) for seq in unit)
+                if chunk_tokens < self.chunk_tokens and i < len(units) - 1:
+                    continue
+                content = await self._fold(summary.get("content", ""), [messages[seq] for seq in chunk])
+                if content is None:
+                    print(f"生成对话摘要失败: {session_id}")
+                    return
+                summary = {"content": content, "upto": chunk[-1] + 1, "updated_at": time.time()}
+                await run_blocking(self.session_manager.update_session, session_id, summary=summary)
+                chunk = []
+                chunk_tokens = 0
+            print(f"已更新会话摘要 {session_id}: 覆盖前 {summary['upto']} 条消息")
+        except Exception as e:
+            print(f"生成对话摘要出错 {session_id}: {e}")
+        finally:
+            self._running.discard(session_id)
@@ -0,0 +1,347 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+from config import Config
+
+# ----------------------------------------------------------------------
+# 各工具的缓存策略
+# ----------------------------------------------------------------------
+
+# 只读 SQL：以 SELECT / WITH / SHOW / DESCRIBE / EXPLAIN 开头，且不包含写操作关键字、不含多条语句
+_READ_SQL_RE = re.compile(r"^\s*(select|with|show|describe|desc|explain)\b", re.IGNORECASE)
+_WRITE_SQL_RE = re.compile(
+    r"\b(insert|update|delete|replace|merge|create|drop|alter|truncate|rename|grant|revoke|attach|detach|vacuum|lock|call|set)\b",
+    re.IGNORECASE
+)
+
+def is_read_only_sql(query: str) -> bool:
+    query = (query or "").strip().rstrip(";")
+    return bool(_READ_SQL_RE.match(query)) and ";" not in query and not _WRITE_SQL_RE.search(query)
+
+def _abspath(path: Optional[str]) -> str:
+    return os.path.abspath(path) if path else ""
+
+def _stat(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+def _stat_signature(path: str, *extra_paths: str) -> Optional[List]:
+    """
+    文件的 [mtime_ns, size]；主文件不存在时返回 None（不缓存）。
+    extra_paths 为可能不存在的附属文件（例如 SQLite 的 -wal 文件）。
+    """
+    main = _stat(path)
+    if main is None:
+        return None
+    return [main] + [_stat(p) for p in extra_paths]
+
+def _mysql_tag(args: Dict) -> str:
+    return f"mysql:{args.get('host')}:{args.get('port', 3306)}"
+
+# 工具名 -> 策略：
+#   ttl: 结果有效期（秒），None 表示不过期（依赖 validate 校验）
+#   cacheable(args): 本次调用是否可以缓存
+#   validate(args): 返回底层资源的签名（例如文件 mtime/size），签名变化则缓存失效
+#   tags(args): 结果依赖的资源标签，标签被 invalidates 失效时缓存一并失效
+#   invalidates(args): 有副作用的调用执行后使哪些标签失效
+#   persist: 为 False 时只缓存在内存中，不写入磁盘层（数据库查询结果可能包含用户数据，不以明文落盘）
+# 未列出的工具（run_python、generate_* 、备忘录等）一律不缓存
+TOOL_CACHE_POLICIES: Dict[str, Dict[str, Callable]] = {
+    "search_web": {"ttl": 600},
+    "read_url": {"ttl": 600},
+    "get_weather": {"ttl": 900},
+    "read_file": {
+        "ttl": None,
+        "validate": lambda args: _stat_signature(_abspath(args.get("file_path"))),
+        "tags": lambda args: [f"path:{_abspath(args.get('file_path'))}"],
+    },
+    "list_directory": {
+        "ttl": None,
+        "validate": lambda args: _stat_signature(_abspath(args.get("dir_path"))),
+        "tags": lambda args: [f"path:{_abspath(args.get('dir_path'))}"],
+    },
+    "write_file": {
+        "invalidates": lambda args: [
+            f"path:{_abspath(args.get('file_path'))}",
+            f"path:{os.path.dirname(_abspath(args.get('file_path')))}",
+        ],
+    },
+    "query_sqlite": {
+        "ttl": None,
+        "persist": False,
+        "cacheable": lambda args: is_read_only_sql(args.get("query")),
+        # WAL 模式下未 checkpoint 的写入只体现在 -wal 文件上
+        "validate": lambda args: _stat_signature(_abspath(args.get("db_path")), _abspath(args.get("db_path")) + "-wal"),
+        "tags": lambda args: [f"sqlite:{_abspath(args.get('db_path'))}"],
+        "invalidates": lambda args: [] if is_read_only_sql(args.get("query")) else [f"sqlite:{_abspath(args.get('db_path'))}"],
+    },
+    "query_mysql": {
+        # 远程数据库无法校验是否变化，只做短时缓存
+        "ttl": 60,
+        "persist": False,
+        "cacheable": lambda args: is_read_only_sql(args.get("query")),
+        "tags": lambda args: [_mysql_tag(args)],
+        "invalidates": lambda args: [] if is_read_only_sql(args.get("query")) else [_mysql_tag(args)],
+    },
+}
+
+# 工具返回的错误信息不缓存
+_ERROR_PREFIXES = ("错误", "Error", "error")
+
+def _is_error_result(result) -> bool:
+    if not isinstance(result, str):
+        return True
+    head = result[:40]
+    return head.startswith(_ERROR_PREFIXES) or "出错" in head or head.startswith('[{"error"')
+
+
+class ToolResultCache:
+    """
+    幂等工具的结果缓存。
+
+    以工具名 + 规范化参数为键，按 TOOL_CACHE_POLICIES 中的策略判断能否缓存、是否过期或失效。
+    内存中按 LRU 淘汰（条数和总字节数两个上限）；配置了 TOOL_CACHE_DIR 时，
+    策略未设置 persist=False 的结果同时写入磁盘，内存未命中时从磁盘读取，重启后仍然有效。
+    """
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 cache_dir: Optional[str] = None, policies: Optional[Dict] = None):
+        self.max_entries = Config.TOOL_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.max_bytes = Config.TOOL_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.cache_dir = Config.TOOL_CACHE_DIR if cache_dir is None else cache_dir
+        self.policies = TOOL_CACHE_POLICIES if policies is None else policies
+        self.max_disk_entries = Config.TOOL_CACHE_DISK_MAX_ENTRIES
+        self._disk_writes = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._bytes = 0
+        # 标签 -> 最近一次失效的时间，早于该时间写入的缓存视为失效
+        self._invalidated_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+        self.tool_stats: Dict[str, Dict[str, int]] = {}
+
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def make_key(func_name: str, func_args: Dict) -> str:
+        normalized = json.dumps(func_args, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(f"{func_name}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _policy(self, func_name: str, func_args: Dict) -> Optional[Dict]:
+        policy = self.policies.get(func_name)
+        if not policy or "ttl" not in policy:
+            return None
+        cacheable = policy.get("cacheable")
+        if cacheable and not cacheable(func_args):
+            return None
+        return policy
+
+    def _count(self, func_name: str, stat: str):
+        self.stats[stat] += 1
+        tool = self.tool_stats.setdefault(func_name, {"hits": 0, "misses": 0})
+        if stat in ("hits", "disk_hits"):
+            tool["hits"] += 1
+        elif stat == "misses":
+            tool["misses"] += 1
+
+    def _is_valid(self, entry: Dict, policy: Dict, func_args: Dict) -> bool:
+        ttl = policy.get("ttl")
+        if ttl is not None and time.time() - entry["created_at"] > ttl:
+            return False
+        for tag in entry.get("tags", []):
+            if self._invalidated_at.get(tag, 0) >= entry["created_at"]:
+                return False
+        validate = policy.get("validate")
+        if validate and validate(func_args) != entry.get("signature"):
+            return False
+        return True
+
+    # ------------------------------------------------------------------
+    # 内存层
+    # ------------------------------------------------------------------
+
+    def get(self, func_name: str, func_args: Dict):
+        """只查内存层，命中返回结果，否则返回 None。足够轻量，可以在事件循环中直接调用。"""
+        policy = self._policy(func_name, func_args)
+        if policy is None:
+            return None
+        key = self.make_key(func_name, func_args)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not self._is_valid(entry, policy, func_args):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self._count(func_name, "hits")
+            return entry["result"]
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry["size"]
+
+    def _put_memory(self, key: str, entry: Dict):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry["size"]
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+
+    # ------------------------------------------------------------------
+    # 磁盘层
+    # ------------------------------------------------------------------
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _get_disk(self, key: str) -> Optional[Dict]:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _put_disk(self, key: str, entry: Dict):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"写入工具缓存出错: {e}")
+            return
+
+        self._disk_writes += 1
+        if self._disk_writes % 100 == 0:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """磁盘层超过上限时删除最旧的文件。"""
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        files.append((os.path.getmtime(path), path))
+                    except OSError:
+                        continue
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort()
+        for _, path in files[:len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # ------------------------------------------------------------------
+
+    def invalidate(self, tags: List[str]):
+        if not tags:
+            return
+        now = time.time()
+        with self._lock:
+            for tag in tags:
+                self._invalidated_at[tag] = now
+            self.stats["invalidations"] += len(tags)
+
+    def invalidate_for(self, func_name: str, func_args: Dict):
+        """在缓存之外执行了工具的等价操作（例如界面上的数据库查看器）时，按该工具的策略使缓存失效。"""
+        invalidates = (self.policies.get(func_name) or {}).get("invalidates")
+        if invalidates:
+            self.invalidate(invalidates(func_args))
+
+    def call(self, func_name: str, func: Callable, func_args: Dict):
+        """
+        带缓存地执行一次（阻塞）工具调用：依次查内存层、磁盘层，未命中时执行工具并写入缓存。
+        有副作用的调用执行后按策略使相关缓存失效。
+        """
+        policy = self._policy(func_name, func_args)
+        if policy is None:
+            result = func(**func_args)
+            self.invalidate_for(func_name, func_args)
+            return result
+
+        cached = self.get(func_name, func_args)
+        if cached is not None:
+            return cached
+
+        key = self.make_key(func_name, func_args)
+        persist = policy.get("persist", True)
+        entry = self._get_disk(key) if persist else None
+        if entry is not None and self._is_valid(entry, policy, func_args):
+            with self._lock:
+                self._count(func_name, "disk_hits")
+            self._put_memory(key, entry)
+            return entry["result"]
+
+        with self._lock:
+            self._count(func_name, "misses")
+        validate = policy.get("validate")
+        # 先取签名再执行，执行期间资源被修改时下次校验会失败，不会缓存到旧内容
+        signature = validate(func_args) if validate else None
+        created_at = time.time()
+        result = func(**func_args)
+        if _is_error_result(result) or (validate and signature is None):
+            return result
+
+        tags = policy["tags"](func_args) if policy.get("tags") else []
+        entry = {
+            "result": result,
+            "created_at": created_at,
+            "signature": signature,
+            "tags": tags,
+            "size": len(result.encode("utf-8"))
+        }
+        if entry["size"] <= self.max_bytes:
+            self._put_memory(key, entry)
+            with self._lock:
+                self.stats["stores"] += 1
+        if persist:
+            self._put_disk(key, entry)
+        return result
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": (self.stats["hits"] + self.stats["disk_hits"]) / lookups if lookups else 0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "tools": {name: dict(counts) for name, counts in self.tool_stats.items()}
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.cache_dir:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+
+tool_cache = ToolResultCache()
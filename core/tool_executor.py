@@ -0,0 +1,295 @@
+import json
+import asyncio
+import functools
+import weakref
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from core.tools import AVAILABLE_TOOLS, STREAMING_TOOLS
+from core.tools.streaming import collect
+from core.tool_cache import tool_cache, is_read_only_sql
+from core.metrics import registry
+
+TOOL_REPEAT_CALLS = registry.counter(
+    "agent_tool_repeat_calls_total", "Identical read-only tool calls answered from the per-run memo.", ["tool"]
+)
+
+# 所有阻塞型工具共享的有界线程池，避免一个慢工具拖住事件循环
+_tool_executor = None
+
+def get_tool_executor() -> ThreadPoolExecutor:
+    global _tool_executor
+    if _tool_executor is None:
+        _tool_executor = ThreadPoolExecutor(
+            max_workers=Config.TOOL_MAX_WORKERS,
+            thread_name_prefix="agent-tool"
+        )
+    return _tool_executor
+
+async def run_blocking(func, *args, executor=None, **kwargs):
+    """
+    在线程池中执行阻塞函数并等待结果。
+
+    :param executor: 指定线程池，默认使用事件循环自带的线程池（适合短小的文件 I/O）
+
+    函数在调用方的 contextvars 上下文中执行，可以读取当前请求的取消信号和追踪信息。
+    调用方被取消时，尚未开始执行的函数不再执行。
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
+
+class _ProgressForwarder:
+    """
+    把工具线程中产出的输出片段转发到事件循环。
+    片段先合并到缓冲区，循环中同一时间最多排着一次 flush：输出很快时多个片段合并为一次回调，
+    不会为每一行都调度一次。
+    """
+    def __init__(self, loop, on_progress):
+        self._loop = loop
+        self._on_progress = on_progress
+        self._lock = threading.Lock()
+        self._pending = []
+        self._scheduled = False
+
+    def __call__(self, chunk: str):
+        if not chunk:
+            return
+        with self._lock:
+            self._pending.append(chunk)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            text = "".join(self._pending)
+            self._pending.clear()
+            self._scheduled = False
+        if text:
+            self._on_progress(text)
+
+async def run_tool(func_name: str, func_args: dict, on_progress=None) -> str:
+    """
+    工具的异步适配器。
+    协程工具直接 await，普通（阻塞）工具放入有界工具线程池执行。
+    启用 TOOL_CACHE_ENABLED 时经过结果缓存：内存命中直接返回，不占用线程池。
+
+    :param on_progress: 在事件循环中以 on_progress(chunk) 接收输出片段；
+                        仅对 STREAMING_TOOLS 中的工具生效，缓存命中时不产生片段
+    """
+    func = AVAILABLE_TOOLS[func_name]
+    if on_progress is not None and func_name in STREAMING_TOOLS:
+        stream_func = STREAMING_TOOLS[func_name]
+        forwarder = _ProgressForwarder(asyncio.get_running_loop(), on_progress)
+
+        def func(**kwargs):
+            return collect(stream_func(**kwargs), on_chunk=forwarder)
+    if asyncio.iscoroutinefunction(func):
+        return await func(**func_args)
+    if not Config.TOOL_CACHE_ENABLED:
+        return await run_blocking(func, executor=get_tool_executor(), **func_args)
+    cached = tool_cache.get(func_name, func_args)
+    if cached is not None:
+        return cached
+    return await run_blocking(tool_cache.call, func_name, func, func_args, executor=get_tool_executor())
+
+# 重型或共享状态的工具按组限制全局并发，避免挤占其他工具的线程
+# 工具名 -> (并发组, 组内最大并发数)
+TOOL_CONCURRENCY_LIMITS = {
+    "run_python": ("python", 2),
+    "generate_image": ("image", 2),
+    "generate_document": ("document", 2),
+    "generate_mindmap": ("document", 2),
+    "analyze_image": ("vision", 4),
+    # 备忘录工具读写同一个 JSON 文件，必须串行
+    "add_memo": ("memo", 1),
+    "delete_memo": ("memo", 1),
+    "read_memos": ("memo", 1),
+}
+
+# 只读工具可以在模型仍在输出后续调用时提前执行（推测执行），值为按参数判断的附加条件
+SPECULATIVE_TOOLS = {
+    "read_file": None,
+    "list_directory": None,
+    "search_files": None,
+    "search_web": None,
+    "read_url": None,
+    "get_weather": None,
+    "query_sqlite": lambda args: is_read_only_sql(args.get("query")),
+    "query_mysql": lambda args: is_read_only_sql(args.get("query")),
+}
+
+def is_speculative(func_name: str, func_args: dict) -> bool:
+    """该调用是否只读、可以在本轮输出结束前提前执行。"""
+    if func_name not in SPECULATIVE_TOOLS:
+        return False
+    condition = SPECULATIVE_TOOLS[func_name]
+    return condition is None or condition(func_args)
+
+def is_barrier(func_name: str, args_str) -> bool:
+    """
+    非只读的调用（写文件、备忘录、非 SELECT 的 SQL、run_python 等）作为屏障：必须等前面的调用全部完成后
+    单独执行，后面的调用再继续，保证同一轮中 DELETE 之后的 SELECT COUNT 看到删除后的结果。
+    与 RunMemo 判断写操作的规则相同；参数无法解析时同样视为屏障。
+    """
+    try:
+        func_args = json.loads(args_str) if isinstance(args_str, str) and args_str else (args_str or {})
+    except json.JSONDecodeError:
+        return True
+    return not isinstance(func_args, dict) or not is_speculative(func_name, func_args)
+
+class RunMemo:
+    """
+    一次 Agent 运行内的只读工具调用记忆。
+
+    模型有时会在同一次运行中反复发出完全相同的调用（同一个目录、同一条 SHOW TABLES），
+    相同的 (工具, 参数) 在没有写操作介入时直接返回第一次的结果，不再访问磁盘或数据库。
+    与 tool_cache 不同，它不依赖工具的缓存策略，只在本次运行内有效；任何非只读调用开始或结束时清空。
+    同一批中并发发出的相同调用只执行一次，后到的等待先到的结果。
+    只在事件循环线程中使用。
+    """
+    def __init__(self):
+        self._entries = {}
+        self.repeats = 0
+
+    def lookup(self, func_name: str, func_args: dict):
+        """已执行过（或正在执行）的相同调用返回其 Future，否则返回 None。"""
+        return self._entries.get(tool_cache.make_key(func_name, func_args))
+
+    def begin(self, func_name: str, func_args: dict):
+        """登记一次调用，返回用于 finish 的凭证；非只读调用清空记忆并返回 None。"""
+        if not is_speculative(func_name, func_args):
+            self.invalidate()
+            return None
+        key = tool_cache.make_key(func_name, func_args)
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = future
+        return key, future
+
+    def finish(self, entry, result):
+        """
+        记录调用结果。result 为 None 表示调用未完成，等待者需要自己执行。
+        调用期间记忆已被写操作清空时，结果不再保留。
+        """
+        if entry is None:
+            return
+        key, future = entry
+        if result is None or self._entries.get(key) is not future:
+            if self._entries.get(key) is future:
+                del self._entries[key]
+            result = None
+        if not future.done():
+            future.set_result(result)
+
+    def record_repeat(self, func_name: str):
+        self.repeats += 1
+        TOOL_REPEAT_CALLS.inc(tool=func_name)
+
+    def invalidate(self):
+        for future in self._entries.values():
+            if not future.done():
+                future.set_result(None)
+        self._entries.clear()
+
+class ToolScheduler:
+    """
+    并发调度同一轮中模型返回的多个工具调用。
+
+    相互独立的只读调用在有界并发下同时执行，非只读调用（见 is_barrier）按原顺序串行执行。
+    run() 以完成顺序产出事件，调用方负责按模型原顺序写回历史。
+    """
+    def __init__(self, max_parallel=None, limits=None):
+        self.max_parallel = max_parallel or Config.TOOL_MAX_PARALLEL
+        self.limits = TOOL_CONCURRENCY_LIMITS if limits is None else limits
+        # asyncio.Semaphore 绑定事件循环，按循环分别维护各组的信号量
+        self._group_semaphores = weakref.WeakKeyDictionary()
+
+    def _group_semaphore(self, func_name):
+        if func_name not in self.limits:
+            return None
+        group, limit = self.limits[func_name]
+        loop = asyncio.get_running_loop()
+        semaphores = self._group_semaphores.get(loop)
+        if semaphores is None:
+            semaphores = {}
+            self._group_semaphores[loop] = semaphores
+        if group not in semaphores:
+            semaphores[group] = asyncio.Semaphore(limit)
+        return semaphores[group]
+
+    def _stages(self, calls):
+        """把调用切分为若干阶段：连续的只读调用为一个并行阶段，屏障调用单独成阶段。"""
+        stages = []
+        current = []
+        for index, call in enumerate(calls):
+            if is_barrier(call[0], call[1]):
+                if current:
+                    stages.append(current)
+                    current = []
+                stages.append([(index, call)])
+            else:
+                current.append((index, call))
+        if current:
+            stages.append(current)
+        return stages
+
+    async def run_one(self, call, execute):
+        """在调度器之外单独执行一个调用（用于推测执行），同样遵守工具组的并发上限。"""
+        group_slots = self._group_semaphore(call[0])
+        if group_slots:
+            async with group_slots:
+                return await execute(*call)
+        return await execute(*call)
+
+    async def run(self, calls, execute, with_progress=False):
+        """
+        执行一轮工具调用。
+
+        :param calls: [(func_name, *args), ...]，按模型给出的顺序
+        :param execute: 异步函数 execute(func_name, *args)，返回该调用的结果
+        :param with_progress: 为 True 时以 execute(func_name, *args, on_progress=callback) 调用，
+                              工具的输出片段作为 ("progress", index, chunk) 事件产出
+        :return: 异步生成器，产出 ("start", index, None)、("result", index, result)
+                 以及（可选的）("progress", index, chunk)
+        """
+        queue = asyncio.Queue()
+        turn_slots = asyncio.Semaphore(self.max_parallel)
+
+        async def worker(index, call):
+            # 先等待组内名额再占用本轮名额，排队中的重型工具不占用本轮并发
+            group_slots = self._group_semaphore(call[0])
+            if group_slots:
+                await group_slots.acquire()
+            try:
+                async with turn_slots:
+                    await queue.put(("start", index, None))
+                    kwargs = {}
+                    if with_progress:
+                        kwargs["on_progress"] = lambda chunk: queue.put_nowait(("progress", index, chunk))
+                    try:
+                        result = await execute(*call, **kwargs)
+                    except Exception as e:
+                        result = e
+                    await queue.put(("result", index, result))
+            finally:
+                if group_slots:
+                    group_slots.release()
+
+        for stage in self._stages(calls):
+            tasks = [asyncio.create_task(worker(index, call)) for index, call in stage]
+            try:
+                remaining = len(stage)
+                while remaining:
+                    event = await queue.get()
+                    if event[0] == "result":
+                        remaining -= 1
+                    yield event
+            finally:
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+
+tool_scheduler = ToolScheduler()
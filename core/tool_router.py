@@ -0,0 +1,226 @@
+import re
+import json
+import math
+from collections import Counter as TermCounter
+from typing import Dict, Iterable, List, Optional, Set
+from config import Config
+from core.tools import TOOLS_SCHEMA
+from core.session_search import tokenize
+from core.context_builder import count_tokens
+from core.metrics import registry
+
+TOOL_SCHEMA_TOKENS_SENT = registry.counter(
+    "llm_tool_schema_tokens_sent_total", "Estimated prompt tokens spent on tool definitions."
+)
+TOOL_SCHEMA_TOKENS_SAVED = registry.counter(
+    "llm_tool_schema_tokens_saved_total", "Estimated prompt tokens saved by sending a subset of the tool definitions."
+)
+TOOLS_OFFERED = registry.histogram(
+    "llm_tools_offered", "Number of tool definitions sent with each model request.",
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 24)
+)
+TOOL_ROUTER_FALLBACKS = registry.counter(
+    "tool_router_fallback_total", "Runs that fell back to the full tool set because the model called a tool it was not offered."
+)
+
+# 关键词规则：命中即选中对应工具。规则按用户意图书写，比描述相似度更可靠
+KEYWORD_RULES = [
+    (r"文件|目录|文件夹|路径|[a-z]:\\|(^|\s)/[\w.-]+/|\.(txt|md|csv|json|log|py|ya?ml|ini|conf)\b|file|folder|director",
+     ["read_file", "list_directory", "search_files"]),
+    (r"写入|保存到|另存|创建文件|新建文件|write|save", ["write_file"]),
+    (r"sqlite|\.db\b|数据库|数据表|sql|select\s|表里|表中|查表", ["query_sqlite", "query_mysql"]),
+    (r"mysql", ["query_mysql"]),
+    (r"python|代码|脚本|计算|算一下|统计|求和|平均|排序|code|calculat", ["run_python"]),
+    (r"画|绘制|生成.{0,6}(图|照片|插画|海报)|图像|image|draw|picture", ["generate_image"]),
+    (r"搜索|搜一下|查一下|查找资料|新闻|热搜|最新|实时|百科|search|news|google", ["search_web"]),
+    (r"https?://|网页|网址|链接|文章|url|web\s?page", ["read_url"]),
+    (r"(这张|图片|照片|图中|截图).{0,6}(是什么|内容|分析|识别|描述)|\.(png|jpe?g|gif|webp)\b", ["analyze_image"]),
+    (r"文档|报告|pdf|docx|word|导出", ["generate_document"]),
+    (r"思维导图|脑图|导图|mind\s?map|mermaid", ["generate_mindmap"]),
+    (r"记住|记下|备忘|备忘录|提醒我|记得|忘记|忘掉|memo|remember", ["add_memo", "read_memos", "delete_memo"]),
+    (r"天气|气温|下雨|下雪|温度|weather", ["get_weather"]),
+]
+
+# 同一组的工具经常连续使用，选中其一时整组发送，避免下一步缺少工具
+TOOL_FAMILIES = [
+    {"read_file", "list_directory", "search_files"},
+    {"add_memo", "read_memos", "delete_memo"},
+    {"search_web", "read_url"},
+]
+
+
+def _schema_name(schema: Dict) -> str:
+    return schema["function"]["name"]
+
+
+def _schema_text(schema: Dict) -> str:
+    """参与相似度计算的工具文本：名称、描述和各参数的描述。"""
+    function = schema["function"]
+    parts = [function["name"].replace("_", " "), function.get("description", "")]
+    for name, prop in (function.get("parameters") or {}).get("properties", {}).items():
+        parts.append(name.replace("_", " "))
+        parts.append(prop.get("description", ""))
+    return "\n".join(parts)
+
+
+class ToolRouter:
+    """
+    按本轮请求挑选发送给模型的工具定义。
+
+    全部工具定义每次请求都要占用数千 token。路由器按以下来源的并集挑选子集：
+    关键词规则、用户消息与工具描述的 TF-IDF 相似度（索引在启动时构建一次）、
+    本会话中已经使用过的工具，以及 TOOL_ROUTER_ALWAYS 配置的常驻工具。
+    同一会话中提供过的工具会在之后的回合继续提供，列表只追加，保持前缀缓存（见 ToolSelection）。
+    """
+    def __init__(self, schemas: Optional[List[Dict]] = None, top_k: Optional[int] = None,
+                 min_score: Optional[float] = None, always: Optional[Iterable[str]] = None):
+        self.schemas = TOOLS_SCHEMA if schemas is None else schemas
+        self.top_k = Config.TOOL_ROUTER_TOP_K if top_k is None else top_k
+        self.min_score = Config.TOOL_ROUTER_MIN_SCORE if min_score is None else min_score
+        if always is None:
+            always = [name.strip() for name in Config.TOOL_ROUTER_ALWAYS.split(",") if name.strip()]
+        self.names = [_schema_name(schema) for schema in self.schemas]
+        self.always = {name for name in always if name in self.names}
+        self._by_name = {_schema_name(schema): schema for schema in self.schemas}
+        # 每个工具定义的 token 数（估算），用于统计节省量
+        self._tokens = {
+            name: count_tokens(json.dumps(schema, ensure_ascii=False)) for name, schema in self._by_name.items()
+        }
+        self.full_tokens = sum(self._tokens.values())
+        self._rules = [(re.compile(pattern, re.IGNORECASE), tools) for pattern, tools in KEYWORD_RULES]
+        self._build_index()
+
+    def _build_index(self):
+        """为每个工具的描述构建归一化的 TF-IDF 向量。"""
+        docs = {name: TermCounter(tokenize(_schema_text(schema))) for name, schema in self._by_name.items()}
+        df = TermCounter()
+        for terms in docs.values():
+            df.update(terms.keys())
+        n = len(docs)
+        self._idf = {term: math.log((n + 1) / (count + 0.5)) for term, count in df.items()}
+        self._vectors = {name: self._vector(terms) for name, terms in docs.items()}
+
+    def _vector(self, terms: TermCounter) -> Dict[str, float]:
+        vector = {term: (1 + math.log(tf)) * self._idf[term] for term, tf in terms.items() if term in self._idf}
+        norm = math.sqrt(sum(w * w for w in vector.values()))
+        return {term: w / norm for term, w in vector.items()} if norm else {}
+
+    def similar(self, text: str) -> List[tuple]:
+        """按描述相似度排序的 [(工具名, 分数), ...]，只包含分数不低于 min_score 的工具。"""
+        query = self._vector(TermCounter(tokenize(text)))
+        if not query:
+            return []
+        scores = []
+        for name, vector in self._vectors.items():
+            score = sum(w * vector.get(term, 0.0) for term, w in query.items())
+            if score >= self.min_score:
+                scores.append((name, score))
+        scores.sort(key=lambda item: -item[1])
+        return scores[:self.top_k]
+
+    def route(self, text: str, used: Iterable[str] = ()) -> Set[str]:
+        """本轮请求应发送的工具名集合。"""
+        selected = set(self.always)
+        selected.update(name for name in used if name in self._by_name)
+        for pattern, tools in self._rules:
+            if pattern.search(text or ""):
+                selected.update(tools)
+        selected.update(name for name, _ in self.similar(text))
+        for family in TOOL_FAMILIES:
+            if selected & family:
+                selected.update(family & set(self.names))
+        return selected
+
+    def select(self, text: str, history: Iterable[Dict] = (), offered: Iterable[str] = ()) -> "ToolSelection":
+        """
+        为一次 Agent 运行挑选工具。history 为会话消息，其中调用过的工具始终保留；
+        offered 为本会话之前提供过的工具，保持原顺序排在最前面（见 ToolSelection）。
+        """
+        if not Config.TOOL_ROUTER_ENABLED:
+            return ToolSelection(self, None)
+        return ToolSelection(self, self.route(text, used_tools(history)), offered)
+
+    def tokens(self, names: Optional[Set[str]]) -> int:
+        if names is None:
+            return self.full_tokens
+        return sum(self._tokens[name] for name in names if name in self._tokens)
+
+
+def used_tools(history: Iterable[Dict]) -> Set[str]:
+    """会话消息中调用过的工具名。"""
+    used = set()
+    for message in history:
+        for call in message.get("tool_calls") or []:
+            name = (call.get("function") or {}).get("name")
+            if name:
+                used.add(name)
+    return used
+
+
+class ToolSelection:
+    """
+    一次 Agent 运行使用的工具列表。order 为 None 表示发送全部工具（路由关闭）。
+
+    工具定义位于提示词的最前面，列表的任何变化都会使服务商的前缀缓存失效。因此列表在会话内只追加不删减：
+    本会话之前提供过的工具（offered，保存在会话头的 offered_tools 中）按原顺序排在最前面，
+    本轮新选中的工具按 TOOLS_SCHEMA 的顺序追加在后面；运行中追加 read_result 或回退到全部工具时同样只追加。
+    相同的会话在后续回合得到逐字节相同的工具列表，代价是长会话发送的工具逐渐增多，节省的 token 变少。
+
+    模型调用了本次没有提供的工具时（通常是它从历史或常识中猜到了工具名），
+    之后的请求追加其余全部工具，让模型看到完整的工具列表后重新选择。
+    """
+    def __init__(self, router: ToolRouter, names: Optional[Set[str]], offered: Iterable[str] = ()):
+        self.router = router
+        # 本轮按请求内容选中的工具（模型级联按它判断是否需要规划）
+        self.routed = names
+        self.order: Optional[List[str]] = None
+        self.changed = False
+        if names is not None:
+            self.order = [name for name in dict.fromkeys(offered) if name in router._by_name]
+            self._append(names)
+
+    def _append(self, names: Iterable[str]) -> bool:
+        existing = set(self.order)
+        added = [name for name in self.router.names if name in names and name not in existing]
+        self.order.extend(added)
+        self.changed = self.changed or bool(added)
+        return bool(added)
+
+    @property
+    def names(self) -> Optional[Set[str]]:
+        return None if self.order is None else set(self.order)
+
+    @property
+    def full(self) -> bool:
+        return self.order is None or len(self.order) == len(self.router.names)
+
+    def schemas(self) -> List[Dict]:
+        """本次请求发送的工具定义，同时记录节省的 token 数。"""
+        if self.order is None:
+            schemas = self.router.schemas
+        else:
+            schemas = [self.router._by_name[name] for name in self.order]
+        sent = self.router.tokens(self.names)
+        TOOL_SCHEMA_TOKENS_SENT.inc(sent)
+        TOOL_SCHEMA_TOKENS_SAVED.inc(self.router.full_tokens - sent)
+        TOOLS_OFFERED.observe(len(schemas))
+        return schemas
+
+    def include(self, name: str):
+        """运行过程中追加一个工具（例如出现存档结果后追加 read_result）。"""
+        if self.order is not None:
+            self._append({name})
+
+    def observe(self, called: Iterable[str]) -> bool:
+        """检查模型本轮调用的工具，出现未提供的工具时追加全部其余工具。返回是否发生了回退。"""
+        if self.order is None:
+            return False
+        unknown = sorted({name for name in called if name not in self.order})
+        if not unknown:
+            return False
+        print(f"Tool router: model called unoffered tools {unknown}, falling back to the full tool set")
+        TOOL_ROUTER_FALLBACKS.inc()
+        return self._append(set(self.router.names))
+
+
+tool_router = ToolRouter()
@@ -1,9 +1,10 @@
 from .file_ops import read_file, write_file, list_directory, search_files
-from .db_ops import query_sqlite, query_mysql
+from .db_ops import query_sqlite, query_mysql, query_sqlite_stream, query_mysql_stream
 from .web_ops import search_web, read_url, get_weather
 from .media_ops import generate_image, analyze_image, generate_document, generate_mindmap
 from .memory_ops import add_memo, read_memos, delete_memo
-from .python_ops import run_python
+from .python_ops import run_python, run_python_stream
+from .result_ops import read_result
 
 AVAILABLE_TOOLS = {
     "read_file": read_file,
@@ -22,7 +23,15 @@ AVAILABLE_TOOLS = {
     "run_python": run_python,
     "analyze_image": analyze_image,
     "generate_document": generate_document,
-    "generate_mindmap": generate_mindmap
+    "generate_mindmap": generate_mindmap,
+    "read_result": read_result
+}
+
+# 支持输出进度的工具：工具名 -> 流式版本（生成器，协议见 core.tools.streaming）
+STREAMING_TOOLS = {
+    "run_python": run_python_stream,
+    "query_sqlite": query_sqlite_stream,
+    "query_mysql": query_mysql_stream,
 }
 
 # LLM 的工具定义
@@ -350,5 +359,42 @@ TOOLS_SCHEMA = [
                 "required": ["code"]
             }
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "read_result",
+            "description": "读取已存档的超长工具结果（结果中带有 handle=res_...）。可按页、按行范围读取，或按关键词搜索匹配行。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "handle": {
+                        "type": "string",
+                        "description": "存档句柄，例如 'res_0123456789ab'。"
+                    },
+                    "page": {
+                        "type": "integer",
+                        "description": "页码，从 1 开始。"
+                    },
+                    "start_line": {
+                        "type": "integer",
+                        "description": "起始行号（从 1 开始）。JSON 数组结果每行一条记录。"
+                    },
+                    "end_line": {
+                        "type": "integer",
+                        "description": "结束行号（含）。"
+                    },
+                    "pattern": {
+                        "type": "string",
+                        "description": "要搜索的关键词，返回包含它的行及行号（不区分大小写）。"
+                    },
+                    "regex": {
+                        "type": "boolean",
+                        "description": "为 true 时 pattern 按正则表达式匹配，默认按普通文本匹配。"
+                    }
+                },
+                "required": ["handle"]
+            }
+        }
     }
 ]
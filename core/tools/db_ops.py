@@ -3,6 +3,20 @@ import json
 import sqlite3
 import pymysql
 from typing import Optional
+from core.tools.streaming import collect
+
+# 流式查询每批读取的行数
+FETCH_BATCH_SIZE = 100
+# 逐行推送给客户端的最大行数，超过后只报告已读取的行数
+PROGRESS_MAX_ROWS = 200
+
+def _row_progress(rows, total: int) -> str:
+    """一批行的进度片段：前 PROGRESS_MAX_ROWS 行逐行输出（每行一个 JSON），之后只输出计数。"""
+    shown = max(0, min(len(rows), PROGRESS_MAX_ROWS - (total - len(rows))))
+    text = "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in rows[:shown])
+    if shown < len(rows):
+        text += f"...已读取 {total} 行\n"
+    return text
 
 def query_sqlite(db_path: str, query: str) -> str:
     """
@@ -15,6 +29,10 @@ def query_sqlite(db_path: str, query: str) -> str:
     Returns:
         查询结果的 JSON 字符串。
     """
+    return collect(query_sqlite_stream(db_path, query))
+
+def query_sqlite_stream(db_path: str, query: str):
+    """query_sqlite 的流式版本：按批读取并产出行，返回值与 query_sqlite 相同。"""
     try:
         if not os.path.exists(db_path):
             return f"错误: 数据库文件 '{db_path}' 不存在。"
@@ -25,11 +43,15 @@ def query_sqlite(db_path: str, query: str) -> str:
         
         # 获取列名和行数据
         columns = [description[0] for description in cursor.description] if cursor.description else []
-        rows = cursor.fetchall()
         
         results = []
-        for row in rows:
-            results.append(dict(zip(columns, row)))
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            batch = [dict(zip(columns, row)) for row in rows]
+            results.extend(batch)
+            yield _row_progress(batch, len(results))
             
         conn.close()
         return json.dumps(results, ensure_ascii=False, default=str)
@@ -51,24 +73,35 @@ def query_mysql(query: str, host: str, user: str, password: str, database: Optio
     Returns:
         查询结果的 JSON 字符串。
     """
+    return collect(query_mysql_stream(query, host, user, password, database, port))
+
+def query_mysql_stream(query: str, host: str, user: str, password: str, database: Optional[str] = None, port: int = 3306):
+    """query_mysql 的流式版本：读取查询使用无缓冲游标，边从服务器接收边产出行。"""
     try:
+        # 检查是否为读取查询
+        query_stripped = query.strip().upper()
+        is_read = query_stripped.startswith(('SELECT', 'SHOW', 'DESCRIBE', 'EXPLAIN'))
         connection = pymysql.connect(
             host=host,
             user=user,
             password=password,
             database=database,
             port=port,
-            cursorclass=pymysql.cursors.DictCursor
+            cursorclass=pymysql.cursors.SSDictCursor if is_read else pymysql.cursors.DictCursor
         )
         
         with connection:
             with connection.cursor() as cursor:
                 affected_rows = cursor.execute(query)
                 
-                # 检查是否为读取查询
-                query_stripped = query.strip().upper()
-                if query_stripped.startswith(('SELECT', 'SHOW', 'DESCRIBE', 'EXPLAIN')):
-                    result = cursor.fetchall()
+                if is_read:
+                    result = []
+                    while True:
+                        rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+                        if not rows:
+                            break
+                        result.extend(rows)
+                        yield _row_progress(rows, len(result))
                     return json.dumps(result, ensure_ascii=False, default=str)
                 else:
                     connection.commit()
@@ -4,8 +4,9 @@ import requests
 import json
 from typing import Optional
 from PIL import Image, ImageDraw, ImageFont
-from openai import OpenAI
 from config import Config
+from core.model_transport import model_transport
+from core.rate_limiter import rate_limiter, estimate_tokens
 
 def generate_image(prompt: str, filename: str, size: str = "1024x1024") -> str:
     """
@@ -49,22 +50,18 @@ def generate_image(prompt: str, filename: str, size: str = "1024x1024") -> str:
         base_url = Config.LOGIC_BASE_URL
         
         if api_key:
-            client = OpenAI(
-                api_key=api_key,
-                base_url=base_url
-            )
+            client = model_transport.client(api_key, base_url)
             
             # 使用 chat completion 调用 gemini-3-pro-image-preview
             # 注意：如果模型支持尺寸参数，应在此处传递。
             # 目前只能通过 prompt 暗示。
             enhanced_prompt = f"{prompt} --aspect {width}:{height}"
             
-            response = client.chat.completions.create(
+            messages = [{"role": "user", "content": enhanced_prompt}]
+            response = model_transport.call(lambda: client.chat.completions.create(
                 model="gemini-3-pro-image-preview",
-                messages=[
-                    {"role": "user", "content": enhanced_prompt}
-                ]
-            )
+                messages=messages
+            ), limiter=rate_limiter.for_endpoint(base_url), tokens=estimate_tokens(messages))
             
             content = response.choices[0].message.content
             # 提取 markdown 图像链接: ![alt](url)
@@ -1,7 +1,18 @@
 import os
 import sys
 import subprocess
+import tempfile
 import ast
+import time
+import queue
+import threading
+from core.cancellation import current_cancel_token
+from core.tools.streaming import collect
+
+# 执行超时（秒）
+RUN_TIMEOUT = 10
+# 检查请求是否已取消的间隔（秒）
+CANCEL_POLL_INTERVAL = 0.1
 
 def run_python(code: str) -> str:
     """
@@ -14,6 +25,12 @@ def run_python(code: str) -> str:
     Returns:
         执行的输出 (stdout + stderr)。
     """
+    return collect(run_python_stream(code))
+
+def run_python_stream(code: str):
+    """
+    run_python 的流式版本：逐行产出 stdout，返回值为完整输出 (stdout + stderr)。
+    """
     # 1. 静态安全检查
     try:
         tree = ast.parse(code)
@@ -56,34 +73,88 @@ def run_python(code: str) -> str:
         return f"安全检查时发生错误: {e}"
 
     try:
-        # 创建临时文件
-        temp_file = os.path.join(os.getcwd(), "temp_script.py")
+        # 创建临时文件（文件名唯一，允许多个调用并发执行）
+        fd, temp_file = tempfile.mkstemp(prefix="temp_script_", suffix=".py", dir=os.getcwd())
         
         # 将代码写入文件
-        with open(temp_file, 'w', encoding='utf-8') as f:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
             f.write(code)
             
-        # 带超时运行脚本
-        result = subprocess.run(
-            [sys.executable, temp_file],
-            capture_output=True,
-            text=True,
-            timeout=10  # 10 秒超时
+        # 带超时运行脚本；请求被取消（例如客户端断开）时立即结束子进程
+        cancel_token = current_cancel_token()
+        deadline = time.monotonic() + RUN_TIMEOUT
+        # -u：子进程不缓冲输出，print 的内容可以立即转发
+        proc = subprocess.Popen(
+            [sys.executable, "-u", temp_file],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
         )
+
+        # 后台线程读取输出，主循环逐行转发 stdout，同时检查超时和取消
+        stdout_lines = queue.Queue()
+        stderr_parts = []
+
+        def read_stdout():
+            for line in proc.stdout:
+                stdout_lines.put(line)
+            stdout_lines.put(None)
+
+        readers = [
+            threading.Thread(target=read_stdout, daemon=True),
+            threading.Thread(target=lambda: stderr_parts.append(proc.stderr.read()), daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+
+        stdout_parts = []
+        stdout_open = True
+        while True:
+            if cancel_token is not None and cancel_token.cancelled:
+                proc.kill()
+                proc.wait()
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                return "错误: 请求已取消，执行被中断。"
+            if time.monotonic() >= deadline:
+                proc.kill()
+                proc.wait()
+                raise subprocess.TimeoutExpired(proc.args, RUN_TIMEOUT)
+            if not stdout_open:
+                # 脚本可能关闭或重定向了 stdout 后继续运行：同样在超时和取消检查下等待它退出
+                try:
+                    proc.wait(timeout=CANCEL_POLL_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    continue
+            try:
+                line = stdout_lines.get(timeout=CANCEL_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if line is None:
+                stdout_open = False
+                continue
+            stdout_parts.append(line)
+            yield line
+
+        # 脚本启动的子进程可能仍持有 stderr，不无限等待
+        for reader in readers:
+            reader.join(timeout=1.0)
         
         # 清理
         if os.path.exists(temp_file):
             os.remove(temp_file)
             
-        output = result.stdout
-        if result.stderr:
-            output += f"\n[标准错误]:\n{result.stderr}"
+        output = "".join(stdout_parts)
+        stderr = "".join(stderr_parts)
+        if stderr:
+            output += f"\n[标准错误]:\n{stderr}"
             
         return output
     except subprocess.TimeoutExpired:
         if os.path.exists(temp_file):
             os.remove(temp_file)
-        return "错误: 执行超时 (限制: 10秒)。"
+        return f"错误: 执行超时 (限制: {RUN_TIMEOUT}秒)。"
     except Exception as e:
         if os.path.exists(temp_file):
             os.remove(temp_file)
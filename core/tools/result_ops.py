@@ -0,0 +1,31 @@
+from typing import Optional
+from core.result_store import result_store, current_result_session
+
+def read_result(handle: str, page: Optional[int] = None, start_line: Optional[int] = None,
+                end_line: Optional[int] = None, pattern: Optional[str] = None, regex: bool = False) -> str:
+    """
+    读取已存档的超长工具结果。
+
+    Args:
+        handle: 工具结果中给出的句柄（res_ 开头）。
+        page: 页码（从 1 开始）。
+        start_line: 起始行号（从 1 开始，含）。
+        end_line: 结束行号（含），省略时读到单页上限为止。
+        pattern: 关键词，返回所有包含它的行及行号（不区分大小写）。
+        regex: 为 True 时 pattern 按正则表达式匹配。
+
+    Returns:
+        请求的内容片段，或错误信息。
+    """
+    session_id = current_result_session()
+    if not session_id:
+        return "错误: 当前没有会话，无法读取存档结果。"
+    try:
+        text, _ = result_store.load(session_id, handle)
+    except KeyError:
+        return f"错误: 句柄 '{handle}' 不存在或不属于当前会话。"
+    if pattern:
+        return result_store.grep(text, pattern, regex=bool(regex))
+    if start_line is not None or end_line is not None:
+        return result_store.lines(text, int(start_line or 1), int(end_line) if end_line is not None else None)
+    return result_store.page(text, int(page or 1))
@@ -0,0 +1,23 @@
+"""
+流式工具协议。
+
+流式工具是一个生成器函数：执行过程中 yield 输出片段（字符串），结束时 return 交给模型的最终结果；
+return None 时最终结果为全部片段的拼接。Agent 把片段作为 tool_progress 事件转发给客户端。
+每个流式工具同时保留一个同名的普通版本（用 collect 收集结果），供不需要进度的调用方使用。
+"""
+from typing import Generator, Optional
+
+ToolStream = Generator[str, None, Optional[str]]
+
+
+def collect(stream: ToolStream, on_chunk=None) -> str:
+    """执行流式工具直到结束，返回最终结果。on_chunk(chunk) 在每个片段产出时调用。"""
+    chunks = []
+    while True:
+        try:
+            chunk = next(stream)
+        except StopIteration as stop:
+            return stop.value if stop.value is not None else "".join(chunks)
+        chunks.append(chunk)
+        if on_chunk is not None:
+            on_chunk(chunk)
@@ -1,19 +1,13 @@
-from openai import OpenAI
 from config import Config
+from core.model_transport import model_transport
+from core.llm_client import ModelRouter
+from core.rate_limiter import estimate_tokens
 
 class VisionClient:
     def __init__(self):
         # Updated to use VISION_ config variables
-        if Config.VISION_API_KEY:
-            # Use OpenAI client for Gemini via the compatible API endpoint
-            self.client = OpenAI(
-                api_key=Config.VISION_API_KEY,
-                base_url=Config.VISION_BASE_URL
-            )
-            self.model = Config.VISION_MODEL
-        else:
-            self.client = None
-            self.model = None
+        # Use OpenAI client for Gemini via the compatible API endpoint(s)
+        self.router = ModelRouter.from_config("vision")
 
     def analyze_image(self, image_input, prompt="请详细描述这张图片的内容"):
         """
@@ -23,7 +17,7 @@ class VisionClient:
         :param prompt: Prompt for analysis
         :return: Text description
         """
-        if not self.client:
+        if not self.router.endpoints:
             return "视觉功能未配置 (缺少 VISION_API_KEY)。"
             
         try:
@@ -43,11 +37,13 @@ class VisionClient:
                 }
             ]
             
-            response = self.client.chat.completions.create(
-                model=self.model,
+            response = self.router.call(lambda endpoint: model_transport.client(
+                endpoint.api_key, endpoint.base_url
+            ).chat.completions.create(
+                model=endpoint.model,
                 messages=messages,
                 max_tokens=300
-            )
+            ), tokens=estimate_tokens(messages, completion_tokens=300))
             
             return response.choices[0].message.content
         except Exception as e:
@@ -0,0 +1,19 @@
+"""
+一次性导入工具：把 data/sessions 下已有的 JSON / JSONL 会话导入 SQLite 会话库。
+
+用法:
+    python import_sessions.py [storage_dir]
+
+可以重复执行，已导入的消息会被跳过。
+"""
+import sys
+from core.session_store import SqliteSessionStore, import_legacy_sessions
+
+def main():
+    storage_dir = sys.argv[1] if len(sys.argv) > 1 else "data/sessions"
+    store = SqliteSessionStore(storage_dir)
+    count = import_legacy_sessions(storage_dir, store)
+    print(f"导入完成：共处理 {count} 个会话 -> {store.db_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,12 @@
 import os
+import asyncio
 import base64
 import json
 import io
 from typing import Optional, Dict, Any, List
-from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, Query
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
@@ -14,6 +15,11 @@ from docx import Document
 
 # 导入 Agent
 from core.agent import PersonalAgent
+from core.tool_cache import tool_cache
+from core.llm_cache import llm_cache
+from core.metrics import registry as metrics_registry
+from core.cancellation import CancelToken
+from core.admission import AdmissionController, QueueFullError
 
 # 加载环境变量
 load_dotenv()
@@ -31,6 +37,8 @@ app.add_middleware(
 
 # 初始化 Agent
 agent = PersonalAgent()
+# 限制同时运行的 Agent 循环数，其余请求排队
+admission = AdmissionController()
 
 # 提供静态文件服务
 app.mount("/static", StaticFiles(directory="web"), name="static")
@@ -72,6 +80,8 @@ class ChatRequest(BaseModel):
     db_config: Optional[Dict[str, Any]] = None
     file_config: Optional[FileConfig] = None
     max_steps: Optional[int] = 10
+    # 为 True 时在响应末尾附带本次请求的分阶段耗时
+    timing: Optional[bool] = None
 
 class APIConfig(BaseModel):
     logic_base_url: Optional[str] = None
@@ -187,14 +197,31 @@ async def update_config(config: APIConfig):
         # 重新初始化 Agent 以应用更改 (如果 Agent 内部缓存了这些值)
         # 注意：Agent 实例是全局的，如果它在 __init__ 中读取了配置，需要重新实例化
         global agent
+        # 旧 Agent 的会话工作集先写回磁盘，新 Agent 会从磁盘重新加载
+        agent.session_manager.close()
         agent = PersonalAgent()
 
         return {"status": "success", "message": "配置已更新"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def _admission_key(session_id: Optional[str], http_request: Request) -> str:
+    """公平排队的分组：已有会话按会话，新会话按客户端地址。"""
+    if session_id:
+        return f"session:{session_id}"
+    client = http_request.client
+    return f"client:{client.host if client else 'unknown'}"
+
+def _admit(key: str):
+    """申请 Agent 运行名额，等待队列已满时返回 429。"""
+    try:
+        return admission.enqueue(key)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
 @app.post("/api/chat")
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, http_request: Request):
+    ticket = _admit(_admission_key(request.session_id, http_request))
     try:
         # 构建 Agent 消息（模仿 Plato 格式）
         message = {
@@ -203,16 +230,44 @@ async def chat_endpoint(request: ChatRequest):
             "image": None,
             "db_config": request.db_config,
             "file_config": request.file_config.dict() if request.file_config else None,
-            "max_steps": request.max_steps
+            "max_steps": request.max_steps,
+            "timing": request.timing
         }
         
-        result = agent.process_message(message, session_id=request.session_id)
+        await admission.wait(ticket)
+        result = await agent.aprocess_message(message, session_id=request.session_id)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        admission.release(ticket)
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    持有运行名额的流式响应。生成器开始运行后由它负责归还名额；客户端在生成器第一次被迭代之前
+    就断开时生成器不会运行（其 finally 也不会执行），由响应在结束时归还，避免名额泄漏。
+    """
+    def __init__(self, content, ticket, state: Dict[str, bool], **kwargs):
+        super().__init__(content, **kwargs)
+        self.ticket = ticket
+        self.state = state
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if not self.state["started"]:
+                admission.release(self.ticket)
+
+# 流式请求期间检查客户端是否已断开的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.25
+# 排队期间检查排队位置的间隔（秒），位置变化时推送 queue 事件
+QUEUE_POLL_INTERVAL = 1.0
 
 @app.post("/api/chat/stream")
-async def chat_stream_endpoint(request: ChatRequest):
+async def chat_stream_endpoint(request: ChatRequest, http_request: Request):
+    # 在返回流之前申请名额，队列已满时直接返回 429
+    ticket = _admit(_admission_key(request.session_id, http_request))
     try:
         message = {
             "chat_id": "web-user",
@@ -220,24 +275,78 @@ async def chat_stream_endpoint(request: ChatRequest):
             "image": None,
             "db_config": request.db_config,
             "file_config": request.file_config.dict() if request.file_config else None,
-            "max_steps": request.max_steps
+            "max_steps": request.max_steps,
+            "timing": request.timing
         }
         
-        def event_generator():
+        # 生成器开始运行后置为 True，此后名额由生成器归还
+        state = {"started": False}
+
+        async def event_generator():
+            state["started"] = True
+            # Agent 循环在独立任务中运行，客户端断开时通过 CancelToken 取消它：
+            # 即使当前没有事件可发送（例如正在等待慢工具），也能在一秒内停止
+            cancel_token = CancelToken()
+            queue = asyncio.Queue()
+
+            async def run_agent():
+                try:
+                    async for event in agent.aprocess_message_stream(
+                        message, session_id=request.session_id, cancel_token=cancel_token
+                    ):
+                        await queue.put(event)
+                except Exception as e:
+                    await queue.put({"type": "error", "content": str(e)})
+                finally:
+                    queue.put_nowait(None)
+
+            async def watch_disconnect():
+                while not cancel_token.cancelled:
+                    if await http_request.is_disconnected():
+                        print("Client disconnected, cancelling request")
+                        cancel_token.cancel()
+                        return
+                    await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+            watcher = asyncio.create_task(watch_disconnect())
+            agent_task = None
             try:
-                for event in agent.process_message_stream(message, session_id=request.session_id):
+                # 排队等待运行名额，位置变化时推送 {"type": "queue", "position": n}
+                last_position = None
+                while not await admission.wait(ticket, timeout=QUEUE_POLL_INTERVAL):
+                    if cancel_token.cancelled:
+                        return
+                    position = admission.position(ticket)
+                    if position != last_position:
+                        last_position = position
+                        yield f"data: {json.dumps({'type': 'queue', 'position': position}, ensure_ascii=False)}\n\n"
+
+                agent_task = asyncio.create_task(run_agent())
+                # 名额在 Agent 任务真正结束（包括取消后的收尾）时归还
+                agent_task.add_done_callback(lambda _: admission.release(ticket))
+                cancel_token.bind(agent_task)
+                while True:
+                    event = await queue.get()
+                    if event is None:
+                        break
                     yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
-            except Exception as e:
-                err_event = {"type": "error", "content": str(e)}
-                yield f"data: {json.dumps(err_event, ensure_ascii=False)}\n\n"
-            yield "data: [DONE]\n\n"
-
-        return StreamingResponse(event_generator(), media_type="text/event-stream")
+                yield "data: [DONE]\n\n"
+            finally:
+                watcher.cancel()
+                # 发送失败或响应被取消时同样停止 Agent
+                if agent_task is None:
+                    admission.release(ticket)
+                elif not agent_task.done():
+                    cancel_token.cancel()
+
+        return AdmittedStreamingResponse(event_generator(), ticket, state, media_type="text/event-stream")
     except Exception as e:
+        admission.release(ticket)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/vision")
-async def vision_endpoint(text: str = Form(...), session_id: Optional[str] = Form(None), db_config: Optional[str] = Form(None), file_config: Optional[str] = Form(None), file: UploadFile = File(...)):
+async def vision_endpoint(http_request: Request, text: str = Form(...), session_id: Optional[str] = Form(None), db_config: Optional[str] = Form(None), file_config: Optional[str] = Form(None), file: UploadFile = File(...)):
+    ticket = _admit(_admission_key(session_id, http_request))
     try:
         content_type = file.content_type
         filename = file.filename
@@ -311,26 +420,57 @@ async def vision_endpoint(text: str = Form(...), session_id: Optional[str] = For
             "file_config": parsed_file_config
         }
         
-        result = agent.process_message(message, session_id=session_id)
+        await admission.wait(ticket)
+        result = await agent.aprocess_message(message, session_id=session_id)
         return result
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        admission.release(ticket)
 
 # 历史记录 / 会话管理 API
 
+# 以下会话接口涉及阻塞的文件 I/O，定义为普通函数，由 FastAPI 放到线程池执行，避免阻塞事件循环
+
+# 不带分页参数时保持原有的返回格式（完整列表 / 完整会话）
+
 @app.get("/api/sessions")
-async def list_sessions():
-    return agent.session_manager.list_sessions()
+def list_sessions(limit: Optional[int] = Query(None, ge=1, le=500),
+                  before: Optional[str] = None, after: Optional[str] = None):
+    if limit is None and before is None and after is None:
+        return agent.session_manager.list_sessions()
+    try:
+        return agent.session_manager.list_sessions_page(limit=limit, before=before, after=after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/sessions")
-async def create_session():
+def create_session():
     return agent.session_manager.create_session()
 
+# 必须注册在 /api/sessions/{session_id} 之前，否则 "search" 会被当作会话 ID
+@app.get("/api/sessions/search")
+def search_sessions(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100),
+                    offset: int = Query(0, ge=0)):
+    try:
+        return {"query": q, "results": agent.session_manager.search(q, limit=limit, offset=offset)}
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
 @app.get("/api/sessions/{session_id}")
-async def get_session(session_id: str):
-    session = agent.session_manager.get_session(session_id)
+def get_session(session_id: str, limit: Optional[int] = Query(None, ge=1, le=1000),
+                before: Optional[int] = None, after: Optional[int] = None, view: Optional[str] = None):
+    if limit is None and before is None and after is None and view is None:
+        session = agent.session_manager.get_session(session_id)
+    else:
+        try:
+            session = agent.session_manager.get_messages(
+                session_id, limit=limit, before=before, after=after, view=view or "full"
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     return session
@@ -378,8 +518,10 @@ class DBConfig(BaseModel):
     password: str
     database: Optional[str] = None # 数据库名称可选
 
+# 数据库接口同样是阻塞调用，定义为普通函数交给线程池
+
 @app.post("/api/db/test-connection")
-async def test_db_connection(config: DBConfig):
+def test_db_connection(config: DBConfig):
     from core.tools import query_mysql
     try:
         # 使用简单查询测试连接
@@ -392,7 +534,7 @@ async def test_db_connection(config: DBConfig):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/db/databases")
-async def list_databases(config: DBConfig):
+def list_databases(config: DBConfig):
     from core.tools import query_mysql
     try:
         sql = "SHOW DATABASES"
@@ -405,7 +547,7 @@ async def list_databases(config: DBConfig):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/db/tables")
-async def list_db_tables(config: DBConfig):
+def list_db_tables(config: DBConfig):
     from core.tools import query_mysql
     try:
         if not config.database:
@@ -432,10 +574,11 @@ class DBQueryRequest(BaseModel):
     query: str
 
 @app.post("/api/db/execute")
-async def execute_db_query(req: DBQueryRequest):
+def execute_db_query(req: DBQueryRequest):
     from core.tools import query_mysql
     try:
         res = query_mysql(req.query, req.config.host, req.config.user, req.config.password, req.config.database, req.config.port)
+        tool_cache.invalidate_for("query_mysql", {"query": req.query, "host": req.config.host, "port": req.config.port})
         if res.startswith("Error"):
              raise HTTPException(status_code=400, detail=res)
         return json.loads(res)
@@ -443,12 +586,37 @@ async def execute_db_query(req: DBQueryRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/api/sessions/{session_id}")
-async def delete_session(session_id: str):
+def delete_session(session_id: str):
     success = agent.session_manager.delete_session(session_id)
     if not success:
         raise HTTPException(status_code=404, detail="Session not found")
     return {"status": "success"}
 
+# 工具结果缓存
+
+@app.get("/api/tools/cache")
+def tool_cache_stats():
+    return tool_cache.get_stats()
+
+@app.delete("/api/tools/cache")
+def clear_tool_cache():
+    tool_cache.clear()
+    return {"status": "success"}
+
+@app.get("/api/llm/cache")
+def llm_cache_stats():
+    return llm_cache.get_stats()
+
+@app.delete("/api/llm/cache")
+def clear_llm_cache():
+    llm_cache.clear()
+    return {"status": "success"}
+
+@app.get("/api/metrics")
+def metrics():
+    """Prometheus 文本格式的延迟直方图（模型请求、首 token、工具调用、会话读写、图片分析）。"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
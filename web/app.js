@@ -203,6 +203,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // New Chat Button
     newChatBtn.addEventListener('click', () => {
         currentSessionId = null;
+        hasOlderMessages = false;
         showWelcomeMessage();
         // Clear active class from history
         document.querySelectorAll('.history-item').forEach(el => el.classList.remove('active'));
@@ -889,51 +890,98 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // 会话列表和消息历史都按页加载，滚动到边缘时再取下一页
+    const HISTORY_PAGE_SIZE = 50;
+    const MESSAGE_PAGE_SIZE = 30;
+    // 工具实时输出区域保留的最大行数
+    const TOOL_OUTPUT_MAX_LINES = 8;
+    let historyCursor = null;
+    let historyLoading = false;
+    let oldestMessageIndex = null;
+    let hasOlderMessages = false;
+    let messagesLoading = false;
+
+    function renderHistoryItem(session) {
+        const li = document.createElement('li');
+        li.className = 'history-item';
+        li.dataset.id = session.id;
+        if (session.id === currentSessionId) li.classList.add('active');
+        
+        li.innerHTML = `
+            <span><svg class="icon" style="margin-right:8px; opacity:0.7;"><use href="#icon-chat"></use></svg>${session.title}</span>
+            <button class="delete-btn" title="删除对话"><svg class="icon"><use href="#icon-trash"></use></svg></button>
+        `;
+        
+        // Click to load
+        li.addEventListener('click', (e) => {
+            if (e.target.closest('.delete-btn')) return; // Ignore delete click
+            loadSession(session.id);
+        });
+
+        // Delete button
+        const delBtn = li.querySelector('.delete-btn');
+        delBtn.addEventListener('click', async (e) => {
+            e.stopPropagation();
+            if(confirm('确定要删除这个对话吗？')) {
+                await fetch(`/api/sessions/${session.id}`, { method: 'DELETE' });
+                if (currentSessionId === session.id) {
+                    newChatBtn.click();
+                }
+                loadHistory();
+            }
+        });
+
+        historyList.appendChild(li);
+    }
+
     async function loadHistory() {
+        historyLoading = true;
         try {
-            const res = await fetch('/api/sessions');
-            const sessions = await res.json();
+            const res = await fetch(`/api/sessions?limit=${HISTORY_PAGE_SIZE}`);
+            const page = await res.json();
             historyList.innerHTML = '';
-            
-            sessions.forEach(session => {
-                const li = document.createElement('li');
-                li.className = 'history-item';
-                li.dataset.id = session.id;
-                if (session.id === currentSessionId) li.classList.add('active');
-                
-                li.innerHTML = `
-                    <span><svg class="icon" style="margin-right:8px; opacity:0.7;"><use href="#icon-chat"></use></svg>${session.title}</span>
-                    <button class="delete-btn" title="删除对话"><svg class="icon"><use href="#icon-trash"></use></svg></button>
-                `;
-                
-                // Click to load
-                li.addEventListener('click', (e) => {
-                    if (e.target.closest('.delete-btn')) return; // Ignore delete click
-                    loadSession(session.id);
-                });
-
-                // Delete button
-                const delBtn = li.querySelector('.delete-btn');
-                delBtn.addEventListener('click', async (e) => {
-                    e.stopPropagation();
-                    if(confirm('确定要删除这个对话吗？')) {
-                        await fetch(`/api/sessions/${session.id}`, { method: 'DELETE' });
-                        if (currentSessionId === session.id) {
-                            newChatBtn.click();
-                        }
-                        loadHistory();
-                    }
-                });
+            historyCursor = page.next_cursor;
+            page.sessions.forEach(renderHistoryItem);
+        } catch (error) {
+            console.error('Failed to load history:', error);
+        } finally {
+            historyLoading = false;
+        }
+    }
 
-                historyList.appendChild(li);
-            });
+    async function loadMoreHistory() {
+        if (historyLoading || !historyCursor) return;
+        historyLoading = true;
+        try {
+            const res = await fetch(`/api/sessions?limit=${HISTORY_PAGE_SIZE}&before=${encodeURIComponent(historyCursor)}`);
+            const page = await res.json();
+            historyCursor = page.next_cursor;
+            page.sessions.forEach(renderHistoryItem);
         } catch (error) {
             console.error('Failed to load history:', error);
+        } finally {
+            historyLoading = false;
         }
     }
 
+    const historyContainer = document.querySelector('.history-container');
+    if (historyContainer) {
+        historyContainer.addEventListener('scroll', () => {
+            if (historyContainer.scrollTop + historyContainer.clientHeight >= historyContainer.scrollHeight - 50) {
+                loadMoreHistory();
+            }
+        });
+    }
+
+    // 服务端已经过滤掉工具消息 (view=display)，这里只负责渲染
+    function renderHistoryMessage(msg) {
+        return appendMessage(msg.role === 'user' ? 'user' : 'agent', msg.content);
+    }
+
     async function loadSession(sessionId) {
         currentSessionId = sessionId;
+        oldestMessageIndex = null;
+        hasOlderMessages = false;
         
         // Update Active State
         document.querySelectorAll('.history-item').forEach(el => {
@@ -945,25 +993,17 @@ document.addEventListener('DOMContentLoaded', () => {
         const loadingId = appendLoading();
 
         try {
-            const res = await fetch(`/api/sessions/${sessionId}`);
+            const res = await fetch(`/api/sessions/${sessionId}?view=display&limit=${MESSAGE_PAGE_SIZE}`);
             const session = await res.json();
             
             removeLoading(loadingId);
+            if (currentSessionId !== sessionId) return;
             
-            // Replay messages
+            // Replay newest page
             if (session.messages && session.messages.length > 0) {
-                session.messages.forEach(msg => {
-                   // Filter: Show User messages, and Agent messages that are NOT tool calls (final responses)
-                   // Hide 'tool' role and 'assistant' messages that initiate tools
-                   if (msg.role === 'user') {
-                       appendMessage('user', msg.content);
-                   } else if (msg.role === 'assistant') {
-                       // Only show if it does NOT have tool_calls (or tool_calls is empty)
-                       if (!msg.tool_calls || msg.tool_calls.length === 0) {
-                           appendMessage('agent', msg.content);
-                       }
-                   }
-                });
+                session.messages.forEach(renderHistoryMessage);
+                oldestMessageIndex = session.messages[0].index;
+                hasOlderMessages = session.has_more;
             } else {
                  showWelcomeMessage();
             }
@@ -974,6 +1014,42 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    async function loadOlderMessages() {
+        if (messagesLoading || !hasOlderMessages || oldestMessageIndex === null || !currentSessionId) return;
+        const sessionId = currentSessionId;
+        messagesLoading = true;
+        try {
+            const res = await fetch(`/api/sessions/${sessionId}?view=display&limit=${MESSAGE_PAGE_SIZE}&before=${oldestMessageIndex}`);
+            const session = await res.json();
+            if (currentSessionId !== sessionId || !session.messages) return;
+
+            // 把更早的消息插到顶部，并保持当前可视位置不跳动
+            const prevHeight = chatContainer.scrollHeight;
+            const prevTop = chatContainer.scrollTop;
+            const firstChild = chatContainer.firstChild;
+            session.messages.forEach(msg => {
+                const msgDiv = renderHistoryMessage(msg);
+                chatContainer.insertBefore(msgDiv, firstChild);
+            });
+            chatContainer.scrollTop = chatContainer.scrollHeight - prevHeight + prevTop;
+
+            if (session.messages.length > 0) {
+                oldestMessageIndex = session.messages[0].index;
+            }
+            hasOlderMessages = session.has_more;
+        } catch (error) {
+            console.error('Failed to load older messages:', error);
+        } finally {
+            messagesLoading = false;
+        }
+    }
+
+    chatContainer.addEventListener('scroll', () => {
+        if (chatContainer.scrollTop < 50) {
+            loadOlderMessages();
+        }
+    });
+
     let abortController = null;
 
     if (stopBtn) {
@@ -1067,6 +1143,11 @@ document.addEventListener('DOMContentLoaded', () => {
                 const data = await response.json();
                 
                 removeLoading(loadingId);
+
+                if (response.status === 429) {
+                    const retryAfter = response.headers.get('Retry-After');
+                    appendMessage('agent', retryAfter ? `服务繁忙，请 ${retryAfter} 秒后重试。` : '服务繁忙，请稍后重试。');
+                }
                 
                 if (data.response) {
                     appendMessage('agent', data.response, null, true);
@@ -1113,6 +1194,12 @@ document.addEventListener('DOMContentLoaded', () => {
             });
 
             removeLoading(loadingId);
+
+            if (response.status === 429) {
+                const retryAfter = response.headers.get('Retry-After');
+                appendMessage('agent', retryAfter ? `服务繁忙，请 ${retryAfter} 秒后重试。` : '服务繁忙，请稍后重试。');
+                return;
+            }
             
             // Create placeholder for streaming content
             appendMessage('agent', ''); 
@@ -1174,6 +1261,18 @@ document.addEventListener('DOMContentLoaded', () => {
                     
                     try {
                         const event = JSON.parse(dataStr);
+
+                        // 排队提示只在等待期间显示，收到其他事件即移除
+                        const queueStatus = contentDiv.querySelector('.queue-status');
+                        if (event.type === 'queue') {
+                            const status = queueStatus || document.createElement('div');
+                            status.className = 'queue-status';
+                            status.style.cssText = 'font-size:0.85em; color:#666;';
+                            status.textContent = `⏳ 排队中，前面还有 ${event.position - 1} 个请求...`;
+                            if (!queueStatus) contentDiv.appendChild(status);
+                            continue;
+                        }
+                        if (queueStatus) queueStatus.remove();
                         
                         if (event.type === 'content') {
                             markdownBuffer += event.content;
@@ -1183,15 +1282,37 @@ document.addEventListener('DOMContentLoaded', () => {
                             const toolInfo = document.createElement('div');
                             toolInfo.className = 'tool-indicator';
                             toolInfo.style.cssText = 'font-size:0.85em; color:#666; margin-top:5px; padding:4px 8px; background:rgba(0,0,0,0.05); border-radius:4px;';
-                            toolInfo.textContent = `⚡ 调用工具: ${event.tool}...`;
+                            const label = document.createElement('span');
+                            label.className = 'tool-label';
+                            label.textContent = `⚡ 调用工具: ${event.tool}...`;
+                            toolInfo.appendChild(label);
+                            if (event.id) toolInfo.dataset.callId = event.id;
                             contentDiv.appendChild(toolInfo);
                             scrollToBottom();
+                        } else if (event.type === 'tool_progress') {
+                            // 工具的实时输出，只保留最后若干行
+                            const indicator = Array.from(contentDiv.querySelectorAll('.tool-indicator'))
+                                .find(el => el.dataset.callId === event.id);
+                            if (indicator) {
+                                let output = indicator.querySelector('.tool-output');
+                                if (!output) {
+                                    output = document.createElement('pre');
+                                    output.className = 'tool-output';
+                                    output.style.cssText = 'margin:4px 0 0; max-height:10em; overflow:hidden; white-space:pre-wrap; font-size:0.9em;';
+                                    indicator.appendChild(output);
+                                }
+                                output.textContent = (output.textContent + event.content).split('\n').slice(-TOOL_OUTPUT_MAX_LINES).join('\n');
+                                scrollToBottom();
+                            }
                         } else if (event.type === 'tool_result') {
-                             const indicators = contentDiv.querySelectorAll('.tool-indicator');
-                             if(indicators.length > 0) {
-                                 const last = indicators[indicators.length - 1];
-                                 last.textContent += ' ✓';
-                                 setTimeout(() => last.remove(), 1000);
+                             // 工具并发执行，按调用 ID 找到对应的指示条
+                             const indicators = Array.from(contentDiv.querySelectorAll('.tool-indicator'));
+                             const target = indicators.find(el => event.id && el.dataset.callId === event.id)
+                                 || indicators[indicators.length - 1];
+                             if (target) {
+                                 const label = target.querySelector('.tool-label') || target;
+                                 label.textContent += ' ✓';
+                                 setTimeout(() => target.remove(), 1000);
                              }
                         } else if (event.type === 'meta') {
                             if (onMeta) onMeta(event);
@@ -1440,6 +1561,7 @@ document.addEventListener('DOMContentLoaded', () => {
         }
 
         scrollToBottom();
+        return msgDiv;
     }
 
     function typeText(element, text) {